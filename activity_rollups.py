@@ -0,0 +1,202 @@
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from database import get_connection
+
+# Сколько дней хранятся почасовые и суточные сводки
+ROLLUP_HOURLY_DAYS = int(os.getenv('ROLLUP_HOURLY_DAYS', '14'))
+ROLLUP_DAILY_DAYS = int(os.getenv('ROLLUP_DAILY_DAYS', '400'))
+
+HOUR_FORMAT = '%Y-%m-%d %H:00'
+DAY_FORMAT = '%Y-%m-%d'
+
+# Строк истории в одной порции фонового пересчета сводок
+REBUILD_CHUNK = 2000
+
+# Таблица сводки -> (формат периода, учитывается ли пользователь)
+ROLLUP_TABLES = {
+    'chat_activity_hourly': (HOUR_FORMAT, False),
+    'chat_user_activity_hourly': (HOUR_FORMAT, True),
+    'chat_activity_daily': (DAY_FORMAT, False),
+    'chat_user_activity_daily': (DAY_FORMAT, True),
+}
+
+
+def create_tables(c):
+    """Создать таблицы сводок. Возвращает True, если их еще не было"""
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_activity_hourly'")
+    created = c.fetchone() is None
+    for table, (_, per_user) in ROLLUP_TABLES.items():
+        if per_user:
+            c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                        (chat_id INTEGER,
+                         period TEXT,
+                         user_id INTEGER,
+                         messages INTEGER DEFAULT 0,
+                         PRIMARY KEY (chat_id, period, user_id))''')
+            # Активные пользователи всех бесед за период
+            c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_period ON {table}(period, user_id)')
+        else:
+            c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                        (chat_id INTEGER,
+                         period TEXT,
+                         messages INTEGER DEFAULT 0,
+                         PRIMARY KEY (chat_id, period))''')
+    return created
+
+
+def record(c, history):
+    """
+    Добавить в сводки пакет строк истории (user_id, chat_id, message_type, timestamp).
+    Вызывается в той же транзакции, что и запись самой истории.
+    """
+    for table, (period_format, per_user) in ROLLUP_TABLES.items():
+        if per_user:
+            counts = Counter((chat_id, timestamp.strftime(period_format), user_id)
+                             for user_id, chat_id, _, timestamp in history)
+            c.executemany(f'''INSERT INTO {table} (chat_id, period, user_id, messages)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT(chat_id, period, user_id) DO UPDATE
+                            SET messages = messages + excluded.messages''',
+                          [key + (count,) for key, count in counts.items()])
+        else:
+            counts = Counter((chat_id, timestamp.strftime(period_format))
+                             for _, chat_id, _, timestamp in history)
+            c.executemany(f'''INSERT INTO {table} (chat_id, period, messages)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT(chat_id, period) DO UPDATE
+                            SET messages = messages + excluded.messages''',
+                          [key + (count,) for key, count in counts.items()])
+
+
+def rebuild(c):
+    """
+    Пересчитать сводки по таблице message_history. Возвращает первый
+    пересчитанный момент истории или None, если история пуста.
+
+    Сводки хранятся дольше истории: сообщения старше срока хранения уже
+    перенесены в архив или удалены. Поэтому пересчитываются только периоды
+    после периода самого старого сообщения истории (его часть могла уйти
+    в архив), более ранние сводки не меняются.
+    """
+    c.execute('SELECT MIN(timestamp) FROM message_history')
+    oldest = c.fetchone()[0]
+    if oldest is None:
+        return None
+    for table, (period_format, per_user) in ROLLUP_TABLES.items():
+        c.execute(f"DELETE FROM {table} WHERE period > strftime('{period_format}', ?)", (oldest,))
+        if per_user:
+            c.execute(f'''INSERT INTO {table} (chat_id, period, user_id, messages)
+                        SELECT chat_id, strftime('{period_format}', timestamp), user_id, COUNT(*)
+                        FROM message_history
+                        WHERE chat_id IS NOT NULL AND user_id IS NOT NULL AND timestamp IS NOT NULL
+                          AND strftime('{period_format}', timestamp) > strftime('{period_format}', ?)
+                        GROUP BY 1, 2, 3''', (oldest,))
+        else:
+            c.execute(f'''INSERT INTO {table} (chat_id, period, messages)
+                        SELECT chat_id, strftime('{period_format}', timestamp), COUNT(*)
+                        FROM message_history
+                        WHERE chat_id IS NOT NULL AND timestamp IS NOT NULL
+                          AND strftime('{period_format}', timestamp) > strftime('{period_format}', ?)
+                        GROUP BY 1, 2''', (oldest,))
+    return oldest
+
+
+def rebuild_chunk(c, position):
+    """
+    Порция пересчета сводок для фоновой миграции.
+    Первая порция запоминает последний id истории и очищает сводки: более
+    новые сообщения добавляет в сводки буфер записи, а следующие порции по
+    REBUILD_CHUNK строк истории прибавляют к сводкам сообщения до этого id.
+    Возвращает позицию следующей порции или None.
+    """
+    if position is None:
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM message_history')
+        last_id = c.fetchone()[0]
+        for table in ROLLUP_TABLES:
+            c.execute(f'DELETE FROM {table}')
+        return [0, last_id] if last_id else None
+
+    after, last_id = position
+    upper = min(after + REBUILD_CHUNK, last_id)
+    for table, (period_format, per_user) in ROLLUP_TABLES.items():
+        if per_user:
+            c.execute(f'''INSERT INTO {table} (chat_id, period, user_id, messages)
+                        SELECT chat_id, strftime('{period_format}', timestamp), user_id, COUNT(*)
+                        FROM message_history
+                        WHERE id > ? AND id <= ?
+                          AND chat_id IS NOT NULL AND user_id IS NOT NULL AND timestamp IS NOT NULL
+                        GROUP BY 1, 2, 3
+                        ON CONFLICT(chat_id, period, user_id) DO UPDATE
+                        SET messages = messages + excluded.messages''', (after, upper))
+        else:
+            c.execute(f'''INSERT INTO {table} (chat_id, period, messages)
+                        SELECT chat_id, strftime('{period_format}', timestamp), COUNT(*)
+                        FROM message_history
+                        WHERE id > ? AND id <= ? AND chat_id IS NOT NULL AND timestamp IS NOT NULL
+                        GROUP BY 1, 2
+                        ON CONFLICT(chat_id, period) DO UPDATE
+                        SET messages = messages + excluded.messages''', (after, upper))
+    return [upper, last_id] if upper < last_id else None
+
+
+def prune(c, now=None):
+    """Удалить почасовые и суточные сводки старше срока хранения. Возвращает число строк"""
+    now = now or datetime.now()
+    hour_threshold = (now - timedelta(days=ROLLUP_HOURLY_DAYS)).strftime(HOUR_FORMAT)
+    day_threshold = (now - timedelta(days=ROLLUP_DAILY_DAYS)).strftime(DAY_FORMAT)
+    removed = 0
+    for table, (period_format, _) in ROLLUP_TABLES.items():
+        threshold = hour_threshold if period_format == HOUR_FORMAT else day_threshold
+        c.execute(f'DELETE FROM {table} WHERE period < ?', (threshold,))
+        removed += c.rowcount
+    return removed
+
+
+def window_start(hours, now=None):
+    """
+    Первый период, попадающий в окно последних hours часов, и таблица для него.
+    Окно округляется до целых часов (или суток, если почасовые сводки уже удалены).
+    """
+    now = now or datetime.now()
+    start = now - timedelta(hours=hours - 1)
+    if hours <= ROLLUP_HOURLY_DAYS * 24:
+        return start.strftime(HOUR_FORMAT), 'hourly'
+    return start.strftime(DAY_FORMAT), 'daily'
+
+
+def chat_messages(chat_id, hours=24, snapshot=None):
+    """
+    Количество сообщений в беседе за последние hours часов.
+    snapshot - снимок отчета (database.read_snapshot), из которого читать сводки
+    """
+    period, granularity = window_start(hours)
+    sql = f'''SELECT COALESCE(SUM(messages), 0) FROM chat_activity_{granularity}
+             WHERE chat_id = ? AND period >= ?'''
+    if snapshot is not None:
+        return snapshot.fetch_one(sql, (chat_id, period))[0]
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute(sql, (chat_id, period))
+        return c.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def active_users(hours=24, chat_id=None):
+    """ID пользователей, писавших за последние hours часов (во всех беседах или в одной)"""
+    period, granularity = window_start(hours)
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        if chat_id is None:
+            c.execute(f'''SELECT DISTINCT user_id FROM chat_user_activity_{granularity}
+                        WHERE period >= ?''', (period,))
+        else:
+            c.execute(f'''SELECT user_id FROM chat_user_activity_{granularity}
+                        WHERE chat_id = ? AND period >= ?
+                        GROUP BY user_id''', (chat_id, period))
+        return [row[0] for row in c.fetchall()]
+    finally:
+        conn.close()
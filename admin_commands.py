@@ -1,32 +1,36 @@
 import sqlite3
+from database import get_connection, pool, storage_settings, read_snapshot
+from write_buffer import write_buffer
+from db_writer import db_writer
 from datetime import datetime, timedelta
 from vk_api.utils import get_random_id
 from utils import get_chat_stats, parse_duration, format_duration, extract_user_id
 from logger import log_moderation, log_error
+from command_registry import command, registry, COST_API, COST_HEAVY
+from vk_batch import VkBatch
+from fanout import FanOut, progress_message
+from send_scheduler import scheduler
+from user_cache import user_cache
+from chat_members import members_index
+from user_state import user_state
+from migrations import migrator
+from query_profiler import profiler
+from report_worker import report_worker
+from ledger import ledger
+from leaderboards import leaderboards
+import activity_rollups
 
 def is_admin(user_id):
     """Проверка является ли пользователь администратором"""
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result and result[0] == 'admin'
+    return user_state.role(user_id) == 'admin'
 
 def get_user_role(user_id):
     """Получить роль пользователя"""
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 'user'
+    return user_state.role(user_id)
 
+@command('skick', role='admin', cost=COST_HEAVY)
 def cmd_skick(vk, event, args):
     """Исключить пользователя из всех бесед"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя и причину"
     
@@ -42,27 +46,28 @@ def cmd_skick(vk, event, args):
         if is_admin(user_id):
             return "⚠️ Невозможно исключить администратора"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('SELECT chat_id FROM bot_chats WHERE is_active = 1')
         chats = c.fetchall()
         conn.close()
         
+        # Исключаем из всех бесед параллельно, пакетами через execute
+        fanout = FanOut(vk, progress=progress_message(vk, event.chat_id, "Исключение из бесед"))
+        kicks = fanout.run([chat_id[0] for chat_id in chats], lambda batch, chat_id:
+                           batch.messages.removeChatUser(chat_id=chat_id, user_id=user_id))
+        
         kick_count = 0
         failed_chats = []
-        for chat_id in chats:
-            try:
-                vk.messages.removeChatUser(
-                    chat_id=chat_id[0],
-                    user_id=user_id
-                )
+        for chat_id, result in kicks.items():
+            if result.ok:
                 kick_count += 1
-            except Exception as e:
-                failed_chats.append(str(chat_id[0]))
-                continue
+                members_index.remove_member(chat_id, user_id)
+            else:
+                failed_chats.append(str(chat_id))
         
-        user_info = vk.users.get(user_ids=[user_id])[0]
+        user_info = vk.users.get(user_ids=user_id)[0]
         log_moderation(event.obj.message['from_id'], 'SKICK', user_id, reason)
         
         response = f"👢 Пользователь @id{user_id} ({user_info['first_name']}) исключен из {kick_count} бесед\nПричина: {reason}"
@@ -73,6 +78,7 @@ def cmd_skick(vk, event, args):
         log_error(f"Ошибка в команде skick: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('quiet', role='admin')
 def cmd_quiet(vk, event, args):
     """Управление режимом тишины в беседе"""
     try:
@@ -83,7 +89,7 @@ def cmd_quiet(vk, event, args):
             new_mode = args[0].lower() not in ['off', '0', 'false']
             duration = int(args[1]) if len(args) > 1 else None
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         if duration:
@@ -124,11 +130,63 @@ def cmd_quiet(vk, event, args):
             except:
                 pass
 
+def plan_removals(user_ids, chat_ids):
+    """План глобального бана: пары (беседа, пользователь) по данным индекса участников"""
+    return [(chat_id, user_id)
+            for user_id in user_ids
+            for chat_id in sorted(members_index.chats_of(user_id) & set(chat_ids))]
+
+def ban_in_all_chats(vk, event, user_ids, reason, title):
+    """
+    Заблокировать пользователей во всех активных беседах.
+    Состав бесед загружается один раз, исключения выполняются параллельно,
+    записи о банах добавляются одним executemany.
+    Возвращает (беседы с баном по пользователям, неудачные исключения по пользователям,
+    беседы, которые не удалось проверить).
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    
+    # Получаем список всех активных бесед
+    c.execute('SELECT chat_id FROM bot_chats WHERE is_active = 1')
+    chat_ids = [chat_id[0] for chat_id in c.fetchall()]
+    
+    # Состав бесед берем из индекса участников, устаревшие беседы синхронизируем один раз
+    sync_errors = members_index.ensure_synced(vk, chat_ids)
+    for chat_id, error in sync_errors.items():
+        log_error(f"Ошибка при обработке чата {chat_id}: {str(error)}")
+    
+    plan = plan_removals(user_ids, [chat_id for chat_id in chat_ids if chat_id not in sync_errors])
+    fanout = FanOut(vk, progress=progress_message(vk, event.chat_id, title))
+    kicks = fanout.run(plan, lambda batch, item:
+                       batch.messages.removeChatUser(chat_id=item[0], user_id=item[1]))
+    
+    ban_time = datetime.now()
+    banned = {user_id: [] for user_id in user_ids}
+    failed = {user_id: [] for user_id in user_ids}
+    for (chat_id, user_id), result in kicks.items():
+        if not result.ok:
+            failed[user_id].append(chat_id)
+            log_error(f"Ошибка при обработке чата {chat_id}: {str(result.error)}")
+            continue
+        
+        banned[user_id].append(chat_id)
+        members_index.remove_member(chat_id, user_id)
+        # Логируем действие для каждой беседы
+        log_moderation(event.obj.message['from_id'], 'BAN', user_id, f"Беседа {chat_id}: {reason}")
+    
+    # Добавляем записи о банах в базу данных
+    c.executemany('''INSERT OR REPLACE INTO bans (user_id, chat_id, ban_time)
+                    VALUES (?, ?, ?)''', [(user_id, chat_id, ban_time)
+                                           for user_id, chats in banned.items() for chat_id in chats])
+    
+    conn.commit()
+    conn.close()
+    return banned, failed, list(sync_errors)
+
+@command('sban', role='admin', cost=COST_HEAVY)
 def cmd_sban(vk, event, args):
     """Заблокировать пользователя во всех беседах"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя и причину"
     
@@ -143,45 +201,11 @@ def cmd_sban(vk, event, args):
             return "⚠️ Невозможно заблокировать администратора"
             
         reason = ' '.join(args[1:]) if len(args) > 1 else "Не указана"
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        # Получаем список всех активных бесед
-        c.execute('SELECT chat_id FROM bot_chats WHERE is_active = 1')
-        chats = c.fetchall()
-        
-        ban_time = datetime.now()
-        banned_chats = []
-        failed_chats = []
+        banned, failed, sync_errors = ban_in_all_chats(vk, event, [user_id], reason, "Блокировка в беседах")
+        banned_chats = banned[user_id]
+        failed_chats = [str(chat_id) for chat_id in sync_errors + failed[user_id]]
         
-        for chat_id in chats:
-            chat_id = chat_id[0]
-            
-            try:
-                # Проверяем, есть ли пользователь в беседе
-                members = vk.messages.getConversationMembers(peer_id=2000000000 + chat_id)
-                member_ids = [member['member_id'] for member in members['items']]
-                
-                if user_id in member_ids:
-                    # Исключаем пользователя из беседы
-                    vk.messages.removeChatUser(chat_id=chat_id, user_id=user_id)
-                    banned_chats.append(chat_id)
-                    
-                    # Добавляем запись о бане в базу данных
-                    c.execute('''INSERT OR REPLACE INTO bans (user_id, chat_id, ban_time)
-                                VALUES (?, ?, ?)''', (user_id, chat_id, ban_time))
-                    
-                    # Логируем действие для каждой беседы
-                    log_moderation(event.obj.message['from_id'], 'BAN', user_id, f"Беседа {chat_id}: {reason}")
-            except Exception as e:
-                failed_chats.append(str(chat_id))
-                log_error(f"Ошибка при обработке чата {chat_id}: {str(e)}")
-                continue
-        
-        conn.commit()
-        conn.close()
-        
-        user_info = vk.users.get(user_ids=[user_id])[0]
+        user_info = vk.users.get(user_ids=user_id)[0]
         response = (f"🚫 Пользователь @id{user_id} ({user_info['first_name']} {user_info['last_name']}) "
                    f"заблокирован в {len(banned_chats)} беседах\n"
                    f"Причина: {reason}")
@@ -195,11 +219,9 @@ def cmd_sban(vk, event, args):
         log_error(f"Ошибка в команде sban: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('sunban', role='admin', cost=COST_API)
 def cmd_sunban(vk, event, args):
     """Разблокировать пользователя во всех беседах"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя"
     
@@ -209,7 +231,7 @@ def cmd_sunban(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Получаем список бесед, где пользователь забанен
@@ -235,11 +257,9 @@ def cmd_sunban(vk, event, args):
         log_error(f"Ошибка в команде sunban: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('addsenmoder', role='admin', cost=COST_API)
 def cmd_addsenmoder(vk, event, args):
     """Назначить пользователя старшим модератором"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя"
     
@@ -253,29 +273,12 @@ def cmd_addsenmoder(vk, event, args):
         if is_admin(user_id):
             return "⚠️ Пользователь уже является администратором"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
         # Проверяем текущую роль пользователя
-        c.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-        current_role = c.fetchone()
-        
-        if current_role and current_role[0] == 'senior_moderator':
+        if get_user_role(user_id) == 'senior_moderator':
             return "⚠️ Пользователь уже является старшим модератором"
         
-        # Назначаем пользователя старшим модератором
-        c.execute('''INSERT OR REPLACE INTO users 
-                    (user_id, role, messages_count, level, xp, balance, reputation)
-                    VALUES (?, 'senior_moderator', 
-                    COALESCE((SELECT messages_count FROM users WHERE user_id = ?), 0),
-                    COALESCE((SELECT level FROM users WHERE user_id = ?), 1),
-                    COALESCE((SELECT xp FROM users WHERE user_id = ?), 0),
-                    COALESCE((SELECT balance FROM users WHERE user_id = ?), 0),
-                    COALESCE((SELECT reputation FROM users WHERE user_id = ?), 0))''',
-                    (user_id, user_id, user_id, user_id, user_id, user_id))
-        
-        conn.commit()
-        conn.close()
+        # Назначаем пользователя старшим модератором (запись в базу и кэш ролей)
+        user_state.set_role(user_id, 'senior_moderator')
         
         log_moderation(event.obj.message['from_id'], 'ADD_SENIOR_MODERATOR', user_id)
         
@@ -293,6 +296,7 @@ def cmd_addsenmoder(vk, event, args):
         log_error(f"Ошибка в команде addsenmoder: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('bug', role='admin', cost=COST_API)
 def cmd_bug(vk, event, args):
     """Отправка отчета об ошибке"""
     if not args:
@@ -302,7 +306,7 @@ def cmd_bug(vk, event, args):
         user_id = event.obj.message['from_id']
         bug_description = ' '.join(args)
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Проверяем время последнего отправленного баг-репорта
@@ -340,7 +344,7 @@ def cmd_bug(vk, event, args):
 def notify_admins(vk, message, exclude_id=None):
     """Отправить сообщение всем администраторам"""
     try:
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Получаем список всех администраторов
@@ -348,21 +352,22 @@ def notify_admins(vk, message, exclude_id=None):
         admins = c.fetchall()
         conn.close()
         
+        # Отправляем уведомления одним пакетом, ошибки отдельных отправок игнорируются
+        batch = VkBatch(vk)
         for admin_id in admins:
             admin_id = admin_id[0]
             if admin_id != exclude_id:  # Пропускаем указанный ID
-                try:
-                    vk.messages.send(
-                        user_id=admin_id,
-                        message=message,
-                        random_id=get_random_id()
-                    )
-                except:
-                    continue
+                batch.messages.send(
+                    user_id=admin_id,
+                    message=message,
+                    random_id=get_random_id()
+                )
+        batch.execute()
         return None
     except:
         return None  # Игнорируем ошибки при отправке уведомлений
 
+@command('stats_chat', role='admin', cost=COST_HEAVY, background=True)
 def cmd_stats_chat(vk, event):
     """Статистика беседы"""
     try:
@@ -370,34 +375,24 @@ def cmd_stats_chat(vk, event):
         if not stats:
             return "❌ Не удалось получить статистику беседы"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        # Получаем настройки беседы
-        c.execute('SELECT quiet_mode, welcome_message, auto_warn, max_warnings FROM chat_settings WHERE chat_id = ?', 
-                 (event.chat_id,))
-        settings = c.fetchone() or (0, None, 0, 3)
-        
-        # Получаем количество варнов в беседе
-        c.execute('''SELECT COUNT(*) FROM warn_history 
-                    WHERE user_id IN (
-                        SELECT user_id FROM users 
-                        WHERE warnings > 0
-                    )''')
-        warns_count = c.fetchone()[0]
-        
-        # Получаем количество банов в беседе
-        c.execute('SELECT COUNT(*) FROM bans WHERE chat_id = ?', (event.chat_id,))
-        bans_count = c.fetchone()[0]
-        
-        # Получаем статистику сообщений за последние 24 часа
-        yesterday = datetime.now() - timedelta(days=1)
-        c.execute('''SELECT COUNT(*) FROM message_history 
-                    WHERE chat_id = ? AND timestamp > ?''', 
-                    (event.chat_id, yesterday))
-        messages_24h = c.fetchone()[0]
-        
-        conn.close()
+        write_buffer.flush()
+        with read_snapshot() as snapshot:
+            # Получаем настройки беседы
+            settings = snapshot.fetch_one('SELECT quiet_mode, welcome_message, auto_warn, max_warnings FROM chat_settings WHERE chat_id = ?', 
+                                          (event.chat_id,)) or (0, None, 0, 3)
+            
+            # Получаем количество варнов в беседе
+            warns_count = snapshot.fetch_one('''SELECT COUNT(*) FROM warn_history 
+                                             WHERE user_id IN (
+                                                 SELECT user_id FROM users 
+                                                 WHERE warnings > 0
+                                             )''')[0]
+            
+            # Получаем количество банов в беседе
+            bans_count = snapshot.fetch_one('SELECT COUNT(*) FROM bans WHERE chat_id = ?', (event.chat_id,))[0]
+            
+            # Статистика сообщений за последние 24 часа по почасовым сводкам
+            messages_24h = activity_rollups.chat_messages(event.chat_id, hours=24, snapshot=snapshot)
         
         message = "📊 Статистика беседы:\n\n"
         message += f"👥 Всего участников: {stats['total_members']}\n"
@@ -417,6 +412,7 @@ def cmd_stats_chat(vk, event):
         log_error(f"Ошибка в команде stats_chat: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('settings', role='admin')
 def cmd_settings(vk, event, args):
     """Управление настройками беседы"""
     if not args:
@@ -426,7 +422,7 @@ def cmd_settings(vk, event, args):
         param = args[0].lower()
         value = ' '.join(args[1:]) if len(args) > 1 else None
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         if param == 'welcome':
@@ -474,11 +470,9 @@ def cmd_settings(vk, event, args):
         log_error(f"Ошибка в команде settings: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('addadmin', role='admin', cost=COST_API)
 def cmd_addadmin(vk, event, args):
     """Назначить пользователя администратором"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя"
     
@@ -491,21 +485,8 @@ def cmd_addadmin(vk, event, args):
         if is_admin(user_id):
             return "⚠️ Пользователь уже является администратором"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        c.execute('''INSERT OR REPLACE INTO users 
-                    (user_id, role, messages_count, level, xp, balance, reputation)
-                    VALUES (?, 'admin', 
-                    COALESCE((SELECT messages_count FROM users WHERE user_id = ?), 0),
-                    COALESCE((SELECT level FROM users WHERE user_id = ?), 1),
-                    COALESCE((SELECT xp FROM users WHERE user_id = ?), 0),
-                    COALESCE((SELECT balance FROM users WHERE user_id = ?), 0),
-                    COALESCE((SELECT reputation FROM users WHERE user_id = ?), 0))''',
-                    (user_id, user_id, user_id, user_id, user_id, user_id))
-        
-        conn.commit()
-        conn.close()
+        # Запись в базу и кэш ролей: права действуют с первого же сообщения
+        user_state.set_role(user_id, 'admin')
         
         log_moderation(event.obj.message['from_id'], 'ADD_ADMIN', user_id)
         
@@ -520,11 +501,9 @@ def cmd_addadmin(vk, event, args):
         log_error(f"Ошибка в команде addadmin: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('removeadmin', role='admin', cost=COST_API)
 def cmd_removeadmin(vk, event, args):
     """Снять администратора с должности"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя"
     
@@ -538,17 +517,17 @@ def cmd_removeadmin(vk, event, args):
             return "⚠️ Пользователь не является администратором"
         
         # Проверяем количество оставшихся администраторов
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         c.execute('SELECT COUNT(*) FROM users WHERE role = "admin"')
         admin_count = c.fetchone()[0]
         
+        conn.close()
+        
         if admin_count <= 1:
             return "⚠️ Невозможно снять последнего администратора"
         
-        c.execute('''UPDATE users SET role = 'user' WHERE user_id = ?''', (user_id,))
-        conn.commit()
-        conn.close()
+        user_state.set_role(user_id, 'user')
         
         log_moderation(event.obj.message['from_id'], 'REMOVE_ADMIN', user_id)
         
@@ -563,11 +542,9 @@ def cmd_removeadmin(vk, event, args):
         log_error(f"Ошибка в команде removeadmin: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('massban', role='admin', cost=COST_HEAVY)
 def cmd_massban(vk, event, args):
     """Массовый бан пользователей"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args or len(args) < 2:
         return "⚠️ Укажите список пользователей и причину"
     
@@ -575,7 +552,7 @@ def cmd_massban(vk, event, args):
         targets = args[:-1]  # Все аргументы кроме последнего - это цели
         reason = args[-1]  # Последний аргумент - причина
         
-        banned_users = []
+        user_ids = []
         failed_users = []
         
         for target in targets:
@@ -589,33 +566,40 @@ def cmd_massban(vk, event, args):
                     failed_users.append(f"@id{user_id}")
                     continue
                 
-                # Выполняем бан пользователя
-                ban_result = cmd_sban(vk, event, [str(user_id), reason])
-                if "заблокирован" in ban_result:
-                    banned_users.append(f"@id{user_id}")
-                else:
-                    failed_users.append(f"@id{user_id}")
+                if user_id not in user_ids:
+                    user_ids.append(user_id)
             except:
                 failed_users.append(target)
         
+        # Все цели банятся одним планом: состав бесед загружается один раз на всех
+        banned_users = []
+        sync_errors = []
+        if user_ids:
+            banned, failed, sync_errors = ban_in_all_chats(vk, event, user_ids, reason, "Массовый бан")
+            for user_id in user_ids:
+                if failed[user_id]:
+                    failed_users.append(f"@id{user_id}")
+                else:
+                    banned_users.append(f"@id{user_id}")
+        
         response = f"🚫 Массовый бан завершен\nПричина: {reason}\n"
         if banned_users:
             response += f"\n✅ Успешно заблокированы:\n{', '.join(banned_users)}"
         if failed_users:
             response += f"\n❌ Не удалось заблокировать:\n{', '.join(failed_users)}"
+        if sync_errors:
+            response += f"\n⚠️ Не удалось проверить беседы: {', '.join(map(str, sync_errors))}"
         
         return response
     except Exception as e:
         log_error(f"Ошибка в команде massban: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('unbanall', role='admin')
 def cmd_unbanall(vk, event):
     """Разбанить всех пользователей в беседе"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-    
     try:
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Получаем список всех забаненных пользователей
@@ -625,28 +609,22 @@ def cmd_unbanall(vk, event):
         if not banned_users:
             return "✅ В беседе нет забаненных пользователей"
         
-        # Разбаниваем каждого пользователя
-        unbanned_count = 0
-        for user_id in banned_users:
-            user_id = user_id[0]
-            c.execute('DELETE FROM bans WHERE user_id = ? AND chat_id = ?', (user_id, event.chat_id))
-            unbanned_count += 1
-            
-            log_moderation(event.obj.message['from_id'], 'UNBAN', user_id, "Массовый разбан")
-        
+        # Разбаниваем всех одним запросом
+        c.execute('DELETE FROM bans WHERE chat_id = ?', (event.chat_id,))
         conn.commit()
         conn.close()
         
-        return f"✅ Разбанено {unbanned_count} пользователей"
+        for user_id in banned_users:
+            log_moderation(event.obj.message['from_id'], 'UNBAN', user_id[0], "Массовый разбан")
+        
+        return f"✅ Разбанено {len(banned_users)} пользователей"
     except Exception as e:
         log_error(f"Ошибка в команде unbanall: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('clearwarns', role='admin', cost=COST_API)
 def cmd_clear_warns(vk, event, args):
     """Очистить все предупреждения у пользователя"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя"
     
@@ -656,7 +634,7 @@ def cmd_clear_warns(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Получаем текущее количество предупреждений
@@ -681,11 +659,9 @@ def cmd_clear_warns(vk, event, args):
         log_error(f"Ошибка в команде clear_warns: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('resetstats', role='admin', cost=COST_API)
 def cmd_reset_stats(vk, event, args):
     """Сбросить статистику пользователя"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Укажите пользователя"
     
@@ -695,7 +671,7 @@ def cmd_reset_stats(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Сохраняем роль пользователя
@@ -709,9 +685,12 @@ def cmd_reset_stats(vk, event, args):
                         balance = 0,
                         reputation = 0
                     WHERE user_id = ?''', (user_id,))
+        c.execute('DELETE FROM chat_message_counts WHERE user_id = ?', (user_id,))
         
         conn.commit()
         conn.close()
+        user_state.invalidate(user_id)
+        leaderboards.reset([user_id])
         
         log_moderation(event.obj.message['from_id'], 'RESET_STATS', user_id)
         
@@ -721,13 +700,12 @@ def cmd_reset_stats(vk, event, args):
         log_error(f"Ошибка в команде reset_stats: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('adminlist', role='admin', cost=COST_API)
 def cmd_admin_list(vk, event):
     """Показать список всех администраторов"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-    
     try:
-        conn = sqlite3.connect('bot.db')
+        write_buffer.flush()
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''SELECT user_id, 
@@ -763,11 +741,9 @@ def cmd_admin_list(vk, event):
         log_error(f"Ошибка в команде admin_list: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('givemoney', role='admin', cost=COST_API)
 def cmd_givemoney(vk, event, args):
     """Выдать монеты пользователю (только для администраторов)"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args or len(args) < 2:
         return "⚠️ Использование: /givemoney [пользователь] [количество]"
     
@@ -784,24 +760,13 @@ def cmd_givemoney(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем существование пользователя и получаем текущий баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        
-        if result is None:
-            # Создаем запись для нового пользователя
-            c.execute('''INSERT INTO users (user_id, balance, level, xp)
-                        VALUES (?, ?, 1, 0)''', (user_id, amount))
-            new_balance = amount
-        else:
-            # Обновляем существующий баланс
-            current_balance = result[0]
-            new_balance = current_balance + amount
-            c.execute('UPDATE users SET balance = ? WHERE user_id = ?', 
-                     (new_balance, user_id))
+        # Создаем запись для нового пользователя и зачисляем монеты
+        c.execute('''INSERT OR IGNORE INTO users (user_id, balance, level, xp)
+                    VALUES (?, 0, 1, 0)''', (user_id,))
+        new_balance = ledger.credit(c, user_id, amount, 'givemoney')
         
         conn.commit()
         conn.close()
@@ -812,4 +777,156 @@ def cmd_givemoney(vk, event, args):
         return f"💰 Пользователю @id{user_id} ({user_info['first_name']}) выдано {amount} монет\n💳 Новый баланс: {new_balance}"
     except Exception as e:
         log_error(f"Ошибка в команде givemoney: {str(e)}", exc_info=True)
-        return f"❌ Ошибка: {str(e)}" 
\ No newline at end of file
+        return f"❌ Ошибка: {str(e)}" 
+
+def perf_send_report(args):
+    """Отчет планировщика исходящих запросов"""
+    message = f"📤 Исходящие запросы VK (в очереди: {scheduler.depth()}):\n"
+    for lane, stats in scheduler.metrics().items():
+        message += (f"• {lane}: выполнено {stats['completed']}, ошибок {stats['failed']}, "
+                    f"повторов {stats['retries']}, в очереди {stats['queued']}, "
+                    f"ожидание ср. {stats['avg_wait'] * 1000:.0f} мс / макс. {stats['max_wait'] * 1000:.0f} мс\n")
+    return message
+
+def perf_commands_report(args):
+    """Отчет о времени выполнения команд"""
+    with registry.lock:
+        stats = sorted(registry.stats.items(), key=lambda item: -item[1]['total_time'])[:15]
+    
+    if not stats:
+        return "⏱ Команды еще не выполнялись"
+    
+    message = "⏱ Команды по суммарному времени:\n"
+    for name, command_stats in stats:
+        average = command_stats['total_time'] / command_stats['calls'] * 1000
+        message += (f"• /{name}: {command_stats['calls']} вызовов, ср. {average:.0f} мс, "
+                    f"макс. {command_stats['max_time'] * 1000:.0f} мс, ошибок {command_stats['errors']}\n")
+    
+    reports = report_worker.metrics()
+    message += (f"\n📑 Пул отчетов ({reports['workers']} потоков): в очереди {reports['pending']}, "
+                f"готово {reports['completed']}, отклонено {reports['rejected']}, ошибок {reports['errors']}")
+    return message
+
+def perf_users_report(args):
+    """Отчет кэша профилей users.get"""
+    stats = user_cache.metrics()
+    return (f"👤 Кэш профилей: {stats['size']} записей\n"
+            f"• Попаданий: {stats['hits']}, промахов: {stats['misses']} "
+            f"({stats['hit_rate'] * 100:.1f}% попаданий)\n"
+            f"• Запросов users.get: {stats['api_calls']}")
+
+def perf_members_report(args):
+    """Отчет индекса участников бесед"""
+    stats = members_index.metrics()
+    return (f"👥 Индекс участников: {stats['chats']} бесед, {stats['members']} участников\n"
+            f"• Устаревших бесед: {stats['stale']}\n"
+            f"• Ответов из индекса: {stats['hits']}\n"
+            f"• Полных синхронизаций: {stats['resyncs']} (ошибок: {stats['resync_errors']})\n"
+            f"• Изменений по событиям: {stats['events']}")
+
+def perf_db_report(args):
+    """Отчет профиля хранения SQLite и пула соединений"""
+    settings = storage_settings()
+    stats = pool.metrics()
+    message = f"🗄 База данных: {stats['path']}\n"
+    for name, value in settings.items():
+        message += f"• {name}: {value}\n"
+    message += (f"\n🔌 Пул соединений: открыто {stats['opened']}, выдано {stats['checkouts']}\n"
+                f"• Отмененных незавершенных транзакций: {stats['abandoned']}")
+    schema = migrator.metrics()
+    message += f"\n\n🧱 Схема: версия {schema['version']} из {schema['latest']}"
+    if schema['running']:
+        message += " (выполняются фоновые миграции)"
+    if schema['error']:
+        message += f"\n• Ошибка миграции: {schema['error']}"
+    return message
+
+def perf_writes_report(args):
+    """Отчет буфера отложенной записи"""
+    stats = write_buffer.metrics()
+    return (f"✍️ Отложенная запись: в буфере {stats['pending']} строк\n"
+            f"• Сбросов: {stats['flushes']}, записано строк: {stats['rows']}\n"
+            f"• Строк за сброс: в среднем {stats['avg_batch']:.1f}, максимум {stats['max_batch']}\n"
+            f"• Время сброса: {stats['avg_flush_ms']:.2f} мс в среднем\n"
+            f"• Пропущено повторов: {stats['duplicates']}, ошибок записи: {stats['errors']}\n"
+            + perf_writer_report())
+
+def perf_writer_report():
+    """Отчет потока записи в базу"""
+    stats = db_writer.metrics()
+    if not stats['running']:
+        return "\n🖋 Поток записи не запущен, записи выполняются в потоках обработчиков"
+    return (f"\n🖋 Поток записи: в очереди {stats['queued']}\n"
+            f"• Транзакций: {stats['transactions']}, записей: {stats['writes']} "
+            f"(в среднем {stats['avg_batch']:.1f}, максимум {stats['max_batch']} в транзакции)\n"
+            f"• Ожидание в очереди: {stats['avg_wait_ms']:.2f} мс в среднем, {stats['max_wait_ms']:.0f} мс максимум\n"
+            f"• Транзакция: {stats['avg_transaction_ms']:.2f} мс в среднем, ошибок записей: {stats['failed']}")
+
+def perf_state_report(args):
+    """Отчет кэша состояния пользователей"""
+    stats = user_state.metrics()
+    balance = ledger.metrics()
+    tops = leaderboards.metrics()
+    return (f"🧠 Состояние пользователей в памяти: {stats['size']}/{stats['max_size']}\n"
+            f"• Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate'] * 100:.1f}%)\n"
+            f"• Записей через кэш: {stats['writes']}, сбросов: {stats['invalidations']}\n"
+            f"• Журнал баланса: списаний {balance['debits']}, зачислений {balance['credits']}, "
+            f"отказов (не хватило монет) {balance['declined']}\n"
+            f"• Топы: {tops['users']} пользователей, загрузок {tops['loads']} "
+            f"(последняя {tops['load_ms']:.0f} мс), обновлений {tops['updates']}, чтений {tops['reads']}")
+
+def perf_queries_report(args):
+    """Самые затратные запросы к базе: /perf queries [N] [reset]"""
+    if args and args[0] == 'reset':
+        profiler.reset()
+        return "✅ Статистика запросов сброшена"
+    try:
+        limit = max(1, min(int(args[0]), 30)) if args else 10
+    except ValueError:
+        return "⚠️ Использование: /perf queries [количество] или /perf queries reset"
+
+    stats = profiler.metrics()
+    if not stats['enabled']:
+        return "⚠️ Профилировщик запросов выключен (QUERY_PROFILER=0)"
+    top = profiler.top(limit)
+    if not top:
+        return "🐢 Запросы к базе еще не выполнялись"
+
+    message = (f"🐢 Запросы к базе: {stats['calls']} вызовов, {stats['queries']} различных, "
+               f"{stats['total_time']:.2f} с всего\n"
+               f"• Медленных (от {stats['slow_ms']:.0f} мс): {stats['slow_queries']}\n")
+    for index, query in enumerate(top, 1):
+        sql = query['sql'] if len(query['sql']) <= 150 else query['sql'][:150] + '...'
+        tags = ", ".join(f"{tag} ({count})" for tag, count in query['tags'][:3])
+        message += (f"\n{index}. {sql}\n"
+                    f"   {query['count']} раз, всего {query['total_time'] * 1000:.0f} мс, "
+                    f"ср. {query['avg_time'] * 1000:.2f} мс, p95 {query['p95_time'] * 1000:.2f} мс, "
+                    f"макс. {query['max_time'] * 1000:.0f} мс\n"
+                    f"   Откуда: {tags}\n")
+    return message
+
+# Разделы отчета /perf
+PERF_REPORTS = {
+    'send': perf_send_report,
+    'commands': perf_commands_report,
+    'users': perf_users_report,
+    'members': perf_members_report,
+    'db': perf_db_report,
+    'writes': perf_writes_report,
+    'state': perf_state_report,
+    'queries': perf_queries_report
+}
+
+@command('perf', role='admin')
+def cmd_perf(vk, event, args):
+    """Показатели производительности бота"""
+    section = args[0] if args else 'send'
+    report = PERF_REPORTS.get(section)
+    if not report:
+        return f"⚠️ Использование: /perf [{'/'.join(PERF_REPORTS)}]"
+    
+    try:
+        return report(args[1:])
+    except Exception as e:
+        log_error(f"Ошибка в команде perf: {str(e)}", exc_info=True)
+        return f"❌ Ошибка: {str(e)}"
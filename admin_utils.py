@@ -1,32 +1,25 @@
-import sqlite3
+from database import get_connection, read_snapshot
+from write_buffer import write_buffer
 from datetime import datetime
 import json
 import os
 from logger import log_error, log_moderation
 import re
 from vk_api.utils import get_random_id
+from command_registry import command, COST_API, COST_HEAVY
+from utils import extract_user_id
+from history_archive import archived_months, archive_path, user_history_by_month, MAX_ATTACHED_MONTHS
 
-def is_admin(user_id):
-    """Проверка является ли пользователь администратором"""
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result and result[0] == 'admin'
-
+@command('filter', role='admin')
 def cmd_filter(vk, event, args):
     """Управление фильтрами слов"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return "⚠️ Использование:\n/filter add [слово] — добавить слово\n/filter remove [слово] — удалить слово\n/filter list — список слов"
     
     action = args[0].lower()
     
     try:
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Создаем таблицу, если её нет
@@ -78,11 +71,9 @@ def cmd_filter(vk, event, args):
         if conn:
             conn.close()
 
+@command('pin', role='admin', cost=COST_API)
 def cmd_pin(vk, event, args):
     """Закрепление сообщения"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     try:
         # Если сообщение является ответом на другое сообщение
         if 'reply_message' in event.obj.message:
@@ -102,24 +93,20 @@ def cmd_pin(vk, event, args):
         log_error(f"Ошибка в команде pin: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
 
+@command('export', role='admin', cost=COST_HEAVY, cooldown=30, background=True)
 def cmd_export(vk, event, args):
     """Экспорт данных беседы"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     try:
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        # Получаем статистику беседы
-        c.execute('''SELECT users.user_id, users.messages_count, users.level, 
-                           users.balance, users.reputation, users.warnings
-                    FROM users
-                    JOIN message_history ON users.user_id = message_history.user_id
-                    WHERE message_history.chat_id = ?
-                    GROUP BY users.user_id''', (event.chat_id,))
+        write_buffer.flush()
         
-        users_data = c.fetchall()
+        # Получаем статистику беседы из снимка базы (не больше REPORT_MAX_ROWS строк)
+        with read_snapshot() as snapshot:
+            users_data = snapshot.fetch('''SELECT users.user_id, users.messages_count, users.level, 
+                                               users.balance, users.reputation, users.warnings
+                                        FROM chat_message_counts
+                                        JOIN users ON users.user_id = chat_message_counts.user_id
+                                        WHERE chat_message_counts.chat_id = ?''', (event.chat_id,))
+            truncated = snapshot.truncated
         
         if not users_data:
             return "❌ Нет данных для экспорта"
@@ -133,6 +120,7 @@ def cmd_export(vk, event, args):
         export_data = {
             'chat_id': event.chat_id,
             'export_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'truncated': truncated,
             'users': []
         }
         
@@ -155,20 +143,57 @@ def cmd_export(vk, event, args):
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(export_data, f, ensure_ascii=False, indent=2)
             
-        return f"📊 Данные экспортированы в файл: {filename}"
+        message = f"📊 Данные экспортированы в файл: {filename}"
+        if truncated:
+            message += f"\n⚠️ Выгружены только первые {len(users_data)} пользователей"
+        return message
         
     except Exception as e:
         log_error(f"Ошибка в команде export: {str(e)}", exc_info=True)
         return f"❌ Ошибка: {str(e)}"
-    finally:
-        if conn:
-            conn.close()
 
+@command('history', role='admin', cost=COST_HEAVY, cooldown=10)
+def cmd_history(vk, event, args):
+    """Сообщения пользователя по месяцам и беседам с учетом архива истории"""
+    if not args:
+        months = archived_months()
+        if not months:
+            return "📦 Архив истории сообщений пуст\nИспользование: /history [ID] [месяцев]"
+        message = "📦 Архив истории сообщений:\n"
+        for month in months:
+            message += f"• {month}: {os.path.getsize(archive_path(month)) / 1024:.0f} КБ\n"
+        return message + "\nИспользование: /history [ID] [месяцев]"
+    
+    try:
+        user_id = extract_user_id(vk, args[0])
+        if not user_id:
+            return "❌ Не удалось определить пользователя"
+        
+        # Архивы подключаются через ATTACH, а их число ограничено
+        max_months = MAX_ATTACHED_MONTHS + 1
+        try:
+            months = int(args[1]) if len(args) > 1 else 6
+        except ValueError:
+            return f"⚠️ Укажите количество месяцев от 1 до {max_months}"
+        if months < 1 or months > max_months:
+            return f"⚠️ Укажите количество месяцев от 1 до {max_months}"
+        
+        write_buffer.flush()
+        rows = user_history_by_month(user_id, months)
+        if not rows:
+            return f"📜 У пользователя @id{user_id} нет сообщений за {months} мес."
+        
+        message = f"📜 Сообщения @id{user_id} за {months} мес. (с учетом архива):\n"
+        for month, chat_id, count in rows:
+            message += f"• {month}, беседа {chat_id}: {count}\n"
+        return message
+    except Exception as e:
+        log_error(f"Ошибка в команде history: {str(e)}", exc_info=True)
+        return f"❌ Ошибка: {str(e)}"
+
+@command('welcome', role='admin')
 def cmd_welcome(vk, event, args):
     """Управление приветственным сообщением"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return ("⚠️ Использование:\n"
                 "/welcome set [текст] — установить приветствие\n"
@@ -182,7 +207,7 @@ def cmd_welcome(vk, event, args):
     action = args[0].lower()
     
     try:
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         if action == "set":
@@ -230,11 +255,9 @@ def cmd_welcome(vk, event, args):
         if conn:
             conn.close()
 
+@command('backup', role='admin', cost=COST_HEAVY)
 def cmd_backup(vk, event, args):
     """Управление резервными копиями беседы"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return ("⚠️ Использование:\n"
                 "/backup create — создать резервную копию\n"
@@ -250,7 +273,7 @@ def cmd_backup(vk, event, args):
             os.makedirs(backup_dir)
             
         if action == "create":
-            conn = sqlite3.connect('bot.db')
+            conn = get_connection()
             c = conn.cursor()
             
             # Получаем настройки и данные беседы
@@ -306,7 +329,7 @@ def cmd_backup(vk, event, args):
                 with open(backup_file, 'r', encoding='utf-8') as f:
                     backup_data = json.load(f)
                 
-                conn = sqlite3.connect('bot.db')
+                conn = get_connection()
                 c = conn.cursor()
                 
                 # Восстанавливаем настройки
@@ -337,11 +360,9 @@ def cmd_backup(vk, event, args):
         if 'conn' in locals():
             conn.close()
 
+@command('automod', role='admin')
 def cmd_automod(vk, event, args):
     """Управление автомодерацией"""
-    if not is_admin(event.obj.message['from_id']):
-        return "⚠️ У вас нет прав администратора"
-        
     if not args:
         return ("⚠️ Использование:\n"
                 "/automod status — текущие настройки\n"
@@ -354,7 +375,7 @@ def cmd_automod(vk, event, args):
     action = args[0].lower()
     
     try:
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Создаем таблицу настроек автомодерации, если её нет
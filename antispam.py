@@ -2,7 +2,8 @@ import time
 from collections import defaultdict
 from datetime import datetime, timedelta
 from logger import log_error, log_moderation
-import sqlite3
+from database import get_connection
+from user_state import user_state
 import re
 
 class AntiSpam:
@@ -11,10 +12,6 @@ class AntiSpam:
         self.user_messages = defaultdict(list)
         # Словарь для хранения предупреждений пользователей
         self.user_warnings = defaultdict(int)
-        # Кэш ролей пользователей
-        self.role_cache = {}
-        # Время жизни кэша (в секундах)
-        self.cache_lifetime = 300  # 5 минут
         # Настройки антиспама
         self.settings = {
             'message_interval': 1.0,  # Минимальный интервал между сообщениями (в секундах)
@@ -33,30 +30,8 @@ class AntiSpam:
         self.invite_link_pattern = re.compile(r'vk\.com/join|vk\.me/join|vk\.cc/')
 
     def get_user_role(self, user_id):
-        """Получает роль пользователя из базы данных с использованием кэша"""
-        current_time = time.time()
-        
-        # Проверяем кэш
-        if user_id in self.role_cache:
-            cached_role, cache_time = self.role_cache[user_id]
-            if current_time - cache_time < self.cache_lifetime:
-                return cached_role
-        
-        try:
-            conn = sqlite3.connect('bot.db')
-            c = conn.cursor()
-            c.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-            result = c.fetchone()
-            role = result[0] if result else 'user'
-            
-            # Обновляем кэш
-            self.role_cache[user_id] = (role, current_time)
-            
-            conn.close()
-            return role
-        except Exception as e:
-            log_error(f"Ошибка при получении роли пользователя: {str(e)}")
-            return 'user'
+        """Получает роль пользователя из общего кэша состояния пользователей"""
+        return user_state.role(user_id)
 
     def clean_old_messages(self, user_id):
         """Очищает старые сообщения пользователя"""
@@ -149,7 +124,7 @@ class AntiSpam:
         warning_count = self.user_warnings[user_id]
 
         try:
-            conn = sqlite3.connect('bot.db')
+            conn = get_connection()
             c = conn.cursor()
             
             # Логируем предупреждение
@@ -192,15 +167,6 @@ class AntiSpam:
         """Сбрасывает предупреждения пользователя"""
         if user_id in self.user_warnings:
             del self.user_warnings[user_id]
-        
-    def clear_cache(self):
-        """Очищает устаревшие данные из кэша ролей"""
-        current_time = time.time()
-        self.role_cache = {
-            user_id: (role, cache_time)
-            for user_id, (role, cache_time) in self.role_cache.items()
-            if current_time - cache_time < self.cache_lifetime
-        }
 
     def update_settings(self, new_settings):
         """Обновляет настройки антиспама"""
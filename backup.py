@@ -4,6 +4,22 @@ import sqlite3
 from datetime import datetime
 import zipfile
 from logger import log_error
+from database import DATABASE_PATH, DATABASE_TIMEOUT
+from user_state import user_state
+from leaderboards import leaderboards
+
+def copy_database(source, target):
+    """
+    Копирует базу через backup API SQLite. В отличие от копирования файла
+    учитывает изменения, которые еще лежат в журнале WAL, и не мешает записи
+    """
+    source_conn = sqlite3.connect(source, timeout=DATABASE_TIMEOUT)
+    target_conn = sqlite3.connect(target, timeout=DATABASE_TIMEOUT)
+    try:
+        source_conn.backup(target_conn)
+    finally:
+        target_conn.close()
+        source_conn.close()
 
 def create_backup():
     """
@@ -21,7 +37,7 @@ def create_backup():
         backup_path = os.path.join(backup_dir, backup_filename)
 
         # Создаем копию базы данных
-        shutil.copy2('bot.db', backup_path)
+        copy_database(DATABASE_PATH, backup_path)
 
         # Создаем ZIP архив
         zip_filename = f'bot_backup_{current_time}.zip'
@@ -80,10 +96,13 @@ def restore_backup(backup_file):
         # Создаем бэкап текущей базы данных перед восстановлением
         current_time = datetime.now().strftime('%Y%m%d_%H%M%S')
         pre_restore_backup = f'pre_restore_backup_{current_time}.db'
-        shutil.copy2('bot.db', pre_restore_backup)
+        copy_database(DATABASE_PATH, pre_restore_backup)
 
         # Восстанавливаем базу данных
-        shutil.copy2(os.path.join(temp_dir, db_file), 'bot.db')
+        copy_database(os.path.join(temp_dir, db_file), DATABASE_PATH)
+        # Состояние пользователей и топы перечитываются из восстановленной базы
+        user_state.invalidate()
+        leaderboards.invalidate()
 
         # Очищаем временные файлы
         shutil.rmtree(temp_dir)
@@ -93,7 +112,9 @@ def restore_backup(backup_file):
         log_error(f"Ошибка при восстановлении из бэкапа: {str(e)}", exc_info=True)
         # Восстанавливаем оригинальную базу данных в случае ошибки
         if os.path.exists(pre_restore_backup):
-            shutil.copy2(pre_restore_backup, 'bot.db')
+            copy_database(pre_restore_backup, DATABASE_PATH)
+            user_state.invalidate()
+            leaderboards.invalidate()
         return False
     finally:
         # Удаляем временный бэкап
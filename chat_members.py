@@ -0,0 +1,324 @@
+import os
+import time
+from database import get_connection
+import logging
+import threading
+from collections import defaultdict
+from logger import log_error
+from fanout import FanOut
+from user_cache import user_cache
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+CHAT_PEER_OFFSET = 2000000000
+
+# Действия в беседе, меняющие состав участников
+INVITE_ACTIONS = {'chat_invite_user', 'chat_invite_user_by_link'}
+KICK_ACTIONS = {'chat_kick_user'}
+
+
+class MembersIndex:
+    """
+    Локальный индекс участников бесед.
+
+    Состав беседы хранится в таблице chat_members и в памяти. После полной
+    синхронизации (messages.getConversationMembers) индекс поддерживается
+    событиями chat_invite_user/chat_kick_user, а полная синхронизация
+    повторяется, когда данные беседы старше resync_interval.
+    Онлайн-статус не хранится: его дает свежий ответ getConversationMembers,
+    который переиспользуется в течение online_ttl.
+    """
+
+    def __init__(self, resync_interval=21600, online_ttl=60):
+        self.resync_interval = resync_interval
+        self.online_ttl = online_ttl
+        # chat_id -> {user_id: {'first_name', 'last_name', 'is_admin'}}
+        self.chats = {}
+        # user_id -> множество chat_id
+        self.user_chats = defaultdict(set)
+        # chat_id -> время последней полной синхронизации (time.time())
+        self.synced = {}
+        # chat_id -> (время получения, множество ID онлайн)
+        self.online = {}
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.thread = None
+        self.hits = 0
+        self.resyncs = 0
+        self.resync_errors = 0
+        self.events = 0
+
+    # Хранение
+
+    def _ensure_loaded(self):
+        """Загрузить индекс из базы при первом обращении"""
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                conn = get_connection()
+                c = conn.cursor()
+                c.execute('SELECT chat_id, synced_at FROM chat_members_sync')
+                self.synced = dict(c.fetchall())
+                c.execute('SELECT chat_id, user_id, first_name, last_name, is_admin FROM chat_members')
+                for chat_id, user_id, first_name, last_name, is_admin in c.fetchall():
+                    self.chats.setdefault(chat_id, {})[user_id] = {
+                        'first_name': first_name,
+                        'last_name': last_name,
+                        'is_admin': bool(is_admin)
+                    }
+                    self.user_chats[user_id].add(chat_id)
+                conn.close()
+                logger.info(f"Индекс участников загружен: {len(self.chats)} бесед")
+            except Exception as e:
+                log_error(f"Ошибка при загрузке индекса участников: {str(e)}")
+            self.loaded = True
+
+    def _save_chat(self, chat_id, members, synced_at):
+        try:
+            conn = get_connection()
+            c = conn.cursor()
+            c.execute('DELETE FROM chat_members WHERE chat_id = ?', (chat_id,))
+            c.executemany('''INSERT INTO chat_members (chat_id, user_id, first_name, last_name, is_admin)
+                            VALUES (?, ?, ?, ?, ?)''',
+                          [(chat_id, user_id, info['first_name'], info['last_name'], int(info['is_admin']))
+                           for user_id, info in members.items()])
+            c.execute('INSERT OR REPLACE INTO chat_members_sync (chat_id, synced_at) VALUES (?, ?)',
+                      (chat_id, synced_at))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            log_error(f"Ошибка при сохранении участников беседы {chat_id}: {str(e)}")
+
+    # Синхронизация
+
+    def is_stale(self, chat_id):
+        """Нужна ли беседе полная синхронизация"""
+        self._ensure_loaded()
+        synced_at = self.synced.get(chat_id)
+        return synced_at is None or time.time() - synced_at > self.resync_interval
+
+    def apply_members(self, chat_id, response):
+        """Заменить состав беседы ответом messages.getConversationMembers"""
+        self._ensure_loaded()
+        profiles = {profile['id']: profile for profile in response.get('profiles', [])}
+        members = {}
+        online = set()
+        for item in response.get('items', []):
+            user_id = item['member_id']
+            if user_id <= 0:
+                continue  # Сообщества в беседе не учитываем
+            profile = profiles.get(user_id, {})
+            members[user_id] = {
+                'first_name': profile.get('first_name'),
+                'last_name': profile.get('last_name'),
+                'is_admin': bool(item.get('is_admin', False))
+            }
+            if profile.get('online', 0) == 1:
+                online.add(user_id)
+
+        synced_at = time.time()
+        with self.lock:
+            for user_id in self.chats.get(chat_id, {}):
+                self.user_chats[user_id].discard(chat_id)
+            self.chats[chat_id] = members
+            for user_id in members:
+                self.user_chats[user_id].add(chat_id)
+            self.synced[chat_id] = synced_at
+            self.online[chat_id] = (time.monotonic(), online)
+            self.resyncs += 1
+
+        # Профили из ответа сразу попадают в общий кэш users.get
+        user_cache.store(list(profiles.values()))
+        self._save_chat(chat_id, members, synced_at)
+        return members
+
+    def resync(self, vk, chat_id):
+        """Полная синхронизация одной беседы"""
+        try:
+            response = vk.messages.getConversationMembers(peer_id=CHAT_PEER_OFFSET + chat_id)
+        except Exception:
+            with self.lock:
+                self.resync_errors += 1
+            raise
+        return self.apply_members(chat_id, response)
+
+    def ensure_synced(self, vk, chat_ids):
+        """
+        Синхронизировать беседы без актуальных данных (параллельно, пакетами через execute).
+        Возвращает {chat_id: ошибка} для бесед, которые не удалось синхронизировать.
+        """
+        stale = [chat_id for chat_id in chat_ids if self.is_stale(chat_id)]
+        if not stale:
+            return {}
+
+        results = FanOut(vk).run(stale, lambda batch, chat_id:
+                                 batch.messages.getConversationMembers(peer_id=CHAT_PEER_OFFSET + chat_id))
+
+        failed = {}
+        for chat_id, result in results.items():
+            if result.ok:
+                self.apply_members(chat_id, result.result)
+            else:
+                failed[chat_id] = result.error
+        if failed:
+            with self.lock:
+                self.resync_errors += len(failed)
+        return failed
+
+    def resync_stale(self, vk, limit=25):
+        """Синхронизировать устаревшие активные беседы (не больше limit за раз)"""
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute('SELECT chat_id FROM bot_chats WHERE is_active = 1')
+        chat_ids = [row[0] for row in c.fetchall()]
+        conn.close()
+
+        stale = [chat_id for chat_id in chat_ids if self.is_stale(chat_id)][:limit]
+        failed = self.ensure_synced(vk, stale)
+        for chat_id, error in failed.items():
+            log_error(f"Не удалось синхронизировать участников беседы {chat_id}: {str(error)}")
+        return len(stale) - len(failed)
+
+    def start(self, vk, interval=600):
+        """Запустить фоновую синхронизацию устаревших бесед"""
+        def loop():
+            while True:
+                try:
+                    synced = self.resync_stale(vk)
+                    if synced:
+                        logger.info(f"Синхронизирован состав {synced} бесед")
+                except Exception as e:
+                    log_error(f"Ошибка фоновой синхронизации участников: {str(e)}")
+                time.sleep(interval)
+
+        self.thread = threading.Thread(target=loop, name='members-resync', daemon=True)
+        self.thread.start()
+
+    # Изменения по событиям
+
+    def add_member(self, chat_id, user_id):
+        if user_id <= 0:
+            return
+        self._ensure_loaded()
+        with self.lock:
+            self.events += 1
+            members = self.chats.setdefault(chat_id, {})
+            if user_id in members:
+                return
+            members[user_id] = {'first_name': None, 'last_name': None, 'is_admin': False}
+            self.user_chats[user_id].add(chat_id)
+        try:
+            conn = get_connection()
+            conn.execute('''INSERT OR IGNORE INTO chat_members (chat_id, user_id, is_admin)
+                           VALUES (?, ?, 0)''', (chat_id, user_id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            log_error(f"Ошибка при добавлении участника {user_id} в индекс беседы {chat_id}: {str(e)}")
+
+    def remove_member(self, chat_id, user_id):
+        self._ensure_loaded()
+        with self.lock:
+            self.events += 1
+            self.chats.get(chat_id, {}).pop(user_id, None)
+            self.user_chats[user_id].discard(chat_id)
+            if not self.user_chats[user_id]:
+                del self.user_chats[user_id]
+        try:
+            conn = get_connection()
+            conn.execute('DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            log_error(f"Ошибка при удалении участника {user_id} из индекса беседы {chat_id}: {str(e)}")
+
+    def apply_action(self, chat_id, message):
+        """Обновить индекс по служебному сообщению беседы (приглашение, выход, исключение)"""
+        action = message.get('action') or {}
+        action_type = action.get('type')
+        if action_type in INVITE_ACTIONS:
+            # При входе по ссылке member_id может отсутствовать - вошел сам отправитель
+            self.add_member(chat_id, action.get('member_id') or message['from_id'])
+        elif action_type in KICK_ACTIONS:
+            self.remove_member(chat_id, action.get('member_id') or message['from_id'])
+
+    # Запросы
+
+    def members(self, vk, chat_id):
+        """
+        Участники беседы: список словарей с id, first_name, last_name, is_admin.
+        Обращается к VK только если данные беседы устарели.
+        """
+        if self.is_stale(chat_id):
+            self.resync(vk, chat_id)
+        else:
+            with self.lock:
+                self.hits += 1
+
+        with self.lock:
+            members = dict(self.chats.get(chat_id, {}))
+
+        # Имена участников, добавленных по событиям, берем из кэша профилей
+        unnamed = [user_id for user_id, info in members.items() if not info['first_name']]
+        if unnamed:
+            names = {user['id']: user for user in vk.users.get(user_ids=','.join(map(str, unnamed)))}
+            with self.lock:
+                for user_id in unnamed:
+                    user = names.get(user_id)
+                    if user and user_id in self.chats.get(chat_id, {}):
+                        info = dict(members[user_id], first_name=user['first_name'], last_name=user['last_name'])
+                        self.chats[chat_id][user_id] = info
+                        members[user_id] = info
+
+        return [dict(info, id=user_id) for user_id, info in members.items()]
+
+    def online_members(self, vk, chat_id):
+        """Участники беседы и множество ID тех, кто сейчас онлайн"""
+        with self.lock:
+            cached = self.online.get(chat_id)
+        if not cached or time.monotonic() - cached[0] > self.online_ttl:
+            # Онлайн-статус есть только в свежем ответе VK - заодно обновляем состав
+            self.resync(vk, chat_id)
+        with self.lock:
+            online = set(self.online[chat_id][1])
+        return self.members(vk, chat_id), online
+
+    def is_member(self, vk, chat_id, user_id):
+        """Состоит ли пользователь в беседе"""
+        if self.is_stale(chat_id):
+            self.resync(vk, chat_id)
+        with self.lock:
+            self.hits += 1
+            return user_id in self.chats.get(chat_id, {})
+
+    def chats_of(self, user_id):
+        """Беседы, в которых состоит пользователь, по данным индекса"""
+        self._ensure_loaded()
+        with self.lock:
+            return set(self.user_chats.get(user_id, ()))
+
+    def metrics(self):
+        self._ensure_loaded()
+        now = time.time()
+        with self.lock:
+            return {
+                'chats': len(self.chats),
+                'members': sum(len(members) for members in self.chats.values()),
+                'stale': sum(1 for chat_id in self.chats
+                             if now - self.synced.get(chat_id, 0) > self.resync_interval),
+                'hits': self.hits,
+                'resyncs': self.resyncs,
+                'resync_errors': self.resync_errors,
+                'events': self.events
+            }
+
+
+# Создаем глобальный индекс участников бесед
+members_index = MembersIndex(
+    resync_interval=int(os.getenv('MEMBERS_RESYNC_INTERVAL', '21600')),
+    online_ttl=int(os.getenv('MEMBERS_ONLINE_TTL', '60'))
+)
@@ -1,54 +1,66 @@
-import sqlite3
+from database import get_connection
+from db_writer import db_writer
+from write_buffer import write_buffer
+from user_state import user_state
+from leaderboards import leaderboards
+from ledger import ledger
+import activity_rollups
+from history_archive import cleanup_history
 from datetime import datetime, timedelta
 from logger import log_error
 
+def expire_restrictions(c, current_time):
+    """
+    Снимает истекшие муты и режимы тишины
+    """
+    c.execute('''UPDATE users 
+                SET is_muted = 0, mute_end = NULL 
+                WHERE is_muted = 1 
+                AND mute_end < ?''', (current_time,))
+
+    c.execute('''UPDATE chat_settings 
+                SET quiet_mode = 0, quiet_end = NULL 
+                WHERE quiet_mode = 1 
+                AND quiet_end < ?''', (current_time,))
+
+def delete_old_records(c, current_time):
+    """
+    Удаляет устаревшие записи (выполняется в потоке записи)
+    """
+    # Очистка истории предупреждений старше 30 дней
+    thirty_days_ago = current_time - timedelta(days=30)
+    c.execute('DELETE FROM warn_history WHERE timestamp < ?', (thirty_days_ago,))
+
+    # Очистка истории репутации старше 90 дней
+    ninety_days_ago = current_time - timedelta(days=90)
+    c.execute('DELETE FROM reputation_history WHERE timestamp < ?', (ninety_days_ago,))
+
+    # Очистка обработанных баг-репортов старше 30 дней
+    c.execute('''DELETE FROM bug_reports 
+                WHERE status != 'new' 
+                AND report_date < ?''', (thirty_days_ago,))
+
+    # Очистка записей о мутах и режима тишины, срок которых истек
+    expire_restrictions(c, current_time)
+
 def cleanup_database():
     """
     Очищает старые записи из базы данных
     """
     try:
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-
-        # Текущее время
+        # Удаление выполняется через поток записи; сводки и журнал баланса
+        # очищаются отдельными записями, чтобы ошибка в одной очистке не
+        # отменяла другие
         current_time = datetime.now()
-
-        # Очистка истории предупреждений старше 30 дней
-        thirty_days_ago = current_time - timedelta(days=30)
-        c.execute('DELETE FROM warn_history WHERE timestamp < ?', (thirty_days_ago,))
-
-        # Очистка истории репутации старше 90 дней
-        ninety_days_ago = current_time - timedelta(days=90)
-        c.execute('DELETE FROM reputation_history WHERE timestamp < ?', (ninety_days_ago,))
-
-        # Очистка обработанных баг-репортов старше 30 дней
-        c.execute('''DELETE FROM bug_reports 
-                    WHERE status != 'new' 
-                    AND report_time < ?''', (thirty_days_ago,))
-
-        # Очистка записей о мутах, срок которых истек
-        c.execute('''UPDATE users 
-                    SET is_muted = 0, mute_end = NULL 
-                    WHERE is_muted = 1 
-                    AND mute_end < ?''', (current_time,))
-
-        # Очистка режима тишины, срок которого истек
-        c.execute('''UPDATE chat_settings 
-                    SET quiet_mode = 0, quiet_end = NULL 
-                    WHERE quiet_mode = 1 
-                    AND quiet_end < ?''', (current_time,))
-
-        # Очистка неактивных бесед (не было активности более 30 дней)
-        c.execute('''UPDATE bot_chats 
-                    SET is_active = 0 
-                    WHERE last_activity < ?''', (thirty_days_ago,))
-
-        # Сохраняем изменения
-        conn.commit()
-
-        # Оптимизация базы данных
-        c.execute('VACUUM')
-        
+        writes = [db_writer.submit(delete_old_records, current_time),
+                  db_writer.submit(activity_rollups.prune, current_time),
+                  db_writer.submit(ledger.prune, current_time)]
+        for write in writes:
+            write.result()
+
+        # Оптимизация базы данных (VACUUM не выполняется внутри транзакции)
+        conn = get_connection()
+        conn.execute('VACUUM')
         conn.close()
         return True
 
@@ -56,35 +68,61 @@ def cleanup_database():
         log_error(f"Ошибка при очистке базы данных: {str(e)}", exc_info=True)
         return False
 
+def archive_history():
+    """
+    Переносит историю сообщений старше срока хранения в помесячные архивы
+    (или удаляет ее при HISTORY_MODE=delete)
+    """
+    try:
+        # Сообщения из буфера должны попасть в историю до переноса
+        write_buffer.flush()
+        cleanup_history()
+        return True
+    except Exception as e:
+        log_error(f"Ошибка при переносе истории сообщений в архив: {str(e)}", exc_info=True)
+        return False
+
+def reset_users(c, user_ids):
+    """
+    Сбрасывает статистику пользователей (выполняется в потоке записи)
+    """
+    c.executemany('''UPDATE users 
+                    SET messages_count = 0,
+                        level = 1,
+                        xp = 0,
+                        balance = 0,
+                        reputation = 0
+                    WHERE user_id = ?''', user_ids)
+    c.executemany('DELETE FROM chat_message_counts WHERE user_id = ?', user_ids)
+
 def cleanup_inactive_users():
     """
     Очищает данные неактивных пользователей
     """
     try:
-        conn = sqlite3.connect('bot.db')
+        # Время активности должно быть актуальным
+        write_buffer.flush()
+        conn = get_connection()
         c = conn.cursor()
 
         # Получаем список всех пользователей
         c.execute('SELECT user_id, last_activity FROM users')
         users = c.fetchall()
+        conn.close()
 
         # Текущее время
         current_time = datetime.now()
         ninety_days_ago = current_time - timedelta(days=90)
 
-        for user_id, last_activity in users:
-            if last_activity and datetime.fromisoformat(last_activity) < ninety_days_ago:
-                # Сбрасываем статистику неактивного пользователя
-                c.execute('''UPDATE users 
-                            SET messages_count = 0,
-                                level = 1,
-                                xp = 0,
-                                balance = 0,
-                                reputation = 0
-                            WHERE user_id = ?''', (user_id,))
-
-        conn.commit()
-        conn.close()
+        # Сбрасываем статистику неактивных пользователей
+        inactive = [(user_id,) for user_id, last_activity in users
+                    if last_activity and datetime.fromisoformat(last_activity) < ninety_days_ago]
+        if inactive:
+            db_writer.call(reset_users, inactive)
+            leaderboards.reset(user_id for user_id, in inactive)
+
+        # Уровни и балансы сброшены в обход кэша состояния
+        user_state.invalidate()
         return True
 
     except Exception as e:
@@ -98,11 +136,19 @@ def schedule_cleanup():
     import schedule
     import time
 
+    # Перенос старой истории сообщений в архив каждый день в 2:30,
+    # VACUUM при очистке в 3:00 освобождает место в основной базе
+    schedule.every().day.at("02:30").do(archive_history)
+
     # Очистка базы данных каждый день в 3:00
     schedule.every().day.at("03:00").do(cleanup_database)
     
     # Очистка неактивных пользователей каждую неделю в воскресенье в 4:00
     schedule.every().sunday.at("04:00").do(cleanup_inactive_users)
+    
+    # Очистка устаревших отметок кулдаунов команд каждый час
+    from command_registry import registry
+    schedule.every().hour.do(registry.cleanup_cooldowns)
 
     while True:
         schedule.run_pending()
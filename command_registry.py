@@ -0,0 +1,140 @@
+import inspect
+import threading
+import time
+import logging
+from query_profiler import profiler
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Уровни ролей для проверки прав
+ROLE_LEVELS = {
+    'user': 0,
+    'moderator': 1,
+    'senior_moderator': 2,
+    'admin': 3
+}
+
+# Классы стоимости команд
+COST_LIGHT = 'light'  # Несколько запросов к базе
+COST_API = 'api'      # Запросы к VK API или внешним сервисам
+COST_GAME = 'game'    # Игры и экономика
+COST_HEAVY = 'heavy'  # Генерация изображений, отчеты, действия во всех беседах
+
+
+class Command:
+    """Описание зарегистрированной команды"""
+
+    __slots__ = ('name', 'handler', 'role', 'cost', 'cooldown', 'background', 'pass_args')
+
+    def __init__(self, name, handler, role, cost, cooldown, background=False):
+        if role not in ROLE_LEVELS:
+            raise ValueError(f"Неизвестная роль: {role}")
+
+        self.name = name
+        self.handler = handler
+        self.role = role
+        self.cost = cost
+        self.cooldown = cooldown
+        # Тяжелый отчет: выполняется в пуле отчетов, а не в обработчике событий
+        self.background = background
+        # Обработчики вида cmd_x(vk, event) не принимают аргументы
+        self.pass_args = len(inspect.signature(handler).parameters) >= 3
+
+
+class CommandRegistry:
+    """Реестр команд бота с проверкой прав, кулдаунами и статистикой"""
+
+    def __init__(self):
+        self.commands = {}
+        # Время последнего вызова: (user_id, команда) -> time.monotonic()
+        self.last_calls = {}
+        # Статистика выполнения: команда -> {'calls', 'total_time', 'max_time', 'errors'}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, handler, role='user', cost=COST_LIGHT, cooldown=0, background=False):
+        """Зарегистрировать обработчик команды"""
+        if name in self.commands:
+            raise ValueError(f"Команда /{name} уже зарегистрирована")
+        self.commands[name] = Command(name, handler, role, cost, cooldown, background)
+        return handler
+
+    def command(self, name, role='user', cost=COST_LIGHT, cooldown=0, background=False):
+        """Декоратор для регистрации команды"""
+        def decorator(handler):
+            return self.register(name, handler, role, cost, cooldown, background)
+        return decorator
+
+    def get(self, name):
+        """Найти команду по имени"""
+        return self.commands.get(name)
+
+    def has_access(self, command, user_role):
+        """Проверить, хватает ли роли для выполнения команды"""
+        return ROLE_LEVELS.get(user_role, 0) >= ROLE_LEVELS[command.role]
+
+    def check_cooldown(self, command, user_id):
+        """Проверить кулдаун и отметить вызов. Возвращает True, если команду можно выполнить"""
+        if not command.cooldown:
+            return True
+
+        key = (user_id, command.name)
+        now = time.monotonic()
+        with self.lock:
+            last_call = self.last_calls.get(key)
+            if last_call is not None and now - last_call < command.cooldown:
+                return False
+            self.last_calls[key] = now
+        return True
+
+    def execute(self, command, vk, event, args, user_role):
+        """Выполнить команду. Возвращает текст ответа или None"""
+        user_id = event.obj.message['from_id']
+
+        if not self.has_access(command, user_role):
+            return None
+
+        if not self.check_cooldown(command, user_id):
+            logger.info(f"Команда /{command.name} от {user_id} пропущена из-за кулдауна")
+            return None
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            # Запросы к базе внутри команды учитываются под именем ее обработчика
+            with profiler.tag(command.handler.__name__):
+                if command.pass_args:
+                    return command.handler(vk, event, args)
+                return command.handler(vk, event)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record(command.name, time.perf_counter() - started, failed)
+
+    def _record(self, name, elapsed, failed):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {'calls': 0, 'total_time': 0.0, 'max_time': 0.0, 'errors': 0}
+            stats['calls'] += 1
+            stats['total_time'] += elapsed
+            if elapsed > stats['max_time']:
+                stats['max_time'] = elapsed
+            if failed:
+                stats['errors'] += 1
+
+    def cleanup_cooldowns(self, max_age=3600):
+        """Удалить устаревшие отметки кулдаунов"""
+        now = time.monotonic()
+        with self.lock:
+            self.last_calls = {
+                key: last_call for key, last_call in self.last_calls.items()
+                if now - last_call < max_age
+            }
+
+
+# Создаем глобальный реестр команд
+registry = CommandRegistry()
+command = registry.command
@@ -1,9 +1,314 @@
 import sqlite3
 from datetime import datetime, timedelta
 import threading
+import logging
+from contextlib import contextmanager
+from dotenv import load_dotenv
 from logger import log_error
+from query_profiler import ProfiledConnection
 import os
 
+load_dotenv()
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Путь к базе данных и параметры соединений
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot.db')
+DATABASE_TIMEOUT = float(os.getenv('DATABASE_TIMEOUT', '20'))
+# Размер кэша подготовленных выражений на соединение
+DATABASE_STATEMENT_CACHE = int(os.getenv('DATABASE_STATEMENT_CACHE', '256'))
+# Максимум строк, которые отчет читает из одного запроса к снимку базы
+REPORT_MAX_ROWS = int(os.getenv('REPORT_MAX_ROWS', '5000'))
+
+# Профиль хранения: PRAGMA, которые применяются к каждому соединению.
+# WAL позволяет читать во время записи, а очистке и VACUUM - не блокировать
+# обработку сообщений; synchronous=NORMAL в режиме WAL не теряет целостность
+# базы, а только последние транзакции при сбое питания
+STORAGE_PROFILE = (
+    ('journal_mode', os.getenv('DATABASE_JOURNAL_MODE', 'WAL')),
+    ('synchronous', os.getenv('DATABASE_SYNCHRONOUS', 'NORMAL')),
+    ('busy_timeout', int(DATABASE_TIMEOUT * 1000)),
+    ('cache_size', -int(os.getenv('DATABASE_CACHE_KB', '16384'))),
+    ('mmap_size', int(os.getenv('DATABASE_MMAP_MB', '256')) * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('journal_size_limit', 64 * 1024 * 1024),
+)
+
+
+def apply_storage_profile(conn):
+    """Применить профиль хранения к соединению"""
+    for name, value in STORAGE_PROFILE:
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def open_connection(detect_types=0):
+    """Отдельное соединение с базой (для обновления схемы, бэкапов и т.п.)"""
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=DATABASE_TIMEOUT,
+        detect_types=detect_types,
+        cached_statements=DATABASE_STATEMENT_CACHE,
+        check_same_thread=False,
+        # Все запросы проходят через профилировщик (/perf queries)
+        factory=ProfiledConnection
+    )
+    apply_storage_profile(conn)
+    return conn
+
+
+def storage_settings():
+    """Текущие значения PRAGMA профиля хранения на соединении потока"""
+    conn = get_connection()
+    try:
+        return {name: conn.execute(f'PRAGMA {name}').fetchone()[0] for name, _ in STORAGE_PROFILE}
+    finally:
+        conn.close()
+
+
+class PoolSlot:
+    """Соединение потока и количество выданных из него PooledConnection"""
+
+    __slots__ = ('connection', 'depth', 'generation')
+
+    def __init__(self, connection, generation):
+        self.connection = connection
+        self.depth = 0
+        self.generation = generation
+
+
+class PooledConnection:
+    """
+    Соединение, выданное пулом. Повторяет интерфейс sqlite3.Connection,
+    но close() возвращает соединение в пул, а не закрывает его.
+    Если соединение не закрыли явно (ранний return, исключение),
+    оно возвращается в пул при удалении объекта.
+    """
+
+    def __init__(self, pool, slot):
+        self._pool = pool
+        self._slot = slot
+        self._closed = False
+        self.row_factory = None
+
+    @property
+    def in_transaction(self):
+        return self._slot.connection.in_transaction
+
+    @property
+    def total_changes(self):
+        return self._slot.connection.total_changes
+
+    def cursor(self):
+        cursor = self._slot.connection.cursor()
+        if self.row_factory is not None:
+            cursor.row_factory = self.row_factory
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        self._slot.connection.commit()
+
+    def rollback(self):
+        rolled_back = self._slot.connection.in_transaction
+        self._slot.connection.rollback()
+        if rolled_back:
+            self._pool.rolled_back()
+
+    def backup(self, target, **kwargs):
+        self._slot.connection.backup(target, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Как у sqlite3.Connection: commit при успехе, rollback при ошибке
+        rolled_back = exc_type is not None and self._slot.connection.in_transaction
+        result = self._slot.connection.__exit__(exc_type, exc_value, traceback)
+        if rolled_back:
+            self._pool.rolled_back()
+        return result
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._pool.release(self._slot)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Постоянные соединения с базой: одно на поток (и на набор detect_types).
+    Соединения не открываются заново на каждый запрос, поэтому работает
+    кэш подготовленных выражений sqlite3. С query_only=True соединения
+    открываются только для чтения (PRAGMA query_only).
+    """
+
+    def __init__(self, query_only=False):
+        self.query_only = query_only
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.opened = 0
+        self.checkouts = 0
+        self.abandoned = 0
+        # Вызываются после отката транзакции (кэши, которые могли получить отмененные изменения)
+        self.rollback_listeners = []
+
+    def connect(self, detect_types=0):
+        """Получить соединение текущего потока"""
+        slots = getattr(self._local, 'slots', None)
+        if slots is None:
+            slots = self._local.slots = {}
+
+        slot = slots.get(detect_types)
+        if slot is not None and slot.generation != self.generation and slot.depth == 0:
+            # Пул сброшен (например, база восстановлена из бэкапа) - открываем заново
+            slot.connection.close()
+            slot = None
+        if slot is None:
+            connection = open_connection(detect_types)
+            if self.query_only:
+                connection.execute('PRAGMA query_only = ON')
+            slot = slots[detect_types] = PoolSlot(connection, self.generation)
+            with self.lock:
+                self.opened += 1
+
+        slot.depth += 1
+        with self.lock:
+            self.checkouts += 1
+        return PooledConnection(self, slot)
+
+    def release(self, slot):
+        slot.depth -= 1
+        if slot.depth == 0 and slot.connection.in_transaction:
+            # Транзакцию не завершили - откатываем, как при закрытии обычного соединения
+            slot.connection.rollback()
+            with self.lock:
+                self.abandoned += 1
+            logger.warning("Незавершенная транзакция отменена при возврате соединения в пул")
+            self.rolled_back()
+
+    def add_rollback_listener(self, callback):
+        """Вызывать callback() после каждого отката транзакции"""
+        self.rollback_listeners.append(callback)
+
+    def rolled_back(self):
+        for callback in self.rollback_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Ошибка обработчика отката транзакции: {str(e)}")
+
+    def reset(self):
+        """Переоткрыть все соединения при следующем обращении"""
+        with self.lock:
+            self.generation += 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'path': DATABASE_PATH,
+                'opened': self.opened,
+                'checkouts': self.checkouts,
+                'abandoned': self.abandoned
+            }
+
+
+# Создаем глобальный пул соединений
+pool = ConnectionPool()
+
+# Создаем пул соединений только для чтения (снимки для отчетов)
+report_pool = ConnectionPool(query_only=True)
+
+
+def get_connection(detect_types=0):
+    """Соединение с базой для текущего потока. close() возвращает его в пул"""
+    return pool.connect(detect_types)
+
+
+class Snapshot:
+    """Чтение из снимка базы с ограничением размера результата"""
+
+    def __init__(self, connection, max_rows):
+        self.connection = connection
+        self.max_rows = max_rows
+        # Был ли хотя бы один результат обрезан по max_rows
+        self.truncated = False
+
+    def fetch(self, sql, parameters=(), limit=None):
+        """Строки результата, не больше limit (по умолчанию max_rows)"""
+        limit = min(limit or self.max_rows, self.max_rows)
+        rows = self.connection.execute(sql, parameters).fetchmany(limit + 1)
+        if len(rows) > limit:
+            self.truncated = True
+            rows = rows[:limit]
+        return rows
+
+    def fetch_one(self, sql, parameters=()):
+        """Первая строка результата или None"""
+        return self.connection.execute(sql, parameters).fetchone()
+
+
+@contextmanager
+def read_snapshot(max_rows=REPORT_MAX_ROWS):
+    """
+    Согласованный снимок базы для тяжелых отчетов:
+
+        with read_snapshot() as snapshot:
+            rows = snapshot.fetch('SELECT ...', (chat_id,))
+
+    Отдельное соединение только для чтения, транзакция BEGIN DEFERRED: под WAL
+    все запросы блока видят базу на момент первого чтения и не мешают записи.
+    """
+    conn = report_pool.connect()
+    try:
+        conn.execute('BEGIN DEFERRED')
+        yield Snapshot(conn, max_rows)
+    finally:
+        # Изменений нет - просто завершаем транзакцию чтения
+        if conn.in_transaction:
+            conn.commit()
+        conn.close()
+
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Транзакция на соединении текущего потока:
+
+        with transaction() as c:
+            c.execute(...)
+
+    commit при успешном завершении блока, rollback при исключении.
+    immediate=True сразу берет блокировку на запись (BEGIN IMMEDIATE).
+    """
+    conn = get_connection()
+    try:
+        if immediate and not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        yield conn.cursor()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
 class Database:
     _instance = None
     _lock = threading.Lock()
@@ -20,140 +325,19 @@ class Database:
         if self._initialized:
             return
             
-        self.db_file = 'bot.db'
-        self._connection = None
+        self.db_file = DATABASE_PATH
         self._initialized = True
-        self.init_database()
     
     def get_connection(self):
         """Получить соединение с базой данных"""
-        if self._connection is None:
-            self._connection = sqlite3.connect(self.db_file, check_same_thread=False)
-            self._connection.row_factory = sqlite3.Row
-        return self._connection
+        conn = get_connection()
+        conn.row_factory = sqlite3.Row
+        return conn
     
     def init_database(self):
-        """Инициализация базы данных"""
-        try:
-            conn = self.get_connection()
-            c = conn.cursor()
-            
-            # Создаем все необходимые таблицы
-            c.executescript('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    role TEXT DEFAULT 'user',
-                    messages_count INTEGER DEFAULT 0,
-                    level INTEGER DEFAULT 1,
-                    xp INTEGER DEFAULT 0,
-                    balance INTEGER DEFAULT 0,
-                    reputation INTEGER DEFAULT 0,
-                    warnings INTEGER DEFAULT 0,
-                    is_muted INTEGER DEFAULT 0,
-                    mute_end TIMESTAMP,
-                    last_daily TIMESTAMP,
-                    nickname TEXT,
-                    reg_date TIMESTAMP,
-                    invited_count INTEGER DEFAULT 0,
-                    last_activity TIMESTAMP,
-                    last_bug_report TIMESTAMP
-                );
-
-                CREATE TABLE IF NOT EXISTS marriages (
-                    user1_id INTEGER,
-                    user2_id INTEGER,
-                    marriage_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user1_id) REFERENCES users(user_id),
-                    FOREIGN KEY (user2_id) REFERENCES users(user_id),
-                    PRIMARY KEY (user1_id, user2_id)
-                );
-
-                CREATE TABLE IF NOT EXISTS bans (
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    ban_time TIMESTAMP,
-                    PRIMARY KEY (user_id, chat_id)
-                );
-
-                CREATE TABLE IF NOT EXISTS warn_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    warned_by INTEGER,
-                    reason TEXT,
-                    timestamp TIMESTAMP
-                );
-
-                CREATE TABLE IF NOT EXISTS message_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    message_type TEXT,
-                    timestamp TIMESTAMP
-                );
-
-                CREATE TABLE IF NOT EXISTS chat_settings (
-                    chat_id INTEGER PRIMARY KEY,
-                    quiet_mode INTEGER DEFAULT 0,
-                    quiet_end TIMESTAMP,
-                    welcome_message TEXT,
-                    auto_warn INTEGER DEFAULT 0,
-                    max_warnings INTEGER DEFAULT 3
-                );
-
-                CREATE TABLE IF NOT EXISTS bot_chats (
-                    chat_id INTEGER PRIMARY KEY,
-                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active INTEGER DEFAULT 1
-                );
-
-                CREATE TABLE IF NOT EXISTS word_filters (
-                    chat_id INTEGER,
-                    word TEXT,
-                    added_by INTEGER,
-                    added_time TIMESTAMP,
-                    PRIMARY KEY (chat_id, word)
-                );
-
-                CREATE TABLE IF NOT EXISTS automod_settings (
-                    chat_id INTEGER PRIMARY KEY,
-                    spam_filter INTEGER DEFAULT 0,
-                    caps_filter INTEGER DEFAULT 0,
-                    links_filter INTEGER DEFAULT 0,
-                    max_warns INTEGER DEFAULT 3,
-                    action TEXT DEFAULT 'warn'
-                );
-
-                CREATE TABLE IF NOT EXISTS bug_reports (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    description TEXT,
-                    status TEXT,
-                    report_date TIMESTAMP
-                );
-            ''')
-            
-            conn.commit()
-            
-            # Создаем индексы для оптимизации
-            c.executescript('''
-                CREATE INDEX IF NOT EXISTS idx_message_history_user_chat 
-                ON message_history(user_id, chat_id);
-                
-                CREATE INDEX IF NOT EXISTS idx_warn_history_user 
-                ON warn_history(user_id);
-                
-                CREATE INDEX IF NOT EXISTS idx_bans_user 
-                ON bans(user_id);
-                
-                CREATE INDEX IF NOT EXISTS idx_users_role 
-                ON users(role);
-            ''')
-            
-            conn.commit()
-            
-        except Exception as e:
-            log_error(f"Ошибка при инициализации базы данных: {str(e)}", exc_info=True)
-            raise
+        """Инициализация базы данных: все миграции схемы (см. migrations.py)"""
+        from migrations import migrator
+        return migrator.migrate(background=False)
     
     def backup_database(self):
         """Создание резервной копии базы данных"""
@@ -206,16 +390,15 @@ class Database:
         return cursor.fetchall()
     
     def close(self):
-        """Закрыть соединение с базой данных"""
-        if self._connection:
-            self._connection.close()
-            self._connection = None
+        """Переоткрыть соединения с базой данных при следующем обращении"""
+        pool.reset()
+        report_pool.reset()
 
     def get_message_count(self, user_id):
         """Получить количество сообщений пользователя"""
         try:
-            result = self.fetch_one('''SELECT COUNT(*) as count 
-                                     FROM message_history 
+            result = self.fetch_one('''SELECT messages_count as count 
+                                     FROM users 
                                      WHERE user_id = ?''', (user_id,))
             return result['count'] if result else 0
         except Exception as e:
@@ -224,10 +407,12 @@ class Database:
 
     def update_message_count(self, user_id, count):
         """Обновить количество сообщений пользователя"""
+        from leaderboards import leaderboards
         try:
             self.execute('''UPDATE users 
                            SET messages_count = ? 
                            WHERE user_id = ?''', (count, user_id))
+            leaderboards.set(user_id, messages=count)
             return True
         except Exception as e:
             log_error(f"Ошибка при обновлении количества сообщений: {str(e)}", exc_info=True)
@@ -303,22 +488,14 @@ class Database:
             return False
 
     def get_top_users(self, category, limit=10):
-        """Получить топ пользователей по категории"""
+        """Получить топ пользователей по категории (из топов в памяти, см. leaderboards.py)"""
+        from leaderboards import leaderboards, CATEGORIES
         try:
-            if category not in ['level', 'messages', 'balance', 'rep']:
+            if category not in CATEGORIES:
                 return []
             
-            field = {
-                'level': 'level',
-                'messages': 'messages_count',
-                'balance': 'balance',
-                'rep': 'reputation'
-            }[category]
-            
-            return self.fetch_all(f'''SELECT user_id, {field} as value 
-                                    FROM users 
-                                    ORDER BY {field} DESC 
-                                    LIMIT ?''', (limit,))
+            return [{'user_id': user_id, 'value': value}
+                    for user_id, value in leaderboards.top(category, limit)]
         except Exception as e:
             log_error(f"Ошибка при получении топа пользователей: {str(e)}", exc_info=True)
             return []
@@ -365,11 +542,13 @@ class Database:
     def get_active_users(self, hours=24):
         """Получить список активных пользователей за последние N часов"""
         try:
-            time_threshold = datetime.now() - timedelta(hours=hours)
-            return self.fetch_all('''SELECT DISTINCT user_id 
-                                   FROM message_history 
-                                   WHERE timestamp > ?''', 
-                                (time_threshold,))
+            # Сводки активности вместо просмотра истории; окно округляется до часа
+            from activity_rollups import window_start
+            period, granularity = window_start(hours)
+            return self.fetch_all(f'''SELECT DISTINCT user_id 
+                                    FROM chat_user_activity_{granularity} 
+                                    WHERE period >= ?''', 
+                                (period,))
         except Exception as e:
             log_error(f"Ошибка при получении списка активных пользователей: {str(e)}", exc_info=True)
             return []
@@ -0,0 +1,220 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+from database import get_connection, transaction, pool
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+
+class WriteRequest:
+    """Функция записи, ее аргументы и Future для результата"""
+
+    __slots__ = ('func', 'args', 'future', 'submitted')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class DatabaseWriter:
+    """
+    Поток, через который проходят записи в базу.
+
+    Вызывающий код передает функцию записи func(c, *args) и получает
+    concurrent.futures.Future (в asyncio - через asyncio.wrap_future).
+    Поток забирает из очереди все накопившиеся запросы (до max_batch) и
+    выполняет их в одной транзакции BEGIN IMMEDIATE, каждый - в своей точке
+    сохранения: ошибка одного запроса откатывает только его изменения.
+    Результаты становятся доступны после commit. Блокировку записи SQLite
+    берет один поток, поэтому записи не ждут друг друга в busy_timeout,
+    а чтение под WAL идет по соединениям потоков из пула.
+
+    Функция записи не должна вызывать commit/rollback. Если поток не запущен
+    или уже остановлен, запись выполняется сразу в потоке вызывающего.
+    """
+
+    def __init__(self, max_batch=200):
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.stopped = False
+        # Курсор текущей транзакции потока записи
+        self.cursor = None
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.writes = 0
+        self.max_batch_seen = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.write_time = 0.0
+
+    def submit(self, func, *args):
+        """Поставить запись в очередь. Возвращает Future с результатом func"""
+        request = WriteRequest(func, args)
+        if threading.current_thread() is self.thread:
+            # Запись из функции записи: выполняем в текущей транзакции
+            self._run_inline(request, self.cursor)
+        elif self.thread is None or self.stopped:
+            self._run_inline(request)
+        else:
+            self.queue.put(request)
+        return request.future
+
+    def call(self, func, *args, timeout=None):
+        """Выполнить запись и дождаться результата"""
+        return self.submit(func, *args).result(timeout)
+
+    def execute(self, sql, parameters=()):
+        """Выполнить один запрос записи. Future с числом измененных строк"""
+        return self.submit(lambda c: c.execute(sql, parameters).rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        """Выполнить запрос для набора параметров. Future с числом измененных строк"""
+        seq_of_parameters = list(seq_of_parameters)
+        return self.submit(lambda c: c.executemany(sql, seq_of_parameters).rowcount)
+
+    def start(self):
+        """Запустить поток записи"""
+        if self.thread:
+            return
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        logger.info(f"Поток записи в базу запущен (до {self.max_batch} записей в транзакции)")
+
+    def stop(self):
+        """Записать все, что в очереди, и остановить поток"""
+        if not self.thread:
+            return
+        # Новые записи выполняются сразу, очередь дописывает поток
+        self.stopped = True
+        self.queue.put(None)
+        self.thread.join(timeout=30)
+        self.thread = None
+
+    def _run_inline(self, request, c=None):
+        if not request.future.set_running_or_notify_cancel():
+            return
+        try:
+            if c is not None:
+                result = request.func(c, *request.args)
+            else:
+                with transaction(immediate=True) as c:
+                    result = request.func(c, *request.args)
+        except BaseException as e:
+            request.future.set_exception(e)
+        else:
+            request.future.set_result(result)
+
+    def _run(self):
+        running = True
+        while running:
+            request = self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                batch.append(request)
+            self._write(batch)
+
+        # Записи, поставленные в очередь одновременно с остановкой
+        batch = []
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                batch.append(request)
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        done = []
+        failed = []
+        conn = get_connection()
+        try:
+            c = self.cursor = conn.cursor()
+            try:
+                c.execute('BEGIN IMMEDIATE')
+                for request in batch:
+                    if not request.future.set_running_or_notify_cancel():
+                        continue
+                    c.execute('SAVEPOINT db_write')
+                    try:
+                        result = request.func(c, *request.args)
+                    except Exception as e:
+                        c.execute('ROLLBACK TO db_write')
+                        c.execute('RELEASE db_write')
+                        # Кэши могли получить изменения из отмененной записи
+                        pool.rolled_back()
+                        failed.append((request, e))
+                    else:
+                        c.execute('RELEASE db_write')
+                        done.append((request, result))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                log_error(f"Ошибка транзакции потока записи ({len(batch)} записей): {str(e)}", exc_info=True)
+                # Отменяется вся транзакция: ошибку получают все ее записи
+                done = []
+                failed = [(request, e) for request in batch
+                          if request.future.running() or request.future.set_running_or_notify_cancel()]
+        finally:
+            self.cursor = None
+            conn.close()
+
+        finished = time.perf_counter()
+        for request, result in done:
+            request.future.set_result(result)
+        for request, error in failed:
+            request.future.set_exception(error)
+
+        with self.lock:
+            self.transactions += 1
+            self.writes += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.failed += len(failed)
+            self.write_time += finished - started
+            for request in batch:
+                wait = started - request.submitted
+                self.wait_time += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'running': bool(self.thread),
+                'queued': self.queue.qsize(),
+                'transactions': self.transactions,
+                'writes': self.writes,
+                'avg_batch': self.writes / self.transactions if self.transactions else 0.0,
+                'max_batch': self.max_batch_seen,
+                'failed': self.failed,
+                'avg_wait_ms': self.wait_time / self.writes * 1000 if self.writes else 0.0,
+                'max_wait_ms': self.max_wait * 1000,
+                'avg_transaction_ms': self.write_time / self.transactions * 1000 if self.transactions else 0.0
+            }
+
+
+# Создаем глобальный поток записи в базу
+db_writer = DatabaseWriter(max_batch=int(os.getenv('DB_WRITER_MAX_BATCH', '200')))
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+
+class ChatEventPipeline:
+    """
+    Асинхронный конвейер обработки событий long poll.
+
+    Каждая беседа получает свою очередь событий. Пул воркеров разбирает
+    очереди так, что события одной беседы обрабатываются строго по порядку,
+    а разные беседы обрабатываются параллельно. Сами обработчики синхронные
+    и выполняются в пуле потоков.
+    """
+
+    def __init__(self, handler, workers=8, backlog_warning=100):
+        self.handler = handler
+        self.workers = workers
+        self.backlog_warning = backlog_warning
+        # Очереди событий по беседам: chat_id -> deque
+        self.chat_queues = {}
+        # Очередь бесед, готовых к обработке
+        self.ready = None
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='event-worker')
+        # Статистика конвейера
+        self.stats = {
+            'received': 0,
+            'processed': 0,
+            'failed': 0,
+            'max_wait': 0.0
+        }
+
+    @staticmethod
+    def chat_key(event):
+        """Ключ очереди для события (ID беседы или 0 для остальных событий)"""
+        return getattr(event, 'chat_id', None) or 0
+
+    def submit(self, event):
+        """Поставить событие в очередь беседы (вызывается в потоке цикла событий)"""
+        key = self.chat_key(event)
+        self.stats['received'] += 1
+
+        queue = self.chat_queues.get(key)
+        if queue is None:
+            # Беседа не обрабатывается и не ждет воркера - ставим ее в очередь
+            queue = self.chat_queues[key] = deque()
+            queue.append((time.monotonic(), event))
+            self.ready.put_nowait(key)
+        else:
+            queue.append((time.monotonic(), event))
+            if len(queue) == self.backlog_warning:
+                logger.warning(f"В очереди беседы {key} скопилось {len(queue)} событий")
+
+    def backlog(self):
+        """Количество событий, ожидающих обработки"""
+        return sum(len(queue) for queue in self.chat_queues.values())
+
+    async def _worker(self):
+        """Воркер: берет беседу из очереди готовых и обрабатывает одно ее событие"""
+        while True:
+            key = await self.ready.get()
+            queue = self.chat_queues[key]
+            queued_at, event = queue.popleft()
+
+            wait = time.monotonic() - queued_at
+            if wait > self.stats['max_wait']:
+                self.stats['max_wait'] = wait
+
+            try:
+                await self.loop.run_in_executor(self.executor, self.handler, event)
+                self.stats['processed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                log_error(f"Ошибка при обработке события беседы {key}: {str(e)}", exc_info=True)
+
+            # Пока событие обрабатывалось, беседа не была в очереди готовых,
+            # поэтому порядок внутри беседы сохраняется. Оставшиеся события
+            # ставим в конец очереди, чтобы не задерживать другие беседы.
+            if queue:
+                self.ready.put_nowait(key)
+            else:
+                del self.chat_queues[key]
+
+    def _read_events(self, events):
+        """Читает события long poll в отдельном потоке и передает их в цикл"""
+        for event in events:
+            self.loop.call_soon_threadsafe(self.submit, event)
+
+    async def _run(self, events):
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Queue()
+
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Конвейер событий запущен ({self.workers} воркеров)")
+
+        try:
+            # listen() блокирующий, поэтому читаем его вне цикла событий
+            await self.loop.run_in_executor(None, self._read_events, events)
+
+            # Итератор событий закончился (например, при воспроизведении записи) -
+            # дожидаемся обработки всего, что осталось в очередях
+            while self.chat_queues:
+                await asyncio.sleep(0.05)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.executor.shutdown(wait=False)
+
+    def run(self, events):
+        """Запустить конвейер для итератора событий (например, longpoll.listen())"""
+        asyncio.run(self._run(events))
@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+import logging
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+
+class EventRecorder:
+    """
+    Запись событий long poll в JSONL файл.
+
+    Каждая строка файла: {"ts": время получения, "event": исходное событие VK}.
+    Записанный файл воспроизводится скриптом replay.py.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.count = 0
+        logger.info(f"Запись событий long poll в {path}")
+
+    def record(self, event):
+        """Записать одно событие"""
+        line = json.dumps({'ts': time.time(), 'event': event.raw}, ensure_ascii=False)
+        try:
+            with self.lock:
+                self.file.write(line + '\n')
+                self.file.flush()
+                self.count += 1
+        except Exception as e:
+            log_error(f"Ошибка при записи события: {str(e)}")
+
+    def wrap(self, events):
+        """Обернуть итератор событий так, чтобы каждое событие записывалось"""
+        for event in events:
+            self.record(event)
+            yield event
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_events(path):
+    """Прочитать записанные события. Возвращает список пар (ts, raw)"""
+    events = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            events.append((record['ts'], record['event']))
+    return events
@@ -0,0 +1,248 @@
+"""
+Проверка планов SQL запросов бота.
+
+Находит в исходниках вызовы execute()/executemany() и fetch()/fetch_one()
+снимков отчетов с текстом запроса, выполняет для каждого
+EXPLAIN QUERY PLAN на схеме из migrations.py и
+выводит запросы, которые читают таблицу целиком (SCAN без индекса).
+Запросы с условием WHERE, которые сканируют таблицу, считаются ошибкой,
+если таблица не входит в SMALL_TABLES, а запрос - в EXPECTED_SCANS.
+Ошибкой считаются и запросы, план которых не строится (столбца или таблицы
+нет в схеме), кроме запросов к RUNTIME_TABLES.
+
+Использование:
+    python explain_queries.py [--db bot.db] [--all] [--strict]
+"""
+import argparse
+import ast
+import os
+import re
+import sqlite3
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Таблицы с одной строкой на беседу (и служебные) и баг-репорты (не чаще
+# раза в 12 часов от пользователя, обработанные удаляются): полный проход дешев
+SMALL_TABLES = {'sqlite_master', 'bot_chats', 'chat_settings', 'achievement_types', 'bug_reports'}
+
+# Полные проходы, которые выполняются намеренно: (файл, функция) -> причина
+EXPECTED_SCANS = {
+    ('migrations.py', 'rebuild_message_counters'): "пересчет счетчиков по всей истории",
+    ('activity_rollups.py', 'rebuild'): "пересчет сводок по всей истории",
+}
+
+# Таблицы, которые появляются только во время работы: подключенный архив
+# истории и временное представление над ним (history_archive.py)
+RUNTIME_TABLES = {'archive.message_history', 'all_message_history'}
+
+MISSING_TABLE_PATTERN = re.compile(r'no such table: (\S+)')
+
+# Команды, для которых план не строится
+SKIPPED_KEYWORDS = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'ATTACH', 'DETACH', 'VACUUM',
+                    'ANALYZE', 'CREATE', 'DROP', 'ALTER')
+
+BINDINGS_PATTERN = re.compile(r'uses (\d+)')
+
+# Методы, первый аргумент которых - текст запроса
+QUERY_METHODS = ('execute', 'executemany', 'fetch', 'fetch_one')
+
+
+class Query:
+    """Текст запроса и место в исходниках"""
+
+    __slots__ = ('path', 'line', 'function', 'sql')
+
+    def __init__(self, path, line, function, sql):
+        self.path = path
+        self.line = line
+        self.function = function
+        self.sql = sql
+
+    @property
+    def location(self):
+        return f"{self.path}:{self.line} ({self.function})"
+
+
+class QueryCollector(ast.NodeVisitor):
+    """Вызовы execute()/executemany()/fetch()/fetch_one() со строковым запросом"""
+
+    def __init__(self, path):
+        self.path = path
+        self.functions = []
+        self.queries = []
+        self.dynamic = []
+
+    def visit_FunctionDef(self, node):
+        self.functions.append(node.name)
+        self.generic_visit(node)
+        self.functions.pop()
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Call(self, node):
+        if (isinstance(node.func, ast.Attribute) and node.func.attr in QUERY_METHODS
+                and node.args):
+            function = self.functions[-1] if self.functions else '<module>'
+            argument = node.args[0]
+            if isinstance(argument, ast.Constant) and isinstance(argument.value, str):
+                self.queries.append(Query(self.path, node.lineno, function, argument.value))
+            elif isinstance(argument, ast.JoinedStr):
+                # f-строки с именами таблиц проверить нельзя - только перечисляем
+                self.dynamic.append(Query(self.path, node.lineno, function, None))
+        self.generic_visit(node)
+
+
+def collect_queries(base_dir=BASE_DIR):
+    """Запросы из всех модулей бота"""
+    queries = []
+    dynamic = []
+    for name in sorted(os.listdir(base_dir)):
+        if not name.endswith('.py') or name == os.path.basename(__file__):
+            continue
+        with open(os.path.join(base_dir, name), encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=name)
+        collector = QueryCollector(name)
+        collector.visit(tree)
+        queries.extend(collector.queries)
+        dynamic.extend(collector.dynamic)
+    return queries, dynamic
+
+
+def schema_connection(db_path=None):
+    """Соединение со схемой: копия существующей базы или новая база из миграций"""
+    if db_path:
+        source = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        conn = sqlite3.connect(':memory:')
+        source.backup(conn)
+        source.close()
+        return conn
+
+    from migrations import MIGRATIONS
+    conn = sqlite3.connect(':memory:')
+    c = conn.cursor()
+    for item in MIGRATIONS:
+        # Долгие миграции только переносят данные
+        if not item.background:
+            item.func(c)
+    conn.commit()
+    return conn
+
+
+def query_plan(conn, sql):
+    """Строки EXPLAIN QUERY PLAN; параметры подставляются как NULL"""
+    parameters = ()
+    for _ in range(2):
+        try:
+            return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+        except sqlite3.ProgrammingError as e:
+            match = BINDINGS_PATTERN.search(str(e))
+            if not match:
+                raise
+            parameters = (None,) * int(match.group(1))
+    raise sqlite3.ProgrammingError("Не удалось подставить параметры запроса")
+
+
+def full_scans(plan):
+    """Таблицы, которые читаются целиком (SCAN без индекса)"""
+    scans = []
+    for detail in plan:
+        # SCAN CONSTANT ROW - SELECT без FROM, таблица не читается
+        if detail.startswith('SCAN ') and ' USING ' not in detail and detail != 'SCAN CONSTANT ROW':
+            table = detail[len('SCAN '):].split(' ')[0]
+            if table not in SMALL_TABLES:
+                scans.append(table)
+    return scans
+
+
+def has_condition(sql):
+    return re.search(r'\bWHERE\b', sql, re.IGNORECASE) is not None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Проверка планов SQL запросов бота")
+    parser.add_argument('--db', help="Проверять на копии этой базы (по умолчанию - новая база из миграций)")
+    parser.add_argument('--all', action='store_true', help="Выводить и полные проходы запросов без WHERE")
+    parser.add_argument('--strict', action='store_true',
+                        help="Код выхода 1, если есть неожиданные полные проходы "
+                             "или запросы, не соответствующие схеме")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, BASE_DIR)
+    conn = schema_connection(args.db)
+    queries, dynamic = collect_queries()
+
+    # Таблицы, которые модули создают сами (CREATE ... IF NOT EXISTS в коде)
+    for query in queries:
+        if query.sql.strip().upper().startswith('CREATE'):
+            try:
+                conn.execute(query.sql)
+            except sqlite3.Error:
+                pass
+
+    problems = []
+    whole_table = []
+    expected = []
+    failed = []
+    runtime = []
+    checked = 0
+    for query in queries:
+        statement = query.sql.strip()
+        if not statement or statement.split(None, 1)[0].upper() in SKIPPED_KEYWORDS:
+            continue
+        try:
+            plan = query_plan(conn, statement)
+        except sqlite3.Error as e:
+            match = MISSING_TABLE_PATTERN.search(str(e))
+            if match and match.group(1) in RUNTIME_TABLES:
+                runtime.append((query, str(e)))
+            else:
+                failed.append((query, str(e)))
+            continue
+        checked += 1
+        scans = full_scans(plan)
+        if not scans:
+            continue
+        if (query.path, query.function) in EXPECTED_SCANS:
+            expected.append((query, scans))
+        elif has_condition(statement):
+            problems.append((query, scans))
+        else:
+            whole_table.append((query, scans))
+
+    print(f"Проверено запросов: {checked}, с динамическим текстом (f-строки): {len(dynamic)}")
+
+    if problems:
+        print(f"\n❌ Полный проход таблицы при условии WHERE ({len(problems)}):")
+        for query, scans in problems:
+            print(f"  {query.location}: {', '.join(scans)}")
+    if args.all and whole_table:
+        print(f"\nℹ️ Запросы без WHERE, читающие таблицу целиком ({len(whole_table)}):")
+        for query, scans in whole_table:
+            print(f"  {query.location}: {', '.join(scans)}")
+    if args.all and expected:
+        print(f"\nℹ️ Ожидаемые полные проходы ({len(expected)}):")
+        for query, scans in expected:
+            reason = EXPECTED_SCANS[(query.path, query.function)]
+            print(f"  {query.location}: {', '.join(scans)} - {reason}")
+    if args.all and runtime:
+        print(f"\nℹ️ Запросы к таблицам времени работы, план не строится ({len(runtime)}):")
+        for query, error in runtime:
+            print(f"  {query.location}: {error}")
+    if failed:
+        print(f"\n❌ Запрос не соответствует схеме ({len(failed)}):")
+        for query, error in failed:
+            print(f"  {query.location}: {error}")
+    if not problems:
+        print("\n✅ Неожиданных полных проходов нет")
+
+    conn.close()
+    if args.strict and (problems or failed):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
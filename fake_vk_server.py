@@ -0,0 +1,439 @@
+"""
+Локальная имитация VK API для нагрузочных замеров и работы без сети.
+
+Поддерживаются методы, которые использует бот, execute, загрузка фото и
+Bots Long Poll сервер. Задержка, частота ошибок 6/9 и размер бесед задаются
+параметрами запуска.
+
+Использование:
+    python fake_vk_server.py --port 8081 --latency 50 --error6 0.01 --members 200
+    VK_API_URL=http://127.0.0.1:8081 python main.py
+
+Внедрение событий в long poll:
+    curl -X POST http://127.0.0.1:8081/inject -d '{"chat_id": 1, "from_id": 10, "text": "/help"}'
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CHAT_START_ID = 2000000000
+
+# Первый ID участников, генерируемых для бесед
+MEMBER_BASE_ID = 100000
+
+
+class VkApiError(Exception):
+    """Ошибка метода, которая возвращается клиенту в поле error"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FakeVk:
+    """Состояние имитируемого VK: беседы, сообщения, очередь long poll"""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.photo_id = 0
+        # Участники бесед: chat_id -> список ID. Создаются при первом обращении
+        self.members = {}
+        # Очередь событий long poll. updates[0] соответствует ts = updates_offset + 1
+        self.updates = []
+        self.updates_offset = 0
+        self.ts = 1
+        self.updates_changed = threading.Condition(self.lock)
+        # Окно запросов за последнюю секунду для ограничения --rps
+        self.recent_requests = deque()
+        # Статистика вызовов
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.sent_messages = 0
+
+        self.handlers = {
+            'messages.send': self.messages_send,
+            'messages.delete': self.messages_delete,
+            'messages.removeChatUser': self.messages_remove_chat_user,
+            'messages.getConversationMembers': self.messages_get_conversation_members,
+            'messages.pin': lambda values: {'id': 1},
+            'users.get': self.users_get,
+            'photos.getMessagesUploadServer': self.photos_get_messages_upload_server,
+            'photos.saveMessagesPhoto': self.photos_save_messages_photo,
+            'groups.getLongPollServer': self.groups_get_long_poll_server,
+        }
+
+    # Вызов методов
+
+    def call(self, method, values, check_limits=True):
+        """Выполнить метод API. Возвращает поле response или бросает VkApiError"""
+        with self.lock:
+            self.calls[method] += 1
+
+        if check_limits:
+            self.check_limits(method)
+
+        handler = self.handlers.get(method)
+        if handler is None:
+            raise VkApiError(3, "Unknown method passed")
+        return handler(values)
+
+    def check_limits(self, method):
+        """Имитация ограничений VK: частота запросов и flood control"""
+        if self.config.rps:
+            now = time.monotonic()
+            with self.lock:
+                while self.recent_requests and now - self.recent_requests[0] > 1:
+                    self.recent_requests.popleft()
+                self.recent_requests.append(now)
+                too_many = len(self.recent_requests) > self.config.rps
+            if too_many:
+                self.add_error(6)
+                raise VkApiError(6, "Too many requests per second")
+
+        if random.random() < self.config.error6:
+            self.add_error(6)
+            raise VkApiError(6, "Too many requests per second")
+
+        if method == 'messages.send' and random.random() < self.config.error9:
+            self.add_error(9)
+            raise VkApiError(9, "Flood control")
+
+    def add_error(self, code):
+        with self.lock:
+            self.errors[code] += 1
+
+    def delay(self):
+        """Имитация сетевой задержки"""
+        if self.config.latency:
+            latency = self.config.latency / 1000
+            jitter = latency * self.config.jitter
+            time.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+
+    def execute(self, code):
+        """
+        Выполнить код execute вида "return [API.method({json}), ...];".
+        Возвращает (ответы, ошибки) как VK: при ошибке вызова на его месте false.
+        """
+        with self.lock:
+            self.calls['execute'] += 1
+        self.check_limits('execute')
+
+        decoder = json.JSONDecoder()
+        responses = []
+        errors = []
+        position = 0
+
+        while True:
+            start = code.find('API.', position)
+            if start == -1:
+                break
+            bracket = code.find('(', start)
+            method = code[start + 4:bracket].strip()
+            try:
+                values, end = decoder.raw_decode(code, bracket + 1)
+            except ValueError:
+                raise VkApiError(12, "Unable to compile code")
+            position = code.find(')', end) + 1
+
+            if len(responses) >= 25:
+                raise VkApiError(13, "Too many API calls")
+
+            try:
+                responses.append(self.call(method, stringify(values), check_limits=False))
+            except VkApiError as e:
+                responses.append(False)
+                errors.append({'method': method, 'error_code': e.code, 'error_msg': e.message})
+
+        return responses, errors
+
+    # Методы
+
+    def messages_send(self, values):
+        with self.lock:
+            self.message_id += 1
+            self.sent_messages += 1
+            message_id = self.message_id
+        if self.config.verbose:
+            print(f"[send {values.get('peer_id') or values.get('chat_id') or values.get('user_id')}] {values.get('message', '')}")
+        return message_id
+
+    def messages_delete(self, values):
+        ids = split_ids(values.get('conversation_message_ids') or values.get('message_ids'))
+        return {str(message_id): 1 for message_id in ids}
+
+    def messages_remove_chat_user(self, values):
+        chat_id = int(values['chat_id'])
+        user_id = int(values.get('user_id') or values.get('member_id'))
+        with self.lock:
+            members = self.chat_members(chat_id)
+            if user_id not in members:
+                raise VkApiError(935, "User not found in chat")
+            members.remove(user_id)
+        return 1
+
+    def messages_get_conversation_members(self, values):
+        chat_id = int(values['peer_id']) - CHAT_START_ID
+        with self.lock:
+            members = list(self.chat_members(chat_id))
+
+        items = [
+            {'member_id': user_id, 'invited_by': 0, 'join_date': 1600000000,
+             'is_admin': index == 0, 'is_owner': index == 0}
+            for index, user_id in enumerate(members)
+        ]
+        profiles = [self.profile(user_id) for user_id in members]
+        return {'count': len(items), 'items': items, 'profiles': profiles, 'groups': []}
+
+    def users_get(self, values):
+        return [self.profile(user_id) for user_id in split_ids(values.get('user_ids'))]
+
+    def photos_get_messages_upload_server(self, values):
+        return {'upload_url': f'{self.config.base_url}/upload', 'album_id': -3, 'group_id': 1}
+
+    def photos_save_messages_photo(self, values):
+        with self.lock:
+            self.photo_id += 1
+            photo_id = self.photo_id
+        return [{'id': photo_id, 'owner_id': -1, 'album_id': -3, 'access_key': 'fake', 'sizes': []}]
+
+    def groups_get_long_poll_server(self, values):
+        with self.lock:
+            ts = self.ts
+        return {'key': 'fake', 'server': f'{self.config.base_url}/longpoll', 'ts': str(ts)}
+
+    # Вспомогательные функции
+
+    def chat_members(self, chat_id):
+        """Участники беседы (вызывается под self.lock)"""
+        members = self.members.get(chat_id)
+        if members is None:
+            first_id = MEMBER_BASE_ID + chat_id * self.config.members
+            members = self.members[chat_id] = list(range(first_id, first_id + self.config.members))
+        return members
+
+    def profile(self, user_id):
+        return {
+            'id': user_id,
+            'first_name': f'User{user_id}',
+            'last_name': 'Fake',
+            'online': int(random.random() < self.config.online),
+            'photo_max_orig': f'{self.config.base_url}/photo.jpg',
+            'can_access_closed': True,
+            'is_closed': False
+        }
+
+    # Long poll
+
+    def inject(self, raw_event):
+        """Добавить событие в очередь long poll"""
+        with self.updates_changed:
+            self.updates.append(raw_event)
+            self.ts += 1
+            # Не храним бесконечно уже выданные события
+            if len(self.updates) > 10000:
+                del self.updates[:5000]
+                self.updates_offset += 5000
+            self.updates_changed.notify_all()
+
+    def long_poll(self, ts, wait):
+        """Вернуть события, появившиеся после ts, ожидая их не дольше wait секунд"""
+        deadline = time.monotonic() + wait
+        with self.updates_changed:
+            while self.ts <= ts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.updates_changed.wait(remaining)
+
+            updates = self.updates[max(0, ts - 1 - self.updates_offset):]
+            return {'ts': str(self.ts), 'updates': updates}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'errors': {str(code): count for code, count in self.errors.items()},
+                'sent_messages': self.sent_messages,
+                'ts': self.ts
+            }
+
+
+def split_ids(value):
+    """Список ID из строки "1,2,3", числа или списка"""
+    if value is None or value == '':
+        return []
+    if isinstance(value, (list, tuple)):
+        return [int(item) for item in value]
+    return [int(item) for item in str(value).split(',') if item.strip()]
+
+
+def stringify(values):
+    """Привести параметры из execute к виду параметров HTTP запроса"""
+    return {
+        key: ','.join(str(item) for item in value) if isinstance(value, list) else value
+        for key, value in values.items()
+    }
+
+
+def message_event(chat_id, from_id, text, conversation_message_id=0):
+    """Событие message_new для беседы"""
+    return {
+        'type': 'message_new',
+        'group_id': 1,
+        'event_id': f'fake{time.monotonic_ns()}',
+        'object': {
+            'message': {
+                'date': int(time.time()),
+                'from_id': from_id,
+                'id': 0,
+                'out': 0,
+                'peer_id': CHAT_START_ID + chat_id,
+                'text': text,
+                'conversation_message_id': conversation_message_id,
+                'attachments': []
+            },
+            'client_info': {}
+        }
+    }
+
+
+class FakeVkHandler(BaseHTTPRequestHandler):
+    fake = None
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: value[-1] for key, value in parse_qs(url.query, keep_blank_values=True).items()}
+
+        if url.path == '/longpoll':
+            wait = min(int(params.get('wait', 25)), 90)
+            self.send_json(self.fake.long_poll(int(params.get('ts', 1)), wait))
+        elif url.path == '/stats':
+            self.send_json(self.fake.stats())
+        elif url.path.startswith('/method/'):
+            self.handle_method(url.path[len('/method/'):], params)
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_body()
+
+        if url.path.startswith('/method/'):
+            params = {key: value[-1] for key, value in parse_qs(url.query, keep_blank_values=True).items()}
+            if body and 'multipart' not in (self.headers.get('Content-Type') or ''):
+                params.update({key: value[-1] for key, value in parse_qs(body.decode('utf-8'), keep_blank_values=True).items()})
+            self.handle_method(url.path[len('/method/'):], params)
+        elif url.path == '/upload':
+            self.send_json({'server': 1, 'photo': '[{"photo":"fake"}]', 'hash': 'fake'})
+        elif url.path == '/inject':
+            self.handle_inject(body)
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    def handle_method(self, method, params):
+        self.fake.delay()
+        try:
+            if method == 'execute':
+                responses, errors = self.fake.execute(params.get('code', ''))
+                result = {'response': responses}
+                if errors:
+                    result['execute_errors'] = errors
+                self.send_json(result)
+            else:
+                self.send_json({'response': self.fake.call(method, params)})
+        except VkApiError as e:
+            request_params = [{'key': 'method', 'value': method}]
+            self.send_json({'error': {'error_code': e.code, 'error_msg': e.message,
+                                      'request_params': request_params}})
+
+    def handle_inject(self, body):
+        data = json.loads(body or b'{}')
+        events = data if isinstance(data, list) else [data]
+        for event in events:
+            if 'type' not in event:
+                event = message_event(int(event.get('chat_id', 1)), int(event.get('from_id', MEMBER_BASE_ID)),
+                                      event.get('text', ''), int(event.get('conversation_message_id', 0)))
+            self.fake.inject(event)
+        self.send_json({'injected': len(events)})
+
+
+def generate_events(fake, rate, chats):
+    """Фоновая генерация сообщений в long poll с заданной частотой"""
+    texts = ['привет', 'как дела?', 'что нового', '/getid', '/top', '/daily', '/slots 10']
+    conversation_message_id = 0
+    while True:
+        chat_id = random.randint(1, chats)
+        first_id = MEMBER_BASE_ID + chat_id * fake.config.members
+        from_id = random.randint(first_id, first_id + fake.config.members - 1)
+        conversation_message_id += 1
+        fake.inject(message_event(chat_id, from_id, random.choice(texts), conversation_message_id))
+        time.sleep(1 / rate)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Локальная имитация VK API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help="Задержка ответа, мс")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Разброс задержки, доля от --latency")
+    parser.add_argument('--error6', type=float, default=0.0, help="Доля ответов с ошибкой 6 (too many requests)")
+    parser.add_argument('--error9', type=float, default=0.0, help="Доля messages.send с ошибкой 9 (flood control)")
+    parser.add_argument('--rps', type=int, default=0, help="Лимит запросов в секунду (0 - без лимита)")
+    parser.add_argument('--members', type=int, default=50, help="Количество участников в каждой беседе")
+    parser.add_argument('--online', type=float, default=0.3, help="Доля участников онлайн")
+    parser.add_argument('--events-rate', type=float, default=0, help="Генерировать N сообщений в секунду")
+    parser.add_argument('--chats', type=int, default=5, help="Количество бесед для генерации сообщений")
+    parser.add_argument('--verbose', action='store_true', help="Выводить отправленные сообщения")
+    return parser.parse_args()
+
+
+def main():
+    config = parse_args()
+    config.base_url = f'http://{config.host}:{config.port}'
+
+    fake = FakeVk(config)
+    FakeVkHandler.fake = fake
+    server = ThreadingHTTPServer((config.host, config.port), FakeVkHandler)
+    server.daemon_threads = True
+
+    if config.events_rate:
+        threading.Thread(target=generate_events, args=(fake, config.events_rate, config.chats),
+                         daemon=True).start()
+
+    print(f"Fake VK API: {config.base_url} (VK_API_URL={config.base_url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(fake.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import os
+import time
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from vk_api.exceptions import ApiError
+from vk_api.utils import get_random_id
+from requests.exceptions import ConnectionError, Timeout
+from vk_batch import VkBatch, VkBatchError, MAX_CALLS_PER_EXECUTE
+from send_scheduler import RETRY_ERROR_CODES
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Одновременных запросов execute и повторов временных ошибок по умолчанию
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS', '4'))
+FANOUT_MAX_RETRIES = int(os.getenv('FANOUT_MAX_RETRIES', '2'))
+
+
+def is_transient(error):
+    """Можно ли повторить вызов, завершившийся этой ошибкой"""
+    if isinstance(error, (VkBatchError, ApiError)):
+        return error.code in RETRY_ERROR_CODES
+    return isinstance(error, (ConnectionError, Timeout))
+
+
+class FanOutResult:
+    """Итог действия для одного элемента (беседы или пары беседа-пользователь)"""
+
+    __slots__ = ('item', 'result', 'error', 'attempts')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.attempts = 0
+
+    @property
+    def ok(self):
+        return self.attempts > 0 and self.error is None
+
+
+class FanOut:
+    """
+    Параллельное выполнение однотипных действий по многим беседам.
+
+    Элементы делятся на пакеты execute по 25 вызовов, пакеты выполняются
+    одновременно в workers потоках. Частоту запросов по-прежнему ограничивает
+    планировщик, через который проходит каждый execute. Вызовы с временными
+    ошибками (6/9/10, сетевые) повторяются следующим кругом с паузой.
+
+        fanout = FanOut(vk, progress=progress_message(vk, event.chat_id, "Исключение"))
+        results = fanout.run(chat_ids, lambda batch, chat_id:
+                             batch.messages.removeChatUser(chat_id=chat_id, user_id=user_id))
+    """
+
+    def __init__(self, vk, workers=None, max_retries=None, retry_delay=1.0,
+                 chunk_size=MAX_CALLS_PER_EXECUTE, progress=None, progress_interval=5.0):
+        self.vk = vk
+        self.workers = workers or FANOUT_WORKERS
+        self.max_retries = FANOUT_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_delay = retry_delay
+        self.chunk_size = chunk_size
+        # progress(done, total) вызывается в потоке, запустившем run()
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+    def run(self, items, make_call):
+        """
+        Выполнить make_call(batch, item) для каждого элемента.
+        Возвращает {item: FanOutResult} в порядке items.
+        """
+        results = {item: FanOutResult(item) for item in items}
+        pending = list(results)
+        total = len(pending)
+        done = 0
+        last_report = time.monotonic()
+
+        attempt = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fanout') as executor:
+            while pending:
+                chunks = [pending[start:start + self.chunk_size]
+                          for start in range(0, len(pending), self.chunk_size)]
+                futures = [executor.submit(self._run_chunk, chunk, make_call, results) for chunk in chunks]
+
+                retry = []
+                for future in as_completed(futures):
+                    for item in future.result():
+                        result = results[item]
+                        if result.error is not None and is_transient(result.error) and attempt < self.max_retries:
+                            retry.append(item)
+                        else:
+                            done += 1
+
+                    if self.progress and done < total and time.monotonic() - last_report >= self.progress_interval:
+                        last_report = time.monotonic()
+                        self._report(done, total)
+
+                pending = retry
+                if pending:
+                    # Экспоненциальная пауза со случайным разбросом перед следующим кругом
+                    delay = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+                    attempt += 1
+                    logger.warning(f"Повтор {len(pending)} вызовов через {delay:.2f} с ({attempt}/{self.max_retries})")
+                    time.sleep(delay)
+
+        return results
+
+    def _run_chunk(self, chunk, make_call, results):
+        batch = VkBatch(self.vk)
+        calls = [(item, make_call(batch, item)) for item in chunk]
+        batch.execute()
+        for item, call in calls:
+            result = results[item]
+            result.attempts += 1
+            result.result = call.result
+            result.error = call.error
+        return chunk
+
+    def _report(self, done, total):
+        try:
+            self.progress(done, total)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить прогресс: {str(e)}")
+
+
+def progress_message(vk, chat_id, title):
+    """Функция прогресса для FanOut, отправляющая сообщения в беседу"""
+    def report(done, total):
+        vk.messages.send(
+            chat_id=chat_id,
+            message=f"⏳ {title}: {done}/{total}",
+            random_id=get_random_id()
+        )
+    return report
+
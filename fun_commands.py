@@ -1,9 +1,15 @@
-import sqlite3
+from database import get_connection
+from write_buffer import write_buffer
 from datetime import datetime, timedelta
 from vk_api.utils import get_random_id
 import random
 from utils import extract_user_id
+from command_registry import command, COST_API, COST_GAME
+from user_state import user_state
+from ledger import ledger
+from leaderboards import leaderboards
 
+@command('profile', cost=COST_API)
 def cmd_profile(vk, event, args):
     """Показывает профиль пользователя"""
     try:
@@ -16,26 +22,38 @@ def cmd_profile(vk, event, args):
         else:
             user_id = event.obj.message['from_id']
         
-        conn = sqlite3.connect('bot.db')
+        # Учитываем сообщения, которые еще не записаны из буфера
+        write_buffer.flush()
+        conn = get_connection()
         c = conn.cursor()
         
-        # Подсчитываем количество сообщений для пользователя напрямую из message_history
-        c.execute('''SELECT COUNT(*) FROM message_history WHERE user_id = ?''', (user_id,))
-        messages_count = c.fetchone()[0]
-        
-        # Получаем информацию о пользователе
-        c.execute('''SELECT level, xp, balance, reputation, nickname, role, invited_count
+        # Получаем информацию о пользователе и его счетчик сообщений в этой беседе
+        c.execute('''SELECT level, xp, balance, reputation, nickname, role, invited_count, messages_count,
+                           (SELECT messages_count FROM chat_message_counts
+                            WHERE chat_id = ? AND user_id = users.user_id)
                     FROM users 
-                    WHERE user_id = ?''', (user_id,))
+                    WHERE user_id = ?''', (event.chat_id, user_id))
         result = c.fetchone()
         
         if not result:
             return "❌ Пользователь не найден в базе данных"
             
-        level, xp, balance, reputation, nickname, role, invited_count = result
+        level, xp, balance, reputation, nickname, role, invited_count, messages_count, chat_messages = result
+        
+        # Проверяем, состоит ли пользователь в браке
+        c.execute('''SELECT user2_id, marriage_date 
+                    FROM marriages 
+                    WHERE user1_id = ?
+                    UNION
+                    SELECT user1_id, marriage_date 
+                    FROM marriages 
+                    WHERE user2_id = ?''', (user_id, user_id))
+        marriage = c.fetchone()
         
-        # Получаем информацию о пользователе из VK API
-        user_info = vk.users.get(user_ids=[user_id])[0]
+        # Получаем информацию о пользователе и партнере из VK API одним запросом
+        user_ids = [user_id, marriage[0]] if marriage else [user_id]
+        users_info = {user['id']: user for user in vk.users.get(user_ids=user_ids)}
+        user_info = users_info[user_id]
         
         # Формируем сообщение
         message = f"👤 Профиль пользователя {user_info['first_name']} {user_info['last_name']}\n\n"
@@ -44,25 +62,15 @@ def cmd_profile(vk, event, args):
         message += f"✨ Опыт: {xp}\n"
         message += f"💰 Баланс: {balance}\n"
         message += f"👍 Репутация: {reputation}\n"
-        message += f"💭 Сообщений: {messages_count}\n"
+        message += f"💭 Сообщений: {messages_count} (в этой беседе: {chat_messages or 0})\n"
         message += f"👥 Приглашено: {invited_count}\n"
         
         if nickname:
             message += f"🏷 Никнейм: {nickname}\n"
         
-        # Проверяем, состоит ли пользователь в браке
-        c.execute('''SELECT user2_id, marriage_date 
-                    FROM marriages 
-                    WHERE user1_id = ?
-                    UNION
-                    SELECT user1_id, marriage_date 
-                    FROM marriages 
-                    WHERE user2_id = ?''', (user_id, user_id))
-        marriage = c.fetchone()
-        
         if marriage:
             partner_id, marriage_date = marriage
-            partner_info = vk.users.get(user_ids=[partner_id])[0]
+            partner_info = users_info.get(partner_id, {'first_name': 'Unknown', 'last_name': 'User'})
             message += f"\n💍 В браке с {partner_info['first_name']} {partner_info['last_name']}\n"
             message += f"📅 Дата свадьбы: {marriage_date}"
         
@@ -73,6 +81,7 @@ def cmd_profile(vk, event, args):
         return f"❌ Ошибка: {str(e)}"
 
 
+@command('give', cost=COST_GAME)
 def cmd_give(vk, event, args):
     """Передача монет другому пользователю"""
     if len(args) < 2:
@@ -94,29 +103,20 @@ def cmd_give(vk, event, args):
         if from_id == to_id:
             return "❌ Вы не можете передать монеты самому себе"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем существование отправителя в базе
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (from_id,))
-        sender = c.fetchone()
-        if not sender:
-            c.execute('INSERT INTO users (user_id, balance) VALUES (?, 0)', (from_id,))
-            conn.commit()
-            return "❌ У вас нет монет для передачи"
-        
-        # Проверяем баланс отправителя
-        if sender[0] < amount:
-            return f"❌ Недостаточно монет для передачи (у вас {sender[0]} монет)"
-        
-        # Проверяем существование получателя в базе
-        c.execute('SELECT 1 FROM users WHERE user_id = ?', (to_id,))
-        if not c.fetchone():
-            c.execute('INSERT INTO users (user_id, balance) VALUES (?, 0)', (to_id,))
-        
-        # Переводим монеты
-        c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (amount, from_id))
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, to_id))
+        # Переводим монеты: списание выполняется, только если их хватает
+        if ledger.transfer(c, from_id, to_id, amount, 'give') is None:
+            sender_balance = user_state.balance(from_id)
+            if sender_balance is None:
+                c.execute('INSERT INTO users (user_id, balance) VALUES (?, 0)', (from_id,))
+                conn.commit()
+                conn.close()
+                user_state.invalidate(from_id)
+                return "❌ У вас нет монет для передачи"
+            conn.close()
+            return f"❌ Недостаточно монет для передачи (у вас {sender_balance} монет)"
         
         conn.commit()
         conn.close()
@@ -128,6 +128,7 @@ def cmd_give(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка при передаче монет: {str(e)}"
     
+@command('nickname')
 def cmd_nickname(vk, event, args):
     """Установка или изменение ника пользователя"""
     if not args:
@@ -140,7 +141,7 @@ def cmd_nickname(vk, event, args):
         if len(nickname) > 20:
             return "⚠️ Максимальная длина ника: 20 символов"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Обновляем ник
@@ -155,12 +156,13 @@ def cmd_nickname(vk, event, args):
     
 
 
+@command('achievements')
 def cmd_achievements(vk, event):
     """Показывает достижения пользователя"""
     try:
         user_id = event.obj.message['from_id']
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Получаем все достижения пользователя
@@ -202,27 +204,35 @@ def cmd_achievements(vk, event):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('daily', cost=COST_GAME)
 def cmd_daily(vk, event):
     try:
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Check last daily claim
-        c.execute('SELECT last_daily FROM users WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
+        # Отмечаем получение награды, только если прошли сутки с прошлого раза:
+        # два одновременных /daily не получат награду дважды
+        now = datetime.now()
+        c.execute('''UPDATE users SET last_daily = ?
+                    WHERE user_id = ? AND (last_daily IS NULL OR last_daily <= ?)''',
+                 (now, user_id, now - timedelta(days=1)))
         
-        if result and result[0]:
+        if c.rowcount == 0:
+            c.execute('SELECT last_daily FROM users WHERE user_id = ?', (user_id,))
+            result = c.fetchone()
+            # Ничего не изменено - просто завершаем транзакцию
+            conn.commit()
+            conn.close()
+            if not result:
+                return "❌ Вы не зарегистрированы в системе"
             last_daily = datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S.%f')
-            if datetime.now() - last_daily < timedelta(days=1):
-                next_daily = last_daily + timedelta(days=1)
-                return f"⏳ Вы уже получили ежедневную награду. Следующая будет доступна {next_daily.strftime('%d.%m.%Y в %H:%M')}"
+            next_daily = last_daily + timedelta(days=1)
+            return f"⏳ Вы уже получили ежедневную награду. Следующая будет доступна {next_daily.strftime('%d.%m.%Y в %H:%M')}"
         
         # Give reward
         reward = random.randint(100, 500)
-        c.execute('''UPDATE users 
-                    SET balance = balance + ?, last_daily = ? 
-                    WHERE user_id = ?''', (reward, datetime.now(), user_id))
+        ledger.credit(c, user_id, reward, 'daily')
         
         conn.commit()
         conn.close()
@@ -231,6 +241,7 @@ def cmd_daily(vk, event):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('marry', cost=COST_API)
 def cmd_marry(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -248,7 +259,7 @@ def cmd_marry(vk, event, args):
         if user_id == partner_id:
             return "❌ Вы не можете заключить брак с самим собой"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Check if either user is already married
@@ -270,11 +281,12 @@ def cmd_marry(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('divorce')
 def cmd_divorce(vk, event):
     try:
         user_id = event.obj.message['from_id']
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Find and delete marriage
@@ -291,6 +303,7 @@ def cmd_divorce(vk, event):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('rep', cost=COST_API)
 def cmd_rep(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя и причину"
@@ -308,32 +321,40 @@ def cmd_rep(vk, event, args):
         if from_id == to_id:
             return "❌ Вы не можете изменить репутацию самому себе"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        # Add reputation point and history
-        c.execute('''UPDATE users 
-                    SET reputation = reputation + 1 
-                    WHERE user_id = ?''', (to_id,))
-        
-        c.execute('''INSERT INTO reputation_history 
-                    (from_user_id, to_user_id, amount, reason, timestamp)
-                    VALUES (?, ?, 1, ?, ?)''', 
-                    (from_id, to_id, reason, datetime.now()))
-        
-        conn.commit()
-        
-        # Get new reputation value
-        c.execute('SELECT reputation FROM users WHERE user_id = ?', (to_id,))
-        new_rep = c.fetchone()[0]
-        
-        conn.close()
+        conn = get_connection()
+        try:
+            c = conn.cursor()
+            
+            # Пользователь мог еще не писать в беседах: создаем его запись
+            c.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (to_id,))
+            created = c.rowcount > 0
+            
+            # Add reputation point and history
+            c.execute('''UPDATE users 
+                        SET reputation = reputation + 1 
+                        WHERE user_id = ?
+                        RETURNING reputation''', (to_id,))
+            new_rep = c.fetchone()[0]
+            
+            c.execute('''INSERT INTO reputation_history 
+                        (from_user_id, to_user_id, amount, reason, timestamp)
+                        VALUES (?, ?, 1, ?, ?)''', 
+                        (from_id, to_id, reason, datetime.now()))
+            
+            conn.commit()
+        finally:
+            conn.close()
+        if created:
+            # Кэш состояния мог запомнить, что пользователя нет в базе
+            user_state.invalidate(to_id)
+        leaderboards.set(to_id, rep=new_rep)
         
         user_info = vk.users.get(user_ids=[to_id])[0]
         return f"👍 Вы повысили репутацию пользователя @id{to_id} ({user_info['first_name']}). Текущая репутация: {new_rep}"
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('game', cost=COST_GAME)
 def cmd_game(vk, event, args):
     if not args:
         return "⚠️ Использование: /game [камень/ножницы/бумага]"
@@ -361,34 +382,29 @@ def cmd_game(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('top', cost=COST_API, cooldown=5)
 def cmd_top(vk, event, args):
     try:
         category = args[0] if args else 'level'
         
         categories = {
-            'level': ('уровню', 'level'),
-            'messages': ('сообщениям', 'messages_count'),
-            'balance': ('балансу', 'balance'),
-            'rep': ('репутации', 'reputation')
+            'level': 'уровню',
+            'messages': 'сообщениям',
+            'balance': 'балансу',
+            'rep': 'репутации'
         }
         
         if category not in categories:
             return "⚠️ Доступные категории: level, messages, balance, rep"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        c.execute(f'''SELECT user_id, {categories[category][1]} 
-                    FROM users 
-                    ORDER BY {categories[category][1]} DESC 
-                    LIMIT 10''')
-        top_users = c.fetchall()
-        conn.close()
+        # Топ и место пользователя - из топов в памяти, без сортировки таблицы
+        top_users = leaderboards.top(category, 10)
+        own_rank = leaderboards.rank(category, event.obj.message['from_id'])
         
         if not top_users:
             return "📊 Статистика пока недоступна"
         
-        message = f"🏆 Топ 10 по {categories[category][0]}:\n\n"
+        message = f"🏆 Топ 10 по {categories[category]}:\n\n"
         
         user_ids = [user[0] for user in top_users]
         users_info = vk.users.get(user_ids=user_ids)
@@ -398,6 +414,10 @@ def cmd_top(vk, event, args):
             user = users_dict.get(user_id, {'first_name': 'Unknown', 'last_name': 'User'})
             message += f"{i}. @id{user_id} ({user['first_name']}): {value}\n"
         
+        if own_rank:
+            place, value = own_rank
+            message += f"\n📍 Ваше место: {place} ({value})"
+        
         return message
     except Exception as e:
         return f"❌ Ошибка: {str(e)}" 
\ No newline at end of file
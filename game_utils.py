@@ -89,7 +89,8 @@ def check_suspicious_activity(conn, user_id):
         c.execute("""SELECT COUNT(*) FROM jackpot_history 
                     WHERE user_id = ? AND timestamp > ? AND amount > 100000""",
                     (user_id, hour_ago))
-        big_wins = c.fetchone()[0] if c.fetchone() else 0
+        result = c.fetchone()
+        big_wins = result[0] if result else 0
         
         if big_wins > 3:
             return False, "Обнаружена подозрительная активность"
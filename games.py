@@ -1,10 +1,15 @@
 import sqlite3
+from database import get_connection
 from datetime import datetime, timedelta
 import random
 from vk_api.utils import get_random_id
 from utils import extract_user_id
 import json
 from logger import log_error
+from command_registry import command, COST_GAME
+from user_state import user_state
+from ledger import ledger
+from game_utils import check_game_limits, check_suspicious_activity
 
 def update_user_stats(conn, user_id, win_amount):
     """Обновляет статистику игр пользователя"""
@@ -70,9 +75,11 @@ def check_achievement(conn, user_id, win_amount, game_type=None):
     
     # Добавляем достижения в базу
     for achievement in achievements:
-        c.execute('''INSERT OR IGNORE INTO achievements 
-                    (user_id, achievement_type, achievement_date)
-                    VALUES (?, ?, ?)''', (user_id, achievement, datetime.now()))
+        c.execute('''INSERT INTO achievements (user_id, type, earned_date)
+                    SELECT ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM achievements 
+                                      WHERE user_id = ? AND type = ?)''',
+                  (user_id, achievement, datetime.now(), user_id, achievement))
     
     # Записываем крупные выигрыши в историю
     if win_amount >= 100000:
@@ -83,6 +90,7 @@ def check_achievement(conn, user_id, win_amount, game_type=None):
     
     return achievements
 
+@command('slots', cost=COST_GAME)
 def cmd_slots(vk, event, args):
     """Игра в слоты"""
     if not args:
@@ -94,14 +102,12 @@ def cmd_slots(vk, event, args):
             return "⚠️ Минимальная ставка: 1 монета"
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'slots') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Символы для слотов с улучшенными шансами
@@ -131,9 +137,9 @@ def cmd_slots(vk, event, args):
             win = -bet
             message = f"🎰 {' '.join(result)}\n💸 Проигрыш: {bet} монет"
         
-        # Обновляем баланс и статистику
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (win, user_id))
+        # Зачисляем ставку с выигрышем и обновляем статистику
+        if bet + win > 0:
+            ledger.credit(c, user_id, bet + win, 'slots')
         update_user_stats(conn, user_id, win)
         
         # Проверяем достижения
@@ -149,6 +155,7 @@ def cmd_slots(vk, event, args):
         return f"❌ Ошибка: {str(e)}"
 
 
+@command('dice', cost=COST_GAME)
 def cmd_dice(vk, event, args):
     """Игра в кости с другим игроком"""
     if len(args) < 2:
@@ -170,25 +177,6 @@ def cmd_dice(vk, event, args):
         if user_id == opponent_id:
             return "❌ Вы не можете играть сами с собой"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        # Проверяем баланс обоих игроков
-        c.execute('SELECT user_id, balance FROM users WHERE user_id IN (?, ?)', (user_id, opponent_id))
-        balances = {row[0]: row[1] for row in c.fetchall()}
-        
-        if user_id not in balances:
-            return "❌ У вас нет аккаунта в боте"
-        if opponent_id not in balances:
-            opponent_info = vk.users.get(user_ids=[opponent_id])[0]
-            return f"❌ У пользователя @id{opponent_id} ({opponent_info['first_name']}) нет аккаунта в боте"
-        
-        if balances[user_id] < bet:
-            return f"❌ У вас недостаточно монет (нужно {bet}, а у вас {balances[user_id]})"
-        if balances[opponent_id] < bet:
-            opponent_info = vk.users.get(user_ids=[opponent_id])[0]
-            return f"❌ У пользователя @id{opponent_id} ({opponent_info['first_name']}) недостаточно монет (нужно {bet}, а у него {balances[opponent_id]})"
-        
         # Бросаем кости
         user_roll = random.randint(1, 6)
         opponent_roll = random.randint(1, 6)
@@ -203,9 +191,25 @@ def cmd_dice(vk, event, args):
         else:
             return "🎲 Ничья! Оба игрока выбросили " + str(user_roll)
         
-        # Обновляем балансы
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (bet, winner_id))
-        c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (bet, loser_id))
+        conn = get_connection()
+        c = conn.cursor()
+        
+        # Списываем ставки с обоих игроков (с обоих или ни с кого)
+        short_id = ledger.stake(c, (user_id, opponent_id), bet, 'dice')
+        if short_id is not None:
+            conn.close()
+            balance = user_state.balance(short_id)
+            if short_id == user_id:
+                if balance is None:
+                    return "❌ У вас нет аккаунта в боте"
+                return f"❌ У вас недостаточно монет (нужно {bet}, а у вас {balance})"
+            opponent_info = vk.users.get(user_ids=[opponent_id])[0]
+            if balance is None:
+                return f"❌ У пользователя @id{opponent_id} ({opponent_info['first_name']}) нет аккаунта в боте"
+            return f"❌ У пользователя @id{opponent_id} ({opponent_info['first_name']}) недостаточно монет (нужно {bet}, а у него {balance})"
+        
+        # Победитель забирает обе ставки
+        ledger.credit(c, winner_id, bet * 2, 'dice')
         
         # Обновляем статистику
         c.execute('UPDATE users SET games_won = games_won + 1 WHERE user_id = ?', (winner_id,))
@@ -228,6 +232,7 @@ def cmd_dice(vk, event, args):
         return f"❌ Ошибка: {str(e)}"
     
 
+@command('roulette', cost=COST_GAME)
 def cmd_russian_roulette(vk, event, args):
     """Русская рулетка"""
     if not args:
@@ -240,14 +245,12 @@ def cmd_russian_roulette(vk, event, args):
         if bet < 1:
             return "⚠️ Минимальная ставка: 1 монета"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'roulette') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Выбираем случайное число от 1 до 6
@@ -261,9 +264,9 @@ def cmd_russian_roulette(vk, event, args):
             win = bet * 5  # Если выжили, получаем 5x ставку
             message = f"🔫 *Щелчок* ✅\n💰 Вы выжили! Выигрыш: {win} монет"
         
-        # Обновляем баланс
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (win, user_id))
+        # Зачисляем ставку с выигрышем
+        if bet + win > 0:
+            ledger.credit(c, user_id, bet + win, 'roulette')
         
         conn.commit()
         conn.close()
@@ -274,6 +277,7 @@ def cmd_russian_roulette(vk, event, args):
     
 
 
+@command('blackjack', cost=COST_GAME)
 def cmd_blackjack(vk, event, args):
     """Игра в блэкджек"""
     if not args:
@@ -287,7 +291,7 @@ def cmd_blackjack(vk, event, args):
         validate_bet(bet, min_bet=50, max_bet=100000)
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db', detect_types=sqlite3.PARSE_DECLTYPES)
+        conn = get_connection(detect_types=sqlite3.PARSE_DECLTYPES)
         
         try:
             # Проверяем лимиты
@@ -302,13 +306,6 @@ def cmd_blackjack(vk, event, args):
             
             c = conn.cursor()
             
-            # Проверяем баланс
-            c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-            balance = c.fetchone()
-            
-            if not balance or balance[0] < bet:
-                return "❌ Недостаточно монет"
-            
             def calculate_hand_value(cards):
                 """Подсчет значения руки с учетом тузов"""
                 value = 0
@@ -328,6 +325,20 @@ def cmd_blackjack(vk, event, args):
                 return value
             
             if action == 'start':
+                # Проверка начатой игры и списание ставки - в одной транзакции
+                # записи, чтобы две команды подряд не открыли две игры
+                c.execute('BEGIN IMMEDIATE')
+                c.execute("""SELECT 1 FROM game_states 
+                           WHERE user_id = ? AND game_type = 'blackjack' LIMIT 1""", (user_id,))
+                if c.fetchone():
+                    conn.commit()
+                    return "⚠️ У вас уже есть начатая игра. Продолжите ее: /blackjack [ставка] hit или stand"
+                
+                # Списываем ставку при начале игры, только если монет достаточно
+                if ledger.debit(c, user_id, bet, 'blackjack') is None:
+                    conn.commit()
+                    return "❌ Недостаточно монет"
+                
                 # Начинаем новую игру
                 user_cards = [random.randint(1, 11), random.randint(1, 11)]
                 dealer_cards = [random.randint(1, 11)]
@@ -348,6 +359,7 @@ def cmd_blackjack(vk, event, args):
                 c.execute("""INSERT INTO game_history (user_id, game_type, amount, timestamp)
                            VALUES (?, 'blackjack', ?, ?)""",
                            (user_id, bet, datetime.now()))
+                conn.commit()
                 
                 user_value = calculate_hand_value(user_cards)
                 return f"🃏 Ваши карты: {user_cards} (сумма: {user_value})\n" \
@@ -380,9 +392,7 @@ def cmd_blackjack(vk, event, args):
                     user_value = calculate_hand_value(user_cards)
                     
                     if user_value > 21:
-                        # Проигрыш
-                        c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?',
-                                (bet, user_id))
+                        # Проигрыш: ставка уже списана при начале игры
                         c.execute('DELETE FROM game_states WHERE user_id = ? AND game_type = ?',
                                 (user_id, 'blackjack'))
                         
@@ -397,6 +407,7 @@ def cmd_blackjack(vk, event, args):
                                SET state = ?, timestamp = ?
                                WHERE user_id = ? AND game_type = 'blackjack'""",
                                (json.dumps(game_state), datetime.now(), user_id))
+                    conn.commit()
                     
                     return f"🃏 Ваши карты: {user_cards} (сумма: {user_value})\n" \
                            f"🎴 Карта дилера: {dealer_cards[0]}\n" \
@@ -422,9 +433,9 @@ def cmd_blackjack(vk, event, args):
                         win = 0
                         result = "🤝 Ничья!"
                     
-                    # Обновляем баланс и статистику
-                    c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                            (win, user_id))
+                    # Зачисляем ставку с выигрышем (при ничьей - возвращаем ставку)
+                    if bet + win > 0:
+                        ledger.credit(c, user_id, bet + win, 'blackjack')
                     
                     if win != 0:
                         update_user_stats(conn, user_id, win)
@@ -461,6 +472,7 @@ def cmd_blackjack(vk, event, args):
         log_error(f"Ошибка в blackjack: {str(e)}", exc_info=True)
         return "❌ Произошла ошибка"
 
+@command('duel', cost=COST_GAME)
 def cmd_duel(vk, event, args):
     """Дуэль между игроками"""
     if len(args) < 2:
@@ -481,26 +493,20 @@ def cmd_duel(vk, event, args):
         if user_id == opponent_id:
             return "❌ Нельзя драться с самим собой"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем балансы обоих игроков
-        c.execute('SELECT balance FROM users WHERE user_id IN (?, ?)',
-                 (user_id, opponent_id))
-        balances = c.fetchall()
-        
-        if len(balances) != 2 or any(b[0] < bet for b in balances):
+        # Списываем ставки с обоих игроков (с обоих или ни с кого)
+        if ledger.stake(c, (user_id, opponent_id), bet, 'duel') is not None:
+            conn.close()
             return "❌ Недостаточно монет у одного из игроков"
         
         # Определяем победителя
         winner_id = random.choice([user_id, opponent_id])
         loser_id = opponent_id if winner_id == user_id else user_id
         
-        # Обновляем балансы
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (bet, winner_id))
-        c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?',
-                 (bet, loser_id))
+        # Победитель забирает обе ставки
+        ledger.credit(c, winner_id, bet * 2, 'duel')
         
         conn.commit()
         conn.close()
@@ -517,6 +523,7 @@ def cmd_duel(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('wheel', cost=COST_GAME)
 def cmd_wheel(vk, event, args):
     """Колесо фортуны"""
     if not args:
@@ -532,14 +539,12 @@ def cmd_wheel(vk, event, args):
             return "⚠️ Выберите цвет: red, black или green"
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'wheel') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Определяем результат
@@ -554,9 +559,9 @@ def cmd_wheel(vk, event, args):
             win = -bet
             message = f"🎡 Выпало: {result}\n💸 Проигрыш: {bet} монет"
         
-        # Обновляем баланс
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (win, user_id))
+        # Зачисляем ставку с выигрышем
+        if bet + win > 0:
+            ledger.credit(c, user_id, bet + win, 'wheel')
         
         conn.commit()
         conn.close()
@@ -565,6 +570,7 @@ def cmd_wheel(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('flip', cost=COST_GAME)
 def cmd_flip(vk, event, args):
     """Игра в монетку"""
     if not args:
@@ -588,21 +594,15 @@ def cmd_flip(vk, event, args):
         if not validate_bet(bet):
             return "⚠️ Минимальная ставка: 1, максимальная: 1,000,000"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        
-        if not result:
-            conn.close()
-            return "❌ Вы не зарегистрированы в системе"
-            
-        balance = result[0]
-        
-        if balance < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'flip') is None:
             conn.close()
+            balance = user_state.balance(user_id)
+            if balance is None:
+                return "❌ Вы не зарегистрированы в системе"
             return f"❌ Недостаточно монет! Ваш баланс: {balance}"
         
         # Подбрасываем монетку
@@ -612,9 +612,9 @@ def cmd_flip(vk, event, args):
         won = choice == flip_result
         win_amount = bet if won else -bet
         
-        # Обновляем баланс
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (win_amount, user_id))
+        # Зачисляем ставку с выигрышем
+        if won:
+            ledger.credit(c, user_id, bet + win_amount, 'flip')
         
         # Обновляем статистику
         if won:
@@ -634,6 +634,7 @@ def cmd_flip(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('lottery', cost=COST_GAME)
 def cmd_lottery(vk, event, args):
     """Лотерея с накопительным джекпотом"""
     if not args:
@@ -648,14 +649,12 @@ def cmd_lottery(vk, event, args):
         total_cost = tickets * ticket_price
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < total_cost:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, total_cost, 'lottery') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Получаем текущий джекпот
@@ -689,9 +688,9 @@ def cmd_lottery(vk, event, args):
             else:
                 win_numbers.append(f"❌ {number}")
         
-        # Обновляем баланс и джекпот
-        c.execute('UPDATE users SET balance = balance - ? + ? WHERE user_id = ?',
-                 (total_cost, total_win, user_id))
+        # Зачисляем выигрыш и обновляем джекпот
+        if total_win > 0:
+            ledger.credit(c, user_id, total_win, 'lottery')
         if total_win == 0:
             c.execute('UPDATE settings SET value = value + ? WHERE key = "lottery_jackpot"',
                      (int(total_cost * 0.5),))  # 50% от проигрыша идет в джекпот
@@ -719,6 +718,7 @@ def cmd_lottery(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('numbers', cost=COST_GAME)
 def cmd_numbers(vk, event, args):
     """Игра в числа: угадай число от 1 до 100"""
     if len(args) < 2:
@@ -734,14 +734,12 @@ def cmd_numbers(vk, event, args):
             return "⚠️ Минимальная ставка: 1 монета"
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'numbers') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Генерируем число
@@ -761,9 +759,9 @@ def cmd_numbers(vk, event, args):
             win = -bet
             message = f"🎯 Не угадали! Было загадано {target}\n💸 Проигрыш: {bet} монет"
         
-        # Обновляем баланс и статистику
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (win, user_id))
+        # Зачисляем ставку с выигрышем и обновляем статистику
+        if bet + win > 0:
+            ledger.credit(c, user_id, bet + win, 'numbers')
         update_user_stats(conn, user_id, win)
         
         # Проверяем достижения
@@ -778,6 +776,7 @@ def cmd_numbers(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('jackpot', cost=COST_GAME)
 def cmd_jackpot(vk, event, args):
     """Игра Jackpot - общий банк, один победитель"""
     if not args:
@@ -789,14 +788,12 @@ def cmd_jackpot(vk, event, args):
             return "⚠️ Минимальная ставка: 100 монет"
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'jackpot') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Получаем текущий банк
@@ -812,15 +809,12 @@ def cmd_jackpot(vk, event, args):
         new_bank = current_bank + bet
         c.execute('UPDATE settings SET value = ? WHERE key = "jackpot_bank"', (str(new_bank),))
         
-        # Списываем ставку
-        c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (bet, user_id))
-        
         # Шанс на выигрыш зависит от размера ставки
         win_chance = bet / new_bank
         
         if random.random() < win_chance:
             # Победа
-            c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (new_bank, user_id))
+            ledger.credit(c, user_id, new_bank, 'jackpot')
             c.execute('UPDATE settings SET value = "0" WHERE key = "jackpot_bank"')
             message = f"🎉 Поздравляем! Вы сорвали джекпот!\n💰 Выигрыш: {new_bank} монет"
             update_user_stats(conn, user_id, new_bank)
@@ -840,6 +834,7 @@ def cmd_jackpot(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('poker', cost=COST_GAME)
 def cmd_poker(vk, event, args):
     """Упрощенная версия покера"""
     if not args:
@@ -851,14 +846,12 @@ def cmd_poker(vk, event, args):
             return "⚠️ Минимальная ставка: 50 монет"
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'poker') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Карты и их значения
@@ -927,8 +920,9 @@ def cmd_poker(vk, event, args):
             win = 0
             result = "🤝 Ничья!"
         
-        # Обновляем баланс
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (win, user_id))
+        # Зачисляем ставку с выигрышем
+        if bet + win > 0:
+            ledger.credit(c, user_id, bet + win, 'poker')
         update_user_stats(conn, user_id, win)
         
         message = (f"🃏 Ваши карты: {format_cards(player_cards)}\n"
@@ -947,11 +941,12 @@ def cmd_poker(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('tournament', cost=COST_GAME)
 def cmd_tournament(vk, event):
     """Ежедневный турнир по играм"""
     try:
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Проверяем, идет ли сейчас турнир
@@ -986,8 +981,7 @@ def cmd_tournament(vk, event):
                     for i, (player_id, score) in enumerate(sorted_players[:3]):
                         reward = rewards.get(i, 0)
                         if reward:
-                            c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                                    (reward, int(player_id)))
+                            ledger.credit(c, int(player_id), reward, 'tournament')
                             user_info = vk.users.get(user_ids=[player_id])[0]
                             message += f"{i+1}. @id{player_id} ({user_info['first_name']})"
                             message += f" — {score} очков, награда: {reward} монет\n"
@@ -1031,6 +1025,7 @@ def validate_bet(bet, min_bet=1, max_bet=1000000):
         raise ValueError(f"Максимальная ставка: {max_bet} монет")
     return True
 
+@command('baccarat', cost=COST_GAME)
 def cmd_baccarat(vk, event, args):
     """Игра в баккара"""
     if not args:
@@ -1047,14 +1042,12 @@ def cmd_baccarat(vk, event, args):
         validate_bet(bet, min_bet=100, max_bet=100000)
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        # Проверяем баланс
-        c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        balance = c.fetchone()
-        
-        if not balance or balance[0] < bet:
+        # Списываем ставку, только если монет достаточно
+        if ledger.debit(c, user_id, bet, 'baccarat') is None:
+            conn.close()
             return "❌ Недостаточно монет"
         
         # Раздаем карты
@@ -1094,9 +1087,9 @@ def cmd_baccarat(vk, event, args):
             win = -bet
             result = "😢 Вы проиграли!"
         
-        # Обновляем баланс и статистику
-        c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                 (win, user_id))
+        # Зачисляем ставку с выигрышем и обновляем статистику
+        if bet + win > 0:
+            ledger.credit(c, user_id, bet + win, 'baccarat')
         update_user_stats(conn, user_id, win)
         
         message = (f"🎴 Карты игрока: {player} (сумма: {player_score})\n"
@@ -1115,6 +1108,7 @@ def cmd_baccarat(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('crash', cost=COST_GAME)
 def cmd_crash(vk, event, args):
     """Игра Crash - растущий множитель, нужно успеть забрать выигрыш"""
     if not args:
@@ -1128,15 +1122,13 @@ def cmd_crash(vk, event, args):
         validate_bet(bet, min_bet=50, max_bet=50000)
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         if action == 'start':
-            # Проверяем баланс
-            c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-            balance = c.fetchone()
-            
-            if not balance or balance[0] < bet:
+            # Списываем ставку, только если монет достаточно
+            if ledger.debit(c, user_id, bet, 'crash') is None:
+                conn.close()
                 return "❌ Недостаточно монет"
             
             # Генерируем точку краха (1.0 - 10.0)
@@ -1154,10 +1146,6 @@ def cmd_crash(vk, event, args):
                        VALUES (?, 'crash', ?, ?)""",
                        (user_id, json.dumps(game_state), datetime.now()))
             
-            # Списываем ставку
-            c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?',
-                     (bet, user_id))
-            
             conn.commit()
             return f"📈 Игра началась!\nСтавка: {bet} монет\nТекущий множитель: 1.00x\nИспользуйте /crash [ставка] cashout чтобы забрать выигрыш"
             
@@ -1184,8 +1172,7 @@ def cmd_crash(vk, event, args):
             
             # Успешный вывод
             win = int(bet * current_multiplier)
-            c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                     (win, user_id))
+            ledger.credit(c, user_id, win, 'crash')
             update_user_stats(conn, user_id, win - bet)
             
             # Удаляем состояние игры
@@ -1207,6 +1194,7 @@ def cmd_crash(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('mines', cost=COST_GAME)
 def cmd_mines(vk, event, args):
     """Игра Mines - выбирайте клетки и не попадите на мину"""
     if not args:
@@ -1220,15 +1208,13 @@ def cmd_mines(vk, event, args):
         validate_bet(bet, min_bet=50, max_bet=50000)
         
         user_id = event.obj.message['from_id']
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         if action == 'start':
-            # Проверяем баланс
-            c.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-            balance = c.fetchone()
-            
-            if not balance or balance[0] < bet:
+            # Списываем ставку, только если монет достаточно
+            if ledger.debit(c, user_id, bet, 'mines') is None:
+                conn.close()
                 return "❌ Недостаточно монет"
             
             # Создаем поле 5x5 с 5 минами
@@ -1250,10 +1236,6 @@ def cmd_mines(vk, event, args):
                        VALUES (?, 'mines', ?, ?)""",
                        (user_id, json.dumps(game_state), datetime.now()))
             
-            # Списываем ставку
-            c.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?',
-                     (bet, user_id))
-            
             # Формируем отображение поля
             display = ['❓'] * 25
             field_display = '\n'.join(' '.join(display[i:i+5]) for i in range(0, 25, 5))
@@ -1334,8 +1316,7 @@ def cmd_mines(vk, event, args):
             win = int(bet * game_state['multiplier'])
             
             # Обновляем баланс и статистику
-            c.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?',
-                     (win, user_id))
+            ledger.credit(c, user_id, win, 'mines')
             update_user_stats(conn, user_id, win - bet)
             
             # Удаляем состояние игры
@@ -0,0 +1,208 @@
+import os
+import re
+import sqlite3
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from database import DATABASE_PATH, DATABASE_TIMEOUT, open_connection
+from query_profiler import ProfiledConnection
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Сколько дней история сообщений хранится в основной базе
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', '30'))
+# archive - переносить старую историю в помесячные файлы, delete - удалять
+HISTORY_MODE = os.getenv('HISTORY_MODE', 'archive')
+# Каталог помесячных архивов (по умолчанию рядом с базой)
+HISTORY_ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR',
+                                os.path.join(os.path.dirname(DATABASE_PATH) or '.', 'archive'))
+
+# Основная база + не больше 9 архивов (лимит ATTACH в SQLite по умолчанию - 10)
+MAX_ATTACHED_MONTHS = 9
+
+ARCHIVE_PATTERN = re.compile(r'^message_history_(\d{4})_(\d{2})\.db$')
+
+
+def archive_path(month):
+    """Файл архива для месяца 'YYYY-MM'"""
+    return os.path.join(HISTORY_ARCHIVE_DIR, f"message_history_{month.replace('-', '_')}.db")
+
+
+def archived_months():
+    """Месяцы 'YYYY-MM', для которых есть архивы, по возрастанию"""
+    if not os.path.isdir(HISTORY_ARCHIVE_DIR):
+        return []
+    months = []
+    for name in os.listdir(HISTORY_ARCHIVE_DIR):
+        match = ARCHIVE_PATTERN.match(name)
+        if match:
+            months.append(f"{match.group(1)}-{match.group(2)}")
+    return sorted(months)
+
+
+def month_bounds(month):
+    """Начало месяца и начало следующего месяца в формате меток времени истории"""
+    start = datetime.strptime(month, '%Y-%m')
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+def retention_cutoff(now=None):
+    """Метка времени, старше которой история не хранится в основной базе"""
+    now = now or datetime.now()
+    return (now - timedelta(days=HISTORY_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _create_archive_table(c, schema):
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema}.message_history
+                (id INTEGER PRIMARY KEY,
+                 user_id INTEGER,
+                 chat_id INTEGER,
+                 message_type TEXT,
+                 timestamp TIMESTAMP)''')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_user ON message_history(user_id, timestamp)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_chat ON message_history(chat_id, timestamp)')
+
+
+def compact_archive(path):
+    """Сжать файл архива (после переноса он больше не изменяется)"""
+    conn = sqlite3.connect(path, timeout=DATABASE_TIMEOUT, factory=ProfiledConnection)
+    try:
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+def archive_old_history(now=None):
+    """
+    Перенести историю сообщений старше HISTORY_RETENTION_DAYS в помесячные
+    файлы archive/message_history_YYYY_MM.db. Каждый месяц переносится своей
+    транзакцией: строки копируются в подключенный (ATTACH) архив и удаляются
+    из основной базы. Возвращает {месяц: число перенесенных строк}.
+    """
+    cutoff = retention_cutoff(now)
+    os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+
+    moved = {}
+    # Отдельное соединение: ATTACH не должен оставаться на соединениях пула
+    conn = open_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT DISTINCT strftime('%Y-%m', timestamp) FROM message_history
+                    WHERE timestamp < ?''', (cutoff,))
+        months = sorted(row[0] for row in c.fetchall() if row[0])
+
+        for month in months:
+            start, end = month_bounds(month)
+            end = min(end, cutoff)
+            path = archive_path(month)
+            c.execute('ATTACH DATABASE ? AS archive', (path,))
+            try:
+                _create_archive_table(c, 'archive')
+                c.execute('BEGIN IMMEDIATE')
+                c.execute('''INSERT OR IGNORE INTO archive.message_history
+                            (id, user_id, chat_id, message_type, timestamp)
+                            SELECT id, user_id, chat_id, message_type, timestamp
+                            FROM main.message_history
+                            WHERE timestamp >= ? AND timestamp < ?''', (start, end))
+                c.execute('''DELETE FROM main.message_history
+                            WHERE timestamp >= ? AND timestamp < ?''', (start, end))
+                moved[month] = c.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                c.execute('DETACH DATABASE archive')
+            compact_archive(path)
+
+        if moved:
+            logger.info("История сообщений перенесена в архив: " +
+                        ", ".join(f"{month} - {count}" for month, count in moved.items()))
+        return moved
+    finally:
+        conn.close()
+
+
+def archived_counts():
+    """
+    Количество сообщений во всех архивах: ({(chat_id, user_id): число},
+    {user_id: число}). Во втором счетчике учтены и сообщения без беседы.
+    Архивы читаются по одному, поэтому их число не ограничено лимитом ATTACH.
+    """
+    chat_counts = Counter()
+    user_counts = Counter()
+    for month in archived_months():
+        conn = sqlite3.connect(f'file:{archive_path(month)}?mode=ro', uri=True, timeout=DATABASE_TIMEOUT)
+        try:
+            rows = conn.execute('''SELECT chat_id, user_id, COUNT(*) FROM message_history
+                                   WHERE user_id IS NOT NULL
+                                   GROUP BY chat_id, user_id''')
+            for chat_id, user_id, count in rows:
+                user_counts[user_id] += count
+                if chat_id is not None:
+                    chat_counts[(chat_id, user_id)] += count
+        finally:
+            conn.close()
+    return chat_counts, user_counts
+
+
+def cleanup_history(now=None):
+    """Убрать из основной базы историю старше срока хранения (в архив или удалением)"""
+    if HISTORY_MODE == 'archive':
+        return sum(archive_old_history(now).values())
+
+    conn = open_connection()
+    try:
+        with conn:
+            cursor = conn.execute('DELETE FROM message_history WHERE timestamp < ?',
+                                  (retention_cutoff(now),))
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+@contextmanager
+def history_with_archive(since=None):
+    """
+    Курсор, в котором представление all_message_history объединяет основную
+    историю с архивами месяцев, начиная с since (по умолчанию - последние 9):
+
+        with history_with_archive(datetime.now() - timedelta(days=90)) as c:
+            c.execute('SELECT COUNT(*) FROM all_message_history WHERE user_id = ?', (user_id,))
+
+    Архивы подключаются через ATTACH только на время блока.
+    """
+    months = archived_months()
+    if since is not None:
+        months = [month for month in months if month >= since.strftime('%Y-%m')]
+    months = months[-MAX_ATTACHED_MONTHS:]
+
+    conn = open_connection()
+    try:
+        c = conn.cursor()
+        sources = ['SELECT id, user_id, chat_id, message_type, timestamp FROM main.message_history']
+        for index, month in enumerate(months):
+            schema = f'archive_{index}'
+            c.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path(month),))
+            sources.append(f'SELECT id, user_id, chat_id, message_type, timestamp FROM {schema}.message_history')
+        c.execute('CREATE TEMP VIEW all_message_history AS ' + ' UNION ALL '.join(sources))
+        yield c
+    finally:
+        conn.close()
+
+
+def user_history_by_month(user_id, months=6):
+    """Количество сообщений пользователя по месяцам и беседам, включая архив"""
+    now = datetime.now()
+    first_month = now.year * 12 + now.month - 1 - (months - 1)
+    since = datetime(first_month // 12, first_month % 12 + 1, 1)
+    with history_with_archive(since) as c:
+        c.execute('''SELECT strftime('%Y-%m', timestamp) AS month, chat_id, COUNT(*)
+                    FROM all_message_history
+                    WHERE user_id = ? AND timestamp >= ?
+                    GROUP BY month, chat_id
+                    ORDER BY month DESC, chat_id''', (user_id, since.strftime('%Y-%m-%d')))
+        return c.fetchall()
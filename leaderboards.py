@@ -0,0 +1,286 @@
+import time
+import logging
+import threading
+from bisect import bisect_left, insort
+from database import get_connection, pool
+from user_state import user_state
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Категории топа -> столбец таблицы users
+CATEGORIES = {
+    'level': 'level',
+    'messages': 'messages_count',
+    'balance': 'balance',
+    'rep': 'reputation'
+}
+
+# Размер блока упорядоченного списка (блок делится пополам при 2 * BLOCK_SIZE)
+BLOCK_SIZE = 500
+
+
+class RankedList:
+    """
+    Упорядоченный список ключей с поиском позиции за O(log n).
+
+    Ключи хранятся в отсортированных блоках: вставка и удаление - bisect по
+    максимумам блоков и сдвиг внутри одного блока. Размеры блоков хранит
+    дерево Фенвика, поэтому позиция ключа - сумма размеров предыдущих блоков
+    плюс bisect в его блоке. Дерево перестраивается только при делении или
+    удалении блока.
+    """
+
+    def __init__(self, keys=(), block_size=BLOCK_SIZE):
+        """keys должны быть отсортированы"""
+        self.block_size = block_size
+        self.blocks = [list(keys[i:i + block_size]) for i in range(0, len(keys), block_size)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(keys)
+        self._build_tree()
+
+    def __len__(self):
+        return self.size
+
+    def _build_tree(self):
+        tree = [len(block) for block in self.blocks]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def _tree_add(self, position, delta):
+        tree = self.tree
+        while position < len(tree):
+            tree[position] += delta
+            position |= position + 1
+
+    def _count_before(self, position):
+        """Число ключей в блоках до position"""
+        total = 0
+        position -= 1
+        while position >= 0:
+            total += self.tree[position]
+            position = (position & (position + 1)) - 1
+        return total
+
+    def add(self, key):
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            self.size = 1
+            self._build_tree()
+            return
+
+        position = bisect_left(self.maxes, key)
+        if position == len(self.blocks):
+            position -= 1
+        block = self.blocks[position]
+        insort(block, key)
+        self.maxes[position] = block[-1]
+        self.size += 1
+
+        if len(block) > 2 * self.block_size:
+            half = len(block) // 2
+            self.blocks[position:position + 1] = [block[:half], block[half:]]
+            self.maxes[position:position + 1] = [block[half - 1], block[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(position, 1)
+
+    def remove(self, key):
+        position = bisect_left(self.maxes, key)
+        if position == len(self.blocks):
+            raise KeyError(key)
+        block = self.blocks[position]
+        index = bisect_left(block, key)
+        if index == len(block) or block[index] != key:
+            raise KeyError(key)
+        del block[index]
+        self.size -= 1
+
+        if block:
+            self.maxes[position] = block[-1]
+            self._tree_add(position, -1)
+        else:
+            del self.blocks[position]
+            del self.maxes[position]
+            self._build_tree()
+
+    def index(self, key):
+        """Позиция ключа (с нуля) или None, если его нет"""
+        position = bisect_left(self.maxes, key)
+        if position == len(self.blocks):
+            return None
+        block = self.blocks[position]
+        index = bisect_left(block, key)
+        if index == len(block) or block[index] != key:
+            return None
+        return self._count_before(position) + index
+
+    def first(self, count):
+        """Первые count ключей"""
+        keys = []
+        for block in self.blocks:
+            keys.extend(block[:count - len(keys)])
+            if len(keys) >= count:
+                break
+        return keys
+
+
+class Leaderboard:
+    """Пользователи, упорядоченные по убыванию значения (при равенстве - по user_id)"""
+
+    def __init__(self, values=None):
+        # user_id -> значение
+        self.values = dict(values or {})
+        self.keys = RankedList(sorted((-value, user_id) for user_id, value in self.values.items()))
+
+    def __len__(self):
+        return len(self.values)
+
+    def set(self, user_id, value):
+        old = self.values.get(user_id)
+        if old == value:
+            return
+        if old is not None:
+            self.keys.remove((-old, user_id))
+        self.values[user_id] = value
+        self.keys.add((-value, user_id))
+
+    def add(self, user_id, delta):
+        self.set(user_id, self.values.get(user_id, 0) + delta)
+
+    def top(self, limit):
+        """[(user_id, значение)] первых limit пользователей"""
+        return [(user_id, -value) for value, user_id in self.keys.first(limit)]
+
+    def rank(self, user_id):
+        """(место с единицы, значение) или None, если пользователя нет"""
+        value = self.values.get(user_id)
+        if value is None:
+            return None
+        return self.keys.index((-value, user_id)) + 1, value
+
+
+class Leaderboards:
+    """
+    Топы пользователей по уровню, сообщениям, балансу и репутации в памяти.
+
+    Загружаются одним запросом при запуске, дальше обновляются вместе с
+    записями: уровень и баланс - из строк, которые пишутся через кэш
+    состояния (user_state), сообщения - после записи буфера, репутация - в
+    /rep. Топ и место пользователя читаются без обращения к базе. Массовые
+    изменения в обход этих путей и откаты транзакций вызывают invalidate():
+    топы перечитываются из базы при следующем обращении.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.boards = {category: Leaderboard() for category in CATEGORIES}
+        self.loaded = False
+        self.loads = 0
+        self.load_time = 0.0
+        self.updates = 0
+        self.reads = 0
+        pool.add_rollback_listener(self.invalidate)
+        user_state.add_listener(self._state_stored)
+
+    def load_all(self):
+        """Загрузить значения всех пользователей одним запросом"""
+        # Под блокировкой: изменения, пришедшие во время загрузки, не потеряются
+        with self.lock:
+            started = time.perf_counter()
+            try:
+                conn = get_connection()
+                try:
+                    c = conn.cursor()
+                    c.execute(f'SELECT user_id, {", ".join(CATEGORIES.values())} FROM users')
+                    rows = c.fetchall()
+                finally:
+                    conn.close()
+            except Exception as e:
+                log_error(f"Ошибка при загрузке топов: {str(e)}", exc_info=True)
+                return 0
+
+            for position, category in enumerate(CATEGORIES, 1):
+                self.boards[category] = Leaderboard({row[0]: row[position] or 0 for row in rows})
+            self.loaded = True
+            self.loads += 1
+            self.load_time = time.perf_counter() - started
+        logger.info(f"Топы загружены: {len(rows)} пользователей за {self.load_time * 1000:.0f} мс")
+        return len(rows)
+
+    def invalidate(self):
+        """Перечитать топы из базы при следующем обращении"""
+        self.loaded = False
+
+    def set(self, user_id, **values):
+        """Новые значения пользователя: set(user_id, balance=100, rep=3)"""
+        with self.lock:
+            if not self.loaded:
+                return
+            self.updates += 1
+            for category, value in values.items():
+                self._board(category, user_id).set(user_id, value or 0)
+
+    def add_messages(self, counts):
+        """Прибавить записанные сообщения: {user_id: количество}"""
+        with self.lock:
+            if not self.loaded:
+                return
+            self.updates += 1
+            for user_id, count in counts.items():
+                self._board('messages', user_id).add(user_id, count)
+
+    def reset(self, user_ids):
+        """Статистика пользователей сброшена (уровень 1, остальное - 0)"""
+        for user_id in user_ids:
+            self.set(user_id, level=1, messages=0, balance=0, rep=0)
+
+    def _board(self, category, user_id):
+        if user_id not in self.boards[category].values:
+            # Новый пользователь попадает во все топы с нулевыми значениями
+            for other, board in self.boards.items():
+                if other != category and user_id not in board.values:
+                    board.set(user_id, 1 if other == 'level' else 0)
+        return self.boards[category]
+
+    def _state_stored(self, user_id, state):
+        if state is not None:
+            self.set(user_id, level=state.level, balance=state.balance)
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load_all()
+
+    def top(self, category, limit=10):
+        """[(user_id, значение)] первых limit пользователей категории"""
+        self._ensure_loaded()
+        with self.lock:
+            self.reads += 1
+            return self.boards[category].top(limit)
+
+    def rank(self, category, user_id):
+        """(место, значение) пользователя в категории или None"""
+        self._ensure_loaded()
+        with self.lock:
+            self.reads += 1
+            return self.boards[category].rank(user_id)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'loaded': self.loaded,
+                'users': len(self.boards['level']),
+                'loads': self.loads,
+                'load_ms': self.load_time * 1000,
+                'updates': self.updates,
+                'reads': self.reads
+            }
+
+
+# Создаем глобальные топы пользователей
+leaderboards = Leaderboards()
@@ -0,0 +1,126 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from user_state import user_state, STATE_COLUMNS
+from leaderboards import leaderboards
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Сколько дней хранятся записи журнала баланса
+LEDGER_DAYS = 90
+
+
+class BalanceLedger:
+    """
+    Все изменения баланса пользователей.
+
+    Списание - один условный запрос UPDATE ... WHERE balance >= ? RETURNING:
+    проверка и изменение баланса выполняются атомарно, поэтому параллельные
+    команды не могут дважды потратить одни и те же монеты или увести баланс
+    в минус. Каждое изменение записывается в balance_ledger (сумма, баланс
+    после изменения, причина) в транзакции курсора c вызывающего, новое
+    состояние строки кладется в кэш user_state.
+
+    Игры сначала списывают ставку, затем зачисляют ставку вместе с выигрышем.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.debits = 0
+        self.credits = 0
+        self.declined = 0
+
+    def debit(self, c, user_id, amount, reason):
+        """Списать amount, если монет достаточно. Новый баланс или None"""
+        began = not c.connection.in_transaction
+        c.execute(f'''UPDATE users SET balance = balance - ?
+                    WHERE user_id = ? AND balance >= ?
+                    RETURNING {STATE_COLUMNS}''', (amount, user_id, amount))
+        row = c.fetchone()
+        if row is None:
+            if began:
+                # Запрос ничего не изменил: завершаем открытую им транзакцию,
+                # чтобы пул не считал ее брошенной и не сбрасывал кэши
+                c.connection.rollback()
+            # Баланс в кэше мог быть устаревшим
+            user_state.invalidate(user_id)
+            with self.lock:
+                self.declined += 1
+            return None
+        with self.lock:
+            self.debits += 1
+        return self._record(c, user_id, -amount, row, reason)
+
+    def credit(self, c, user_id, amount, reason):
+        """Зачислить amount. Новый баланс или None, если пользователя нет в базе"""
+        c.execute(f'''UPDATE users SET balance = balance + ? WHERE user_id = ?
+                    RETURNING {STATE_COLUMNS}''', (amount, user_id))
+        row = c.fetchone()
+        if row is None:
+            user_state.invalidate(user_id)
+            return None
+        with self.lock:
+            self.credits += 1
+        return self._record(c, user_id, amount, row, reason)
+
+    def stake(self, c, user_ids, amount, reason):
+        """
+        Списать ставку amount с каждого из user_ids: со всех или ни с кого.
+        Возвращает None или user_id, у которого не хватило монет.
+        """
+        # Своя транзакция не держит блокировку записи после отказа
+        began = not c.connection.in_transaction
+        if began:
+            c.execute('BEGIN IMMEDIATE')
+        c.execute('SAVEPOINT ledger_stake')
+        for user_id in user_ids:
+            if self.debit(c, user_id, amount, reason) is None:
+                if began:
+                    c.execute('ROLLBACK')
+                else:
+                    c.execute('ROLLBACK TO ledger_stake')
+                    c.execute('RELEASE ledger_stake')
+                # Кэш и топы уже получили отмененные списания
+                for other_id in user_ids:
+                    user_state.invalidate(other_id)
+                leaderboards.invalidate()
+                return user_id
+        c.execute('RELEASE ledger_stake')
+        return None
+
+    def transfer(self, c, from_id, to_id, amount, reason):
+        """
+        Перевести amount от from_id к to_id (получатель создается при необходимости).
+        Новый баланс отправителя или None, если монет не хватает.
+        """
+        balance = self.debit(c, from_id, amount, reason)
+        if balance is None:
+            return None
+        c.execute('INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)', (to_id,))
+        self.credit(c, to_id, amount, reason)
+        return balance
+
+    def _record(self, c, user_id, amount, row, reason):
+        balance = user_state.store(user_id, row).balance
+        c.execute('''INSERT INTO balance_ledger (user_id, amount, balance, reason, timestamp)
+                    VALUES (?, ?, ?, ?, ?)''', (user_id, amount, balance, reason, datetime.now()))
+        return balance
+
+    def prune(self, c, now=None):
+        """Удалить записи журнала старше LEDGER_DAYS дней. Возвращает число строк"""
+        threshold = (now or datetime.now()) - timedelta(days=LEDGER_DAYS)
+        c.execute('DELETE FROM balance_ledger WHERE timestamp < ?', (threshold,))
+        return c.rowcount
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'debits': self.debits,
+                'credits': self.credits,
+                'declined': self.declined
+            }
+
+
+# Создаем глобальный журнал баланса
+ledger = BalanceLedger()
@@ -1,7 +1,10 @@
 import threading
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from database import db
+from db_writer import db_writer
+from cleanup import expire_restrictions
+from history_archive import cleanup_history
 from logger import log_error
 import logging
 
@@ -11,22 +14,11 @@ logger = logging.getLogger('bot')
 def cleanup_old_data():
     """Очистка старых данных"""
     try:
-        # Удаляем сообщения старше 30 дней
-        thirty_days_ago = datetime.now() - timedelta(days=30)
-        db.execute('''DELETE FROM message_history 
-                     WHERE timestamp < ?''', (thirty_days_ago,))
+        # Переносим в помесячный архив (или удаляем) сообщения старше 30 дней
+        cleanup_history()
         
-        # Удаляем истекшие муты
-        db.execute('''UPDATE users 
-                     SET is_muted = 0, mute_end = NULL 
-                     WHERE is_muted = 1 AND mute_end < ?''', 
-                     (datetime.now(),))
-        
-        # Удаляем истекший режим тишины
-        db.execute('''UPDATE chat_settings 
-                     SET quiet_mode = 0, quiet_end = NULL 
-                     WHERE quiet_mode = 1 AND quiet_end < ?''',
-                     (datetime.now(),))
+        # Удаляем истекшие муты и режим тишины
+        db_writer.call(expire_restrictions, datetime.now())
         
         logger.info("Очистка старых данных выполнена успешно")
     except Exception as e:
@@ -37,6 +29,8 @@ def optimize_database():
     try:
         db.execute('VACUUM')
         db.execute('ANALYZE')
+        # Переносим журнал WAL в базу и обрезаем его файл
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         logger.info("Оптимизация базы данных выполнена успешно")
     except Exception as e:
         log_error(f"Ошибка при оптимизации базы данных: {str(e)}", exc_info=True)
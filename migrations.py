@@ -0,0 +1,689 @@
+import time
+import json
+import logging
+import threading
+from datetime import datetime
+from database import get_connection, open_connection
+import activity_rollups
+from history_archive import HISTORY_MODE, archived_counts
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Пользователей в одной порции фоновой миграции
+BACKFILL_CHUNK = 200
+# Пауза между порциями: дает буферу записи получить блокировку
+CHUNK_PAUSE = 0.05
+
+# Границы диапазонов user_id
+MIN_ID = -2 ** 63
+MAX_ID = 2 ** 63 - 1
+
+
+class Migration:
+    """Шаг изменения схемы с номером версии (PRAGMA user_version после него)"""
+
+    __slots__ = ('version', 'description', 'func', 'background')
+
+    def __init__(self, version, description, func, background):
+        self.version = version
+        self.description = description
+        self.func = func
+        self.background = background
+
+
+# Миграции по возрастанию версии
+MIGRATIONS = []
+
+
+def migration(version, description, background=False):
+    """
+    Зарегистрировать миграцию. Функция получает курсор и выполняется в одной
+    транзакции с установкой user_version.
+
+    Долгая миграция (background=True) - функция func(c, position), которая
+    обрабатывает одну порцию данных и возвращает позицию следующей порции
+    (значение, сохраняемое в JSON) или None, когда работа закончена. Каждая
+    порция выполняется в своей короткой транзакции вместе с сохранением
+    позиции в migration_jobs, поэтому миграция не держит блокировку записи
+    дольше одной порции и после перезапуска продолжается с места остановки.
+    Номер долгой миграции засчитывается сразу, а ее порции выполняются после
+    всех обычных миграций (в том числе объявленных позже) в фоновом потоке
+    после запуска бота. Поэтому долгие миграции только переносят данные, а
+    код должен работать, пока они не закончены.
+    """
+    def decorator(func):
+        if MIGRATIONS and MIGRATIONS[-1].version >= version:
+            raise ValueError(f"Миграция {version} объявлена после {MIGRATIONS[-1].version}")
+        MIGRATIONS.append(Migration(version, description, func, background))
+        return func
+    return decorator
+
+
+def add_column(c, table, column, definition):
+    """Добавить столбец, если его еще нет"""
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in {row[1] for row in c.fetchall()}:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def next_user_bound(c, after):
+    """Наибольший user_id следующей порции пользователей после after или None"""
+    c.execute('''SELECT MAX(user_id) FROM
+                    (SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?)''',
+              (after, BACKFILL_CHUNK))
+    return c.fetchone()[0]
+
+
+def rebuild_message_counters(c):
+    """
+    Пересчитать счетчики сообщений по истории: основной таблице
+    message_history и помесячным архивам. Счетчики - итоги за все время,
+    поэтому при HISTORY_MODE=delete, когда старая история удаляется,
+    пересчет только уменьшил бы их и не выполняется (RuntimeError).
+    """
+    if HISTORY_MODE == 'delete':
+        raise RuntimeError("при HISTORY_MODE=delete старые сообщения удаляются, "
+                           "пересчет по оставшейся истории уменьшил бы счетчики")
+    c.execute('DELETE FROM chat_message_counts')
+    # Архивы читаются после начала транзакции записи: перенос истории
+    # в архив ждет ее завершения и не сдвинет строки между подсчетами
+    chat_counts, user_counts = archived_counts()
+    c.execute('''INSERT INTO chat_message_counts (chat_id, user_id, messages_count)
+                SELECT chat_id, user_id, COUNT(*) FROM message_history
+                WHERE chat_id IS NOT NULL AND user_id IS NOT NULL
+                GROUP BY chat_id, user_id''')
+    c.executemany('''INSERT INTO chat_message_counts (chat_id, user_id, messages_count)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(chat_id, user_id) DO UPDATE
+                    SET messages_count = messages_count + excluded.messages_count''',
+                  [(chat_id, user_id, count) for (chat_id, user_id), count in chat_counts.items()])
+    c.execute('''UPDATE users SET messages_count = COALESCE(
+                    (SELECT COUNT(*) FROM message_history
+                     WHERE message_history.user_id = users.user_id), 0)''')
+    c.executemany('UPDATE users SET messages_count = messages_count + ? WHERE user_id = ?',
+                  [(count, user_id) for user_id, count in user_counts.items()])
+    c.execute('SELECT COUNT(*) FROM chat_message_counts')
+    return c.fetchone()[0]
+
+
+@migration(1, "Базовая схема")
+def base_schema(c):
+    # Схема, которую раньше при каждом запуске создавали init_db(),
+    # Database.init_database() и update_database(). Все шаги идемпотентны,
+    # поэтому миграция безопасна для баз любой из прежних версий
+    c.execute('DROP TRIGGER IF EXISTS update_messages_count')
+    c.execute('DROP TRIGGER IF EXISTS update_user_activity')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                (user_id INTEGER PRIMARY KEY,
+                 role TEXT DEFAULT 'user',
+                 messages_count INTEGER DEFAULT 0,
+                 level INTEGER DEFAULT 1,
+                 xp INTEGER DEFAULT 0,
+                 balance INTEGER DEFAULT 0,
+                 reputation INTEGER DEFAULT 0,
+                 warnings INTEGER DEFAULT 0,
+                 is_muted INTEGER DEFAULT 0,
+                 mute_end TIMESTAMP,
+                 last_daily TIMESTAMP,
+                 nickname TEXT,
+                 reg_date TIMESTAMP,
+                 invited_count INTEGER DEFAULT 0,
+                 last_activity TIMESTAMP,
+                 last_bug_report TIMESTAMP)''')
+
+    # Столбцы, добавленные в уже существующие базы
+    add_column(c, 'users', 'reg_date', 'TIMESTAMP')
+    add_column(c, 'users', 'invited_count', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'last_activity', 'TIMESTAMP')
+    add_column(c, 'users', 'last_bug_report', 'TIMESTAMP')
+    # Статистика игр
+    add_column(c, 'users', 'games_won', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'games_lost', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'total_winnings', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'total_losses', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'tournament_points', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'last_tournament_reward', 'TIMESTAMP')
+    add_column(c, 'users', 'jackpot_wins', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'poker_wins', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'biggest_win', 'INTEGER DEFAULT 0')
+
+    # Браки больше не пересоздаются при запуске
+    c.execute('''CREATE TABLE IF NOT EXISTS marriages
+                (user1_id INTEGER,
+                 user2_id INTEGER,
+                 marriage_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (user1_id) REFERENCES users(user_id),
+                 FOREIGN KEY (user2_id) REFERENCES users(user_id),
+                 PRIMARY KEY (user1_id, user2_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS bans
+                (user_id INTEGER,
+                 chat_id INTEGER,
+                 ban_time TIMESTAMP,
+                 PRIMARY KEY (user_id, chat_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS warn_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 warned_by INTEGER,
+                 reason TEXT,
+                 timestamp TIMESTAMP)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS message_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 chat_id INTEGER,
+                 message_type TEXT,
+                 timestamp TIMESTAMP,
+                 FOREIGN KEY (user_id) REFERENCES users(user_id),
+                 FOREIGN KEY (chat_id) REFERENCES bot_chats(chat_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_settings
+                (chat_id INTEGER PRIMARY KEY,
+                 quiet_mode INTEGER DEFAULT 0,
+                 quiet_end TIMESTAMP,
+                 welcome_message TEXT,
+                 auto_warn INTEGER DEFAULT 0,
+                 max_warnings INTEGER DEFAULT 3)''')
+    add_column(c, 'chat_settings', 'antispam_enabled', 'INTEGER DEFAULT 0')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS bot_chats
+                (chat_id INTEGER PRIMARY KEY,
+                 join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 is_active INTEGER DEFAULT 1)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS word_filters
+                (chat_id INTEGER,
+                 word TEXT,
+                 added_by INTEGER,
+                 added_time TIMESTAMP,
+                 PRIMARY KEY (chat_id, word))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS automod_settings
+                (chat_id INTEGER PRIMARY KEY,
+                 spam_filter INTEGER DEFAULT 0,
+                 caps_filter INTEGER DEFAULT 0,
+                 links_filter INTEGER DEFAULT 0,
+                 max_warns INTEGER DEFAULT 3,
+                 action TEXT DEFAULT 'warn')''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS bug_reports
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 description TEXT,
+                 status TEXT DEFAULT 'new',
+                 report_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+    add_column(c, 'bug_reports', 'status', "TEXT DEFAULT 'new'")
+
+    # Настройки и начальные значения для игр
+    c.execute('''CREATE TABLE IF NOT EXISTS settings
+                (key TEXT PRIMARY KEY,
+                 value TEXT)''')
+    c.executemany('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', [
+        ('lottery_jackpot', '1000'),
+        ('jackpot_bank', '0'),
+        ('tournament_end', None),
+        ('tournament_players', '{}'),
+        ('poker_rake', '5'),
+        ('slots_jackpot', '10000')
+    ])
+
+    c.execute('''CREATE TABLE IF NOT EXISTS tournament_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 tournament_date DATE,
+                 place INTEGER,
+                 points INTEGER,
+                 reward INTEGER,
+                 FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS jackpot_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 amount INTEGER,
+                 timestamp TIMESTAMP,
+                 game_type TEXT,
+                 FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS poker_tournaments
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 start_time TIMESTAMP,
+                 end_time TIMESTAMP,
+                 buy_in INTEGER,
+                 prize_pool INTEGER,
+                 max_players INTEGER,
+                 status TEXT DEFAULT 'pending')''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS poker_tournament_players
+                (tournament_id INTEGER,
+                 user_id INTEGER,
+                 position INTEGER,
+                 prize INTEGER,
+                 FOREIGN KEY (tournament_id) REFERENCES poker_tournaments(id),
+                 FOREIGN KEY (user_id) REFERENCES users(user_id),
+                 PRIMARY KEY (tournament_id, user_id))''')
+
+    # Достижения
+    c.execute('''CREATE TABLE IF NOT EXISTS achievements
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 type TEXT,
+                 earned_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (user_id) REFERENCES users(user_id),
+                 FOREIGN KEY (type) REFERENCES achievement_types(type))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS achievement_types
+                (type TEXT PRIMARY KEY,
+                 description TEXT)''')
+    c.executemany('INSERT OR IGNORE INTO achievement_types (type, description) VALUES (?, ?)', [
+        ('🎰 Миллионер', 'Накопить 1,000,000 монет'),
+        ('💎 Крупный выигрыш', 'Выиграть 100,000 монет за раз'),
+        ('🏆 Профессиональный игрок', 'Выиграть 100 игр'),
+        ('👑 Легенда казино', 'Накопить 5,000,000 монет'),
+        ('🌟 Джекпот', 'Выиграть 500,000 монет за раз'),
+        ('🎲 Заядлый игрок', 'Сыграть 1,000 игр'),
+        ('♠️ Покерный профи', 'Выиграть 50 раз в покер'),
+        ('💰 Везунчик', 'Выиграть джекпот 3 раза'),
+        ('🏅 Турнирный боец', 'Занять первое место в 5 турнирах'),
+        ('💬 Общительный', 'Написать 1,000 сообщений'),
+        ('⭐ Популярный', 'Получить 50 очков репутации'),
+        ('🤝 Дружелюбный', 'Повысить репутацию 20 пользователям'),
+        ('📈 Прогресс', 'Достичь 10 уровня'),
+        ('🎯 Целеустремленный', 'Достичь 25 уровня'),
+        ('🌟 Легенда', 'Достичь 50 уровня')
+    ])
+
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_stats
+                (chat_id INTEGER PRIMARY KEY,
+                 messages_today INTEGER DEFAULT 0,
+                 active_users_today INTEGER DEFAULT 0,
+                 last_update TIMESTAMP,
+                 FOREIGN KEY (chat_id) REFERENCES bot_chats(chat_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS moderation_logs
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 moderator_id INTEGER,
+                 action TEXT,
+                 target_id INTEGER,
+                 chat_id INTEGER,
+                 reason TEXT,
+                 timestamp TIMESTAMP,
+                 FOREIGN KEY (moderator_id) REFERENCES users(user_id),
+                 FOREIGN KEY (chat_id) REFERENCES bot_chats(chat_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS antispam_settings
+                (chat_id INTEGER PRIMARY KEY,
+                 message_interval REAL DEFAULT 1.0,
+                 max_messages INTEGER DEFAULT 5,
+                 check_period INTEGER DEFAULT 10,
+                 max_warnings INTEGER DEFAULT 3,
+                 mute_duration INTEGER DEFAULT 300,
+                 max_similar_messages INTEGER DEFAULT 3,
+                 similarity_threshold REAL DEFAULT 0.85,
+                 FOREIGN KEY (chat_id) REFERENCES bot_chats(chat_id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS reputation_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 from_user_id INTEGER,
+                 to_user_id INTEGER,
+                 amount INTEGER,
+                 reason TEXT,
+                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (from_user_id) REFERENCES users(user_id),
+                 FOREIGN KEY (to_user_id) REFERENCES users(user_id))''')
+
+    # Индексы
+    c.execute('CREATE INDEX IF NOT EXISTS idx_marriages_users ON marriages(user1_id, user2_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_achievements_user ON achievements(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bug_reports_user ON bug_reports(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bug_reports_status ON bug_reports(status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_history_user ON message_history(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_history_chat ON message_history(chat_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_history_time ON message_history(timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_history_user_chat ON message_history(user_id, chat_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bans_user ON bans(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bans_chat ON bans(chat_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_warn_history_user ON warn_history(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reputation_history_timestamp ON reputation_history(timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reputation_history_users ON reputation_history(from_user_id, to_user_id)')
+
+    # В пустой базе сразу назначаем администратора
+    c.execute('SELECT COUNT(*) FROM users')
+    if c.fetchone()[0] == 0:
+        logger.info("База данных пуста. Создан администратор по умолчанию.")
+        c.execute('INSERT INTO users (user_id, role, reg_date) VALUES (?, ?, ?)',
+                  (694099447, 'admin', datetime.now()))
+
+
+@migration(2, "Счетчики сообщений и сводки активности")
+def counters_and_rollups(c):
+    # Счетчики сообщений по беседам; users.messages_count - сумма по всем беседам
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_message_counts
+                (chat_id INTEGER,
+                 user_id INTEGER,
+                 messages_count INTEGER DEFAULT 0,
+                 PRIMARY KEY (chat_id, user_id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_message_counts_user ON chat_message_counts(user_id)')
+    # Почасовые и суточные сводки активности бесед
+    activity_rollups.create_tables(c)
+
+
+def fill_missing_fields(c, after):
+    """Порция пользователей с пустыми reg_date и last_activity"""
+    after = MIN_ID if after is None else after
+    upper = next_user_bound(c, after)
+    if upper is None:
+        c.execute('UPDATE chat_settings SET antispam_enabled = 0 WHERE antispam_enabled IS NULL')
+        return None
+    c.execute('''UPDATE users SET reg_date = COALESCE(reg_date, CURRENT_TIMESTAMP),
+                    last_activity = COALESCE(last_activity, ?)
+                WHERE user_id > ? AND user_id <= ?
+                  AND (reg_date IS NULL OR last_activity IS NULL)''',
+              (datetime.now(), after, upper))
+    return upper
+
+
+def rebuild_message_counters_chunk(c, after):
+    """
+    Пересчитать счетчики сообщений порции пользователей по истории.
+    Буфер записи к этому моменту уже может увеличивать счетчики - пересчет
+    в одной транзакции заменяет их значениями по всей истории, включая его
+    записи. Последняя порция не ограничена сверху: в нее попадают сообщения
+    пользователей, которых нет в users.
+    """
+    after = MIN_ID if after is None else after
+    upper = next_user_bound(c, after)
+    high = MAX_ID if upper is None else upper
+    c.execute('DELETE FROM chat_message_counts WHERE user_id > ? AND user_id <= ?', (after, high))
+    c.execute('''INSERT INTO chat_message_counts (chat_id, user_id, messages_count)
+                SELECT chat_id, user_id, COUNT(*) FROM message_history
+                WHERE user_id > ? AND user_id <= ? AND chat_id IS NOT NULL
+                GROUP BY chat_id, user_id''', (after, high))
+    c.execute('''UPDATE users SET messages_count = COALESCE(
+                    (SELECT COUNT(*) FROM message_history
+                     WHERE message_history.user_id = users.user_id), 0)
+                WHERE user_id > ? AND user_id <= ?''', (after, high))
+    return upper
+
+
+# Шаги заполнения по истории: step(c, position) -> позиция или None
+BACKFILL_STEPS = (fill_missing_fields, rebuild_message_counters_chunk, activity_rollups.rebuild_chunk)
+
+
+@migration(3, "Заполнение пустых полей, пересчет счетчиков и сводок по истории", background=True)
+def backfill_history(c, position):
+    # Позиция - [номер шага, позиция внутри шага]
+    step, inner = position or (0, None)
+    inner = BACKFILL_STEPS[step](c, inner)
+    if inner is not None:
+        return [step, inner]
+    if step + 1 < len(BACKFILL_STEPS):
+        return [step + 1, None]
+    return None
+
+
+@migration(4, "Таблицы игр и составные индексы для частых запросов")
+def hot_query_indexes(c):
+    # Состояния и история игр (используются блэкджеком, покером и лимитами игр)
+    c.execute('''CREATE TABLE IF NOT EXISTS game_states
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 game_type TEXT,
+                 state TEXT,
+                 timestamp TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS game_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 game_type TEXT,
+                 amount INTEGER,
+                 timestamp TIMESTAMP)''')
+
+    # Последнее состояние игры пользователя (ORDER BY timestamp DESC LIMIT 1)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_game_states_user_game ON game_states(user_id, game_type, timestamp)')
+    # Лимиты игр: COUNT(*) и MAX(timestamp) за час читаются только из индекса
+    c.execute('CREATE INDEX IF NOT EXISTS idx_game_history_user_game ON game_history(user_id, game_type, timestamp)')
+    # Крупные выигрыши пользователя за час (amount - для покрытия запроса)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jackpot_history_user ON jackpot_history(user_id, timestamp, amount)')
+    # Брак ищется и по второму супругу; по первому работает первичный ключ
+    c.execute('CREATE INDEX IF NOT EXISTS idx_marriages_user2 ON marriages(user2_id, user1_id)')
+    c.execute('DROP INDEX IF EXISTS idx_marriages_users')
+    # Сообщения пользователя в беседе за период; заменяет индексы-префиксы
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_history_user_chat_time ON message_history(user_id, chat_id, timestamp)')
+    c.execute('DROP INDEX IF EXISTS idx_message_history_user_chat')
+    c.execute('DROP INDEX IF EXISTS idx_message_history_user')
+    # Победы в турнирах для достижений
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tournament_history_user ON tournament_history(user_id, place)')
+    # Очистка старых предупреждений
+    c.execute('CREATE INDEX IF NOT EXISTS idx_warn_history_time ON warn_history(timestamp)')
+    # Частичные индексы: в них попадает только небольшая часть пользователей
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_muted ON users(mute_end) WHERE is_muted = 1')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_warned ON users(user_id) WHERE warnings > 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_nickname ON users(nickname) WHERE nickname IS NOT NULL')
+
+
+@migration(5, "Журнал изменений баланса")
+def balance_ledger(c):
+    # Каждое списание и зачисление монет (ledger.py); amount со знаком,
+    # balance - баланс после изменения. Обычная миграция: таблица создается
+    # до запуска бота, даже если перед ней в очереди долгий пересчет
+    c.execute('''CREATE TABLE IF NOT EXISTS balance_ledger
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER NOT NULL,
+                 amount INTEGER NOT NULL,
+                 balance INTEGER NOT NULL,
+                 reason TEXT,
+                 timestamp TIMESTAMP)''')
+    # Очистка старых записей журнала
+    c.execute('CREATE INDEX IF NOT EXISTS idx_balance_ledger_time ON balance_ledger(timestamp)')
+
+
+@migration(6, "Индекс участников бесед")
+def chat_members_index(c):
+    # Участники бесед и время их последней синхронизации с VK (chat_members.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_members
+                (chat_id INTEGER,
+                 user_id INTEGER,
+                 first_name TEXT,
+                 last_name TEXT,
+                 is_admin INTEGER DEFAULT 0,
+                 PRIMARY KEY (chat_id, user_id))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_members_sync
+                (chat_id INTEGER PRIMARY KEY,
+                 synced_at REAL)''')
+    # Беседы пользователя
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members(user_id)')
+
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+class Migrator:
+    """
+    Применение миграций схемы. Номер последней примененной миграции хранится
+    в PRAGMA user_version, поэтому запуск на актуальной схеме - одно чтение
+    заголовка базы. Каждая миграция выполняется в своей транзакции (BEGIN
+    IMMEDIATE) вместе с установкой user_version: прерванная миграция не
+    засчитывается и повторяется при следующем запуске, а второй процесс,
+    дождавшись блокировки, видит, что миграция уже применена. Долгая
+    миграция при применении ставится в очередь migration_jobs, ее порции
+    выполняются после обычных миграций; там же хранится их позиция.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.applied = []
+        self.error = None
+
+    def schema_version(self):
+        """Текущая версия схемы"""
+        conn = get_connection()
+        try:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+
+    def pending_jobs(self):
+        """Долгие миграции, порции которых еще не выполнены"""
+        conn = get_connection()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'migration_jobs'")
+            if c.fetchone() is None:
+                return []
+            c.execute('SELECT version FROM migration_jobs ORDER BY version')
+            versions = {row[0] for row in c.fetchall()}
+        finally:
+            conn.close()
+        return [m for m in MIGRATIONS if m.version in versions]
+
+    def migrate(self, background=True):
+        """
+        Применить недостающие миграции. Обычные миграции применяются сразу,
+        в том числе объявленные после долгих. Порции долгих миграций при
+        background=True выполняются в фоновом потоке, иначе - сразу.
+        Возвращает True, если схема готова к работе.
+        """
+        try:
+            version = self.schema_version()
+            self._apply([m for m in MIGRATIONS if m.version > version])
+            # Схема, от которой зависит код (например, журнал баланса),
+            # должна быть готова до начала обработки событий
+            version = self.schema_version()
+            if version < LATEST_VERSION:
+                raise RuntimeError(f"схема осталась на версии {version} из {LATEST_VERSION}")
+
+            jobs = self.pending_jobs()
+            if jobs and background:
+                self.thread = threading.Thread(target=self._run_deferred, args=(jobs,),
+                                               name='migrations', daemon=True)
+                self.thread.start()
+                logger.info("Долгие миграции выполняются в фоне: " +
+                            ", ".join(str(m.version) for m in jobs))
+            elif jobs:
+                self._run_jobs(jobs)
+            return True
+        except Exception as e:
+            self.error = str(e)
+            log_error(f"Ошибка при обновлении схемы базы данных: {str(e)}", exc_info=True)
+            return False
+
+    def wait(self, timeout=None):
+        """Дождаться завершения фоновых миграций"""
+        if self.thread:
+            self.thread.join(timeout)
+        return self.error is None
+
+    def _apply(self, migrations):
+        if not migrations:
+            return
+        conn = open_connection()
+        try:
+            c = conn.cursor()
+            for item in migrations:
+                started = time.perf_counter()
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    # Другой процесс мог применить миграцию, пока мы ждали блокировку
+                    c.execute('PRAGMA user_version')
+                    if c.fetchone()[0] >= item.version:
+                        conn.rollback()
+                        continue
+                    if item.background:
+                        # Долгая миграция только ставится в очередь: версия
+                        # засчитывается сразу, порции выполнит _run_jobs()
+                        c.execute('''CREATE TABLE IF NOT EXISTS migration_jobs
+                                    (version INTEGER PRIMARY KEY,
+                                     position TEXT,
+                                     chunks INTEGER DEFAULT 0,
+                                     updated TIMESTAMP)''')
+                        c.execute('INSERT OR IGNORE INTO migration_jobs (version, updated) VALUES (?, ?)',
+                                  (item.version, datetime.now()))
+                    else:
+                        item.func(c)
+                    c.execute(f'PRAGMA user_version = {int(item.version)}')
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                if not item.background:
+                    self._applied(item, started)
+        finally:
+            conn.close()
+
+    def _run_jobs(self, jobs):
+        conn = open_connection()
+        try:
+            for item in jobs:
+                started = time.perf_counter()
+                chunks = self._run_chunks(conn, item)
+                if chunks:
+                    self._applied(item, started, f"{chunks} порций")
+        finally:
+            conn.close()
+
+    def _run_chunks(self, conn, item):
+        """Выполнить долгую миграцию порциями. Возвращает число выполненных порций"""
+        c = conn.cursor()
+        chunks = 0
+        while True:
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                # Продолжаем с позиции, сохраненной прошлым запуском;
+                # строки нет - миграцию закончил другой процесс
+                c.execute('SELECT position FROM migration_jobs WHERE version = ?', (item.version,))
+                row = c.fetchone()
+                if row is None:
+                    conn.rollback()
+                    return chunks
+                position = item.func(c, json.loads(row[0]) if row[0] else None)
+                if position is None:
+                    c.execute('DELETE FROM migration_jobs WHERE version = ?', (item.version,))
+                else:
+                    c.execute('''UPDATE migration_jobs SET position = ?, chunks = chunks + 1, updated = ?
+                                WHERE version = ?''',
+                              (json.dumps(position), datetime.now(), item.version))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            chunks += 1
+            if position is None:
+                return chunks
+            time.sleep(CHUNK_PAUSE)
+
+    def _applied(self, item, started, details=None):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.applied.append((item.version, item.description, elapsed))
+        suffix = f", {details}" if details else ""
+        logger.info(f"Применена миграция {item.version} ({item.description}) за {elapsed:.2f} с{suffix}")
+
+    def _run_deferred(self, jobs):
+        try:
+            self._run_jobs(jobs)
+            # Фоновые миграции пересчитывают счетчики в обход топов в памяти
+            from leaderboards import leaderboards
+            leaderboards.invalidate()
+        except Exception as e:
+            self.error = str(e)
+            log_error(f"Ошибка фоновой миграции базы данных: {str(e)}", exc_info=True)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'version': self.schema_version(),
+                'latest': LATEST_VERSION,
+                'running': bool(self.thread and self.thread.is_alive()),
+                'applied': list(self.applied),
+                'error': self.error
+            }
+
+
+# Создаем глобальный объект миграций
+migrator = Migrator()
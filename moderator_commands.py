@@ -1,8 +1,10 @@
-import sqlite3
+from database import get_connection
 from datetime import datetime, timedelta
 from vk_api.utils import get_random_id
 from utils import extract_user_id
+from command_registry import command, COST_API
 
+@command('mute', role='moderator', cost=COST_API)
 def cmd_mute(vk, event, args):
     if not args or len(args) < 2:
         return "⚠️ Использование: /mute [@пользователь] [время в минутах] [причина]"
@@ -16,7 +18,7 @@ def cmd_mute(vk, event, args):
         minutes = int(args[1])
         reason = ' '.join(args[2:]) if len(args) > 2 else "Не указана"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         mute_end = datetime.now() + timedelta(minutes=minutes)
         
@@ -33,6 +35,7 @@ def cmd_mute(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('unmute', role='moderator', cost=COST_API)
 def cmd_unmute(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -43,7 +46,7 @@ def cmd_unmute(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''UPDATE users 
@@ -59,6 +62,7 @@ def cmd_unmute(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('warn', role='moderator', cost=COST_API)
 def cmd_warn(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя и причину"
@@ -72,7 +76,7 @@ def cmd_warn(vk, event, args):
         reason = ' '.join(args[1:]) if len(args) > 1 else "Не указана"
         warned_by = event.obj.message['from_id']
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Add warning to history
@@ -98,6 +102,7 @@ def cmd_warn(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('unwarn', role='moderator', cost=COST_API)
 def cmd_unwarn(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -108,7 +113,7 @@ def cmd_unwarn(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''UPDATE users 
@@ -127,6 +132,7 @@ def cmd_unwarn(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('getban', role='moderator', cost=COST_API)
 def cmd_getban(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -137,7 +143,7 @@ def cmd_getban(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('SELECT chat_id, ban_time FROM bans WHERE user_id = ?', (user_id,))
@@ -157,6 +163,7 @@ def cmd_getban(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('getwarn', role='moderator', cost=COST_API)
 def cmd_getwarn(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -167,7 +174,7 @@ def cmd_getwarn(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('SELECT warnings FROM users WHERE user_id = ?', (user_id,))
@@ -185,6 +192,7 @@ def cmd_getwarn(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('warnhistory', role='moderator', cost=COST_API)
 def cmd_warnhistory(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -195,7 +203,7 @@ def cmd_warnhistory(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''SELECT warned_by, reason, timestamp 
@@ -204,14 +212,17 @@ def cmd_warnhistory(vk, event, args):
                     ORDER BY timestamp DESC''', (user_id,))
         history = c.fetchall()
         
-        user_info = vk.users.get(user_ids=[user_id])[0]
+        # Получаем пользователя и всех выдавших предупреждения одним запросом
+        user_ids = [user_id] + list({warned_by for warned_by, _, _ in history if warned_by > 0} - {user_id})
+        users = {user['id']: user for user in vk.users.get(user_ids=user_ids)}
+        user_info = users[user_id]
         
         if not history:
             response = f"✅ У пользователя @id{user_id} ({user_info['first_name']}) нет истории предупреждений"
         else:
             response = f"📋 История предупреждений пользователя @id{user_id} ({user_info['first_name']}):\n"
             for warned_by, reason, timestamp in history:
-                warner_info = vk.users.get(user_ids=[warned_by])[0]
+                warner_info = users.get(warned_by, {'first_name': 'Unknown'})
                 response += f"• {timestamp} от @id{warned_by} ({warner_info['first_name']}): {reason}\n"
         
         conn.close()
@@ -219,9 +230,10 @@ def cmd_warnhistory(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('staff', role='moderator', cost=COST_API)
 def cmd_staff(vk, event):
     try:
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Получаем всех пользователей с ролями, кроме обычных пользователей
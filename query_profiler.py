@@ -0,0 +1,229 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Включен ли профилировщик и порог медленного запроса
+QUERY_PROFILER = os.getenv('QUERY_PROFILER', '1') == '1'
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+
+# Сколько последних замеров каждого запроса хранится для перцентиля
+SAMPLES_PER_QUERY = 256
+# Ограничение числа различных запросов (остальные учитываются вместе)
+MAX_QUERIES = 2000
+OTHER_QUERIES = '<прочие запросы>'
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """Текст запроса без литералов и лишних пробелов: одинаковые запросы учитываются вместе"""
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = IN_LIST.sub('IN (...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryStats:
+    """Статистика одного нормализованного запроса"""
+
+    __slots__ = ('count', 'total_time', 'max_time', 'samples', 'tags')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.samples = deque(maxlen=SAMPLES_PER_QUERY)
+        # Команда или поток -> число вызовов
+        self.tags = {}
+
+    def add(self, elapsed, tag):
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self.samples.append(elapsed)
+        self.tags[tag] = self.tags.get(tag, 0) + 1
+
+    def percentile(self, fraction):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class QueryProfiler:
+    """
+    Профилировщик запросов ко всем соединениям бота (через ProfiledConnection).
+
+    Для каждого нормализованного запроса считает количество, суммарное и
+    максимальное время и p95 по последним замерам, а также команды (cmd_*),
+    из которых он выполнялся; вне команд - имя потока. Запросы дольше
+    SLOW_QUERY_MS записываются в лог вместе с EXPLAIN QUERY PLAN.
+    """
+
+    def __init__(self, enabled=True, slow_ms=100):
+        self.enabled = enabled
+        self.slow_time = slow_ms / 1000
+        self.queries = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Исходный текст -> нормализованный (тексты запросов в коде постоянны)
+        self.normalized = {}
+        self.slow_queries = 0
+        # Вызываются с временем каждого запроса (замеры replay.py)
+        self.listeners = []
+
+    @contextmanager
+    def tag(self, name):
+        """Отмечать запросы внутри блока именем команды"""
+        previous = getattr(self.local, 'tag', None)
+        self.local.tag = name
+        try:
+            yield
+        finally:
+            self.local.tag = previous
+
+    def current_tag(self):
+        return getattr(self.local, 'tag', None) or threading.current_thread().name
+
+    def add_listener(self, callback):
+        """Вызывать callback(elapsed) после каждого запроса"""
+        self.listeners.append(callback)
+
+    def record(self, connection, sql, parameters, elapsed):
+        for callback in self.listeners:
+            callback(elapsed)
+
+        normalized = self.normalized.get(sql)
+        if normalized is None:
+            normalized = normalize_sql(sql)
+            if len(self.normalized) >= MAX_QUERIES:
+                self.normalized.clear()
+            self.normalized[sql] = normalized
+
+        tag = self.current_tag()
+        with self.lock:
+            stats = self.queries.get(normalized)
+            if stats is None:
+                if len(self.queries) >= MAX_QUERIES:
+                    normalized = OTHER_QUERIES
+                    stats = self.queries.get(normalized)
+                if stats is None:
+                    stats = self.queries[normalized] = QueryStats()
+            stats.add(elapsed, tag)
+            if elapsed >= self.slow_time:
+                self.slow_queries += 1
+
+        if elapsed >= self.slow_time:
+            self._log_slow(connection, sql, parameters, elapsed, tag)
+
+    def _log_slow(self, connection, sql, parameters, elapsed, tag):
+        try:
+            # Обычный курсор: план не должен попадать в статистику
+            cursor = sqlite3.Cursor(connection)
+            plan = [row[-1] for row in cursor.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+        except Exception as e:
+            plan = [f"план недоступен: {str(e)}"]
+        message = f"Медленный запрос ({elapsed * 1000:.0f} мс, {tag}): {normalize_sql(sql)}"
+        if plan:
+            message += "\n" + "\n".join(f"    {detail}" for detail in plan)
+        logger.warning(message)
+
+    def top(self, limit=10):
+        """Самые затратные запросы по суммарному времени"""
+        with self.lock:
+            items = sorted(self.queries.items(), key=lambda item: -item[1].total_time)[:limit]
+            return [{
+                'sql': sql,
+                'count': stats.count,
+                'total_time': stats.total_time,
+                'avg_time': stats.total_time / stats.count,
+                'p95_time': stats.percentile(0.95),
+                'max_time': stats.max_time,
+                'tags': sorted(stats.tags.items(), key=lambda item: -item[1])
+            } for sql, stats in items]
+
+    def reset(self):
+        with self.lock:
+            self.queries.clear()
+            self.slow_queries = 0
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'slow_ms': self.slow_time * 1000,
+                'queries': len(self.queries),
+                'calls': sum(stats.count for stats in self.queries.values()),
+                'total_time': sum(stats.total_time for stats in self.queries.values()),
+                'slow_queries': self.slow_queries
+            }
+
+
+# Создаем глобальный профилировщик запросов
+profiler = QueryProfiler(enabled=QUERY_PROFILER, slow_ms=SLOW_QUERY_MS)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Курсор, передающий время запросов профилировщику"""
+
+    def execute(self, sql, parameters=()):
+        if not profiler.enabled:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            profiler.record(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not profiler.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        # План медленного запроса строится по первому набору параметров
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            profiler.record(self.connection, sql, seq_of_parameters[0] if seq_of_parameters else (),
+                            time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        if not profiler.enabled:
+            return super().executescript(sql_script)
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            # Для скриптов план не строится
+            profiler.record(None, sql_script, (), time.perf_counter() - started)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого замеряют запросы"""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
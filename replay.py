@@ -0,0 +1,314 @@
+"""
+Воспроизведение записанных событий long poll для нагрузочных замеров.
+
+События записываются ботом при заданной переменной RECORD_EVENTS и
+воспроизводятся через handle_event() из main.py на копии базы данных.
+Запросы к VK API не отправляются.
+
+Использование:
+    python replay.py events.jsonl [--speed 1|10|max] [--db bot.db] [--mode sync|async]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ReplayStats:
+    """Сбор задержек событий и времени работы с базой по командам"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latencies = []
+        self.commands = defaultdict(lambda: {'count': 0, 'latency': 0.0, 'db_time': 0.0, 'queries': 0})
+        self.api_calls = defaultdict(int)
+
+    def begin(self, label):
+        """Начать учет события в текущем потоке"""
+        self.local.label = label
+        self.local.db_time = 0.0
+        self.local.queries = 0
+
+    def add_query(self, elapsed):
+        """Учесть один запрос к базе"""
+        if getattr(self.local, 'label', None) is None:
+            return
+        self.local.db_time += elapsed
+        self.local.queries += 1
+
+    def finish(self, latency):
+        """Завершить учет события"""
+        with self.lock:
+            self.latencies.append(latency)
+            command = self.commands[self.local.label]
+            command['count'] += 1
+            command['latency'] += latency
+            command['db_time'] += self.local.db_time
+            command['queries'] += self.local.queries
+        self.local.label = None
+
+    def add_api_call(self, method):
+        with self.lock:
+            self.api_calls[method] += 1
+
+
+stats = ReplayStats()
+
+
+def install_db_timing():
+    """Учитывать время всех запросов к базе через профилировщик запросов бота"""
+    from query_profiler import profiler
+    profiler.enabled = True
+    profiler.add_listener(stats.add_query)
+
+
+class OfflineVkMethod:
+    """Метод заглушки VK API"""
+
+    def __init__(self, vk, method):
+        self._vk = vk
+        self._method = method
+
+    def __getattr__(self, name):
+        return OfflineVkMethod(self._vk, f'{self._method}.{name}')
+
+    def __call__(self, **kwargs):
+        return self._vk.call(self._method, kwargs)
+
+
+class OfflineVk:
+    """Заглушка VK API: ничего не отправляет, только считает вызовы"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._message_id = 0
+        # Для кода, которому нужна сессия (vk._vk.method), например VkBatch
+        self._vk = self
+
+    def __getattr__(self, name):
+        return OfflineVkMethod(self, name)
+
+    def method(self, method, values=None, raw=False):
+        """Аналог VkApi.method, execute разбирается на отдельные вызовы"""
+        values = values or {}
+        if method == 'execute':
+            response = {'response': self.execute(values.get('code', ''))}
+        else:
+            response = {'response': self.call(method, values)}
+        return response if raw else response['response']
+
+    def execute(self, code):
+        """Выполнить код execute вида return [API.method({json}), ...];"""
+        stats.add_api_call('execute')
+        decoder = json.JSONDecoder()
+        results = []
+        position = code.find('API.')
+        while position != -1:
+            bracket = code.find('(', position)
+            values, end = decoder.raw_decode(code, bracket + 1)
+            results.append(self.call(code[position + 4:bracket], values))
+            position = code.find('API.', end)
+        return results
+
+    def call(self, method, values):
+        stats.add_api_call(method)
+
+        if method == 'messages.send':
+            with self._lock:
+                self._message_id += 1
+                return self._message_id
+
+        if method == 'users.get':
+            user_ids = values.get('user_ids', [])
+            if isinstance(user_ids, str):
+                user_ids = user_ids.split(',')
+            elif not isinstance(user_ids, (list, tuple)):
+                user_ids = [user_ids]
+            return [
+                {'id': int(user_id), 'first_name': 'User', 'last_name': str(user_id)}
+                for user_id in user_ids if str(user_id).lstrip('-').isdigit()
+            ]
+
+        if method == 'messages.getConversationMembers':
+            return {'count': 0, 'items': [], 'profiles': [], 'groups': []}
+
+        return 1
+
+
+def percentile(values, percent):
+    """Перцентиль отсортированного списка"""
+    if not values:
+        return 0.0
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def event_label(event, message_new):
+    """Метка события для отчета: команда, действие или обычное сообщение"""
+    if event.type != message_new:
+        return f"event:{getattr(event.type, 'value', event.type)}"
+
+    message = event.obj.message
+    if 'action' in message:
+        return f"action:{message['action'].get('type')}"
+
+    text = message.get('text', '').lower()
+    if text.startswith('/'):
+        parts = text.split()
+        return parts[0] if parts else '/'
+    return 'message'
+
+
+def paced_events(records, speed, parse_event, enqueued):
+    """Выдает события с интервалами из записи, ускоренными в speed раз (0 - без пауз)"""
+    if not records:
+        return
+
+    first_ts = records[0][0]
+    started = time.perf_counter()
+    for ts, raw in records:
+        if speed:
+            delay = (ts - first_ts) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        event = parse_event(raw)
+        enqueued[id(event)] = (event, time.perf_counter())
+        yield event
+
+
+def print_report(total_time, mode, speed):
+    latencies = sorted(stats.latencies)
+    count = len(latencies)
+
+    print()
+    print(f"Режим: {mode}, скорость: {'max' if not speed else f'{speed:g}x'}")
+    print(f"Событий: {count}, время: {total_time:.2f} с, "
+          f"скорость: {count / total_time if total_time else 0:.1f} событий/с")
+    print(f"Задержка события, мс: p50={percentile(latencies, 50) * 1000:.2f} "
+          f"p95={percentile(latencies, 95) * 1000:.2f} "
+          f"p99={percentile(latencies, 99) * 1000:.2f} "
+          f"max={percentile(latencies, 100) * 1000:.2f}")
+
+    print()
+    print(f"{'Команда':<24}{'Кол-во':>8}{'Ср. задержка, мс':>18}{'Ср. БД, мс':>12}{'Всего БД, с':>13}{'Запросов':>10}")
+    for label, command in sorted(stats.commands.items(), key=lambda item: -item[1]['db_time']):
+        print(f"{label:<24}{command['count']:>8}"
+              f"{command['latency'] / command['count'] * 1000:>18.2f}"
+              f"{command['db_time'] / command['count'] * 1000:>12.2f}"
+              f"{command['db_time']:>13.3f}"
+              f"{command['queries']:>10}")
+
+    if stats.api_calls:
+        print()
+        print("Вызовы VK API:")
+        for method, calls in sorted(stats.api_calls.items(), key=lambda item: -item[1]):
+            print(f"  {method:<40}{calls:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных событий long poll")
+    parser.add_argument('events', help="JSONL файл, записанный с RECORD_EVENTS")
+    parser.add_argument('--speed', default='1',
+                        help="Ускорение относительно записи: 1, 10, ... или max (без пауз)")
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'bot.db'),
+                        help="База данных, копия которой используется при воспроизведении")
+    parser.add_argument('--mode', choices=['sync', 'async'], default='async',
+                        help="sync - последовательная обработка, async - конвейер по беседам")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('PIPELINE_WORKERS', '8')),
+                        help="Количество воркеров конвейера в режиме async")
+    parser.add_argument('--keep', action='store_true',
+                        help="Не удалять временный каталог с копией базы")
+    parser.add_argument('--verbose', action='store_true', help="Выводить логи бота")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    speed = 0 if args.speed == 'max' else float(args.speed)
+    events_path = os.path.abspath(args.events)
+
+    # Воспроизводим во временном каталоге с копией базы,
+    # путь к ней передаем боту через DATABASE_PATH
+    work_dir = tempfile.mkdtemp(prefix='replay_')
+    shutil.copy2(args.db, os.path.join(work_dir, 'bot.db'))
+    os.chdir(work_dir)
+    sys.path.insert(0, BASE_DIR)
+    os.environ['DATABASE_PATH'] = os.path.join(work_dir, 'bot.db')
+    os.environ.setdefault('GROUP_ID', '0')
+
+    install_db_timing()
+
+    from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType
+    from event_recorder import load_events
+    from event_pipeline import ChatEventPipeline
+    import main as bot
+    from write_buffer import write_buffer
+    from user_state import user_state
+    from leaderboards import leaderboards
+    from db_writer import db_writer
+    from report_worker import report_worker
+
+    if not args.verbose:
+        logging.getLogger('bot').setLevel(logging.WARNING)
+        logging.getLogger('commands').setLevel(logging.WARNING)
+
+    def parse_event(raw):
+        event_class = VkBotLongPoll.CLASS_BY_EVENT_TYPE.get(raw['type'], VkBotLongPoll.DEFAULT_EVENT_CLASS)
+        return event_class(raw)
+
+    records = load_events(events_path)
+    print(f"Загружено событий: {len(records)}, база: {os.path.join(work_dir, 'bot.db')}")
+
+    vk = OfflineVk()
+    enqueued = {}
+    message_new = VkBotEventType.MESSAGE_NEW
+
+    def process(event):
+        _, queued_at = enqueued.pop(id(event))
+        stats.begin(event_label(event, message_new))
+        try:
+            bot.handle_event(vk, event)
+        finally:
+            stats.finish(time.perf_counter() - queued_at)
+
+    events = paced_events(records, speed, parse_event, enqueued)
+    # Схема и кэши готовятся так же, как при запуске бота
+    bot.update_database(background=False)
+    user_state.load_all()
+    leaderboards.load_all()
+    db_writer.start()
+    write_buffer.start()
+    started = time.perf_counter()
+    try:
+        if args.mode == 'async':
+            pipeline = ChatEventPipeline(process, workers=args.workers)
+            pipeline.run(events)
+        else:
+            for event in events:
+                process(event)
+    finally:
+        # Время отчетов и записи остатка буфера входит в общее время
+        report_worker.stop()
+        write_buffer.stop()
+        db_writer.stop()
+        total_time = time.perf_counter() - started
+        print_report(total_time, args.mode, speed)
+        os.chdir(BASE_DIR)
+        if args.keep:
+            print(f"\nВременный каталог сохранен: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
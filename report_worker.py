@@ -0,0 +1,89 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from vk_api.utils import get_random_id
+from send_scheduler import send_lane
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+
+class ReportWorker:
+    """
+    Пул потоков для тяжелых отчетов (команды с background=True).
+
+    Обработчик события только ставит отчет в очередь, поэтому следующие
+    события беседы не ждут его завершения. Ответ отправляется в беседу,
+    когда отчет готов. Число ожидающих отчетов ограничено max_pending.
+    """
+
+    def __init__(self, workers=2, max_pending=20):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def submit(self, vk, chat_id, lane, func):
+        """Выполнить func() в пуле и отправить ответ в беседу. False, если очередь заполнена"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='report')
+        self.executor.submit(self._run, vk, chat_id, lane, func)
+        return True
+
+    def _run(self, vk, chat_id, lane, func):
+        failed = False
+        try:
+            with send_lane(lane):
+                response = func()
+                if response:
+                    vk.messages.send(chat_id=chat_id, message=response, random_id=get_random_id())
+        except Exception as e:
+            failed = True
+            log_error(f"Ошибка при формировании отчета: {str(e)}", exc_info=True)
+            try:
+                vk.messages.send(chat_id=chat_id, message="❌ Произошла ошибка при обработке команды",
+                                 random_id=get_random_id())
+            except Exception:
+                pass
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                if failed:
+                    self.errors += 1
+
+    def stop(self):
+        """Дождаться отчетов, которые уже в очереди"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'errors': self.errors
+            }
+
+
+# Создаем глобальный пул отчетов
+report_worker = ReportWorker(
+    workers=int(os.getenv('REPORT_WORKERS', '2')),
+    max_pending=int(os.getenv('REPORT_MAX_PENDING', '20'))
+)
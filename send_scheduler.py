@@ -0,0 +1,275 @@
+import os
+import time
+import random
+import logging
+import threading
+import itertools
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future
+from queue import PriorityQueue
+from vk_api.vk_api import VkApiMethod
+from vk_api.exceptions import ApiError
+from requests.exceptions import ConnectionError, Timeout
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Полосы приоритета: меньше - важнее
+LANE_MODERATION = 0  # Модерация, антиспам, режим тишины
+LANE_DEFAULT = 1     # Обычные ответы на команды
+LANE_GAMES = 2       # Игры и экономика
+
+LANE_NAMES = {
+    LANE_MODERATION: 'moderation',
+    LANE_DEFAULT: 'default',
+    LANE_GAMES: 'games'
+}
+
+# Методы, которые выполняются через очередь планировщика
+QUEUED_METHODS = {'messages.send', 'messages.delete', 'messages.removeChatUser'}
+# Методы, результат которых не нужен обработчикам - не ждем их выполнения
+FIRE_AND_FORGET_METHODS = {'messages.send'}
+
+# Коды ошибок VK, при которых запрос повторяется:
+# 6 - слишком много запросов в секунду, 9 - flood control, 10 - внутренняя ошибка сервера
+RETRY_ERROR_CODES = {6, 9, 10}
+
+_local = threading.local()
+
+
+def current_lane():
+    """Полоса приоритета для запросов текущего потока"""
+    return getattr(_local, 'lane', LANE_DEFAULT)
+
+
+@contextmanager
+def send_lane(lane):
+    """Выполнять запросы к VK в блоке с указанным приоритетом"""
+    previous = current_lane()
+    _local.lane = lane
+    try:
+        yield
+    finally:
+        _local.lane = previous
+
+
+def lane_for_command(command):
+    """Полоса приоритета для команды из реестра"""
+    if command.role != 'user':
+        return LANE_MODERATION
+    if command.cost == 'game':
+        return LANE_GAMES
+    return LANE_DEFAULT
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов (token bucket)"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        # По умолчанию без накопления: запросы идут равномерно и не превышают лимит VK за секунду
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Дождаться и забрать один токен. Возвращает время ожидания"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class SendJob:
+    __slots__ = ('method', 'values', 'raw', 'lane', 'future', 'queued_at')
+
+    def __init__(self, method, values, raw, lane):
+        self.method = method
+        self.values = values
+        self.raw = raw
+        self.lane = lane
+        self.future = Future()
+        self.queued_at = time.monotonic()
+
+
+class LaneStats:
+    __slots__ = ('submitted', 'completed', 'failed', 'retries', 'total_wait', 'max_wait', 'queued')
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.queued = 0
+
+
+class SendScheduler:
+    """
+    Планировщик исходящих запросов к VK API.
+
+    Все запросы проходят через общий token bucket с лимитом токена группы.
+    Отправка, удаление сообщений и исключение из бесед ставятся в очередь с
+    полосами приоритета, чтобы модерация не ждала ответов игр. Остальные
+    методы выполняются сразу в вызывающем потоке, но тоже берут токен.
+    Ошибки 6/9/10 и сетевые ошибки повторяются с экспоненциальной паузой.
+    """
+
+    def __init__(self, rate=20, workers=4, max_retries=3, retry_delay=0.5):
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.session = None
+        self.queue = PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = {lane: LaneStats() for lane in LANE_NAMES}
+        self.direct = LaneStats()
+        self.threads = []
+
+    def start(self, vk_session):
+        """Запустить планировщик для сессии VK. Возвращает объект API для обработчиков"""
+        self.session = vk_session
+        # Частоту ограничивает token bucket, поэтому убираем встроенную паузу
+        # vk_api и блокировку, которая выполняла все запросы по одному
+        vk_session.RPS_DELAY = 0
+        vk_session.lock = nullcontext()
+        # Ошибку 6 повторяет планировщик, а не vk_api
+        vk_session.error_handlers.pop(6, None)
+
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'vk-send-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        logger.info(f"Планировщик запросов VK запущен ({self.bucket.rate} запросов/с, {self.workers} потоков)")
+        return VkApiMethod(ScheduledSession(self))
+
+    def submit(self, method, values, raw=False, lane=None):
+        """Поставить запрос в очередь. Возвращает Future с результатом"""
+        job = SendJob(method, values, raw, current_lane() if lane is None else lane)
+        with self.lock:
+            stats = self.stats[job.lane]
+            stats.submitted += 1
+            stats.queued += 1
+        self.queue.put((job.lane, next(self.sequence), job))
+        return job.future
+
+    def call(self, method, values, raw=False):
+        """Выполнить запрос сразу в текущем потоке с учетом лимита"""
+        with self.lock:
+            self.direct.submitted += 1
+        waited = self.bucket.acquire()
+        try:
+            result = self._call_with_retries(method, values, raw, self.direct)
+        except Exception:
+            self._finish(self.direct, waited, failed=True)
+            raise
+        self._finish(self.direct, waited)
+        return result
+
+    def _worker(self):
+        while True:
+            _, _, job = self.queue.get()
+            stats = self.stats[job.lane]
+            self.bucket.acquire()
+            wait = time.monotonic() - job.queued_at
+            with self.lock:
+                stats.queued -= 1
+            try:
+                result = self._call_with_retries(job.method, job.values, job.raw, stats)
+                self._finish(stats, wait)
+                job.future.set_result(result)
+            except Exception as e:
+                self._finish(stats, wait, failed=True)
+                if job.method in FIRE_AND_FORGET_METHODS:
+                    log_error(f"Не удалось выполнить {job.method}: {str(e)}")
+                job.future.set_exception(e)
+
+    def _call_with_retries(self, method, values, raw, stats):
+        attempt = 0
+        while True:
+            try:
+                return self.session.method(method, values, raw=raw)
+            except (ApiError, ConnectionError, Timeout) as e:
+                if isinstance(e, ApiError) and e.code not in RETRY_ERROR_CODES:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+
+                # Экспоненциальная пауза со случайным разбросом
+                delay = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                with self.lock:
+                    stats.retries += 1
+                logger.warning(f"Повтор {method} через {delay:.2f} с ({attempt}/{self.max_retries}): {str(e)}")
+                time.sleep(delay)
+                self.bucket.acquire()
+
+    def _finish(self, stats, wait, failed=False):
+        with self.lock:
+            if failed:
+                stats.failed += 1
+            else:
+                stats.completed += 1
+            stats.total_wait += wait
+            if wait > stats.max_wait:
+                stats.max_wait = wait
+
+    def depth(self):
+        """Количество запросов в очереди"""
+        return self.queue.qsize()
+
+    def metrics(self):
+        """Метрики по полосам: очередь, выполненные, ошибки, повторы, ожидание"""
+        with self.lock:
+            lanes = dict((LANE_NAMES[lane], stats) for lane, stats in self.stats.items())
+            lanes['direct'] = self.direct
+            return {
+                name: {
+                    'queued': stats.queued,
+                    'submitted': stats.submitted,
+                    'completed': stats.completed,
+                    'failed': stats.failed,
+                    'retries': stats.retries,
+                    'avg_wait': stats.total_wait / max(1, stats.completed + stats.failed),
+                    'max_wait': stats.max_wait
+                }
+                for name, stats in lanes.items()
+            }
+
+
+class ScheduledSession:
+    """Сессия для VkApiMethod, направляющая вызовы через планировщик"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def method(self, method, values=None, raw=False):
+        values = values.copy() if values else {}
+        if method in QUEUED_METHODS:
+            future = self.scheduler.submit(method, values, raw)
+            if method in FIRE_AND_FORGET_METHODS:
+                return future
+            return future.result()
+        return self.scheduler.call(method, values, raw)
+
+
+# Создаем глобальный планировщик запросов
+scheduler = SendScheduler(
+    rate=float(os.getenv('VK_RPS', '20')),
+    workers=int(os.getenv('SEND_WORKERS', '4')),
+    max_retries=int(os.getenv('SEND_MAX_RETRIES', '3'))
+)
@@ -1,8 +1,15 @@
-import sqlite3
+from database import get_connection, read_snapshot
 from datetime import datetime
 from vk_api.utils import get_random_id
 from utils import extract_user_id
+from command_registry import command, COST_API, COST_HEAVY
+from chat_members import members_index
+from user_state import user_state
 
+# Сколько банов выводит /banlist (длина сообщения VK ограничена)
+BANLIST_LIMIT = 100
+
+@command('ban', role='senior_moderator', cost=COST_API)
 def cmd_ban(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя и причину"
@@ -16,7 +23,7 @@ def cmd_ban(vk, event, args):
         reason = ' '.join(args[1:]) if len(args) > 1 else "Не указана"
         chat_id = event.chat_id
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''INSERT INTO bans (user_id, chat_id, ban_time)
@@ -36,6 +43,7 @@ def cmd_ban(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('unban', role='senior_moderator', cost=COST_API)
 def cmd_unban(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -48,7 +56,7 @@ def cmd_unban(vk, event, args):
             
         chat_id = event.chat_id
         
-        conn = sqlite3.connect('bot.db')
+        conn = get_connection()
         c = conn.cursor()
         
         # Проверяем, забанен ли пользователь
@@ -71,6 +79,7 @@ def cmd_unban(vk, event, args):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('addmoder', role='senior_moderator', cost=COST_API)
 def cmd_addmoder(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -81,20 +90,15 @@ def cmd_addmoder(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        c.execute('''INSERT OR REPLACE INTO users (user_id, role)
-                    VALUES (?, 'moderator')''', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        # Запись в базу и кэш ролей: права действуют с первого же сообщения
+        user_state.set_role(user_id, 'moderator')
         
         user_info = vk.users.get(user_ids=[user_id])[0]
         return f"✅ Пользователю @id{user_id} ({user_info['first_name']}) выдана роль модератора"
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('removerole', role='senior_moderator', cost=COST_API)
 def cmd_removerole(vk, event, args):
     if not args:
         return "⚠️ Укажите пользователя"
@@ -105,44 +109,34 @@ def cmd_removerole(vk, event, args):
         if not user_id:
             return "❌ Не удалось определить пользователя"
         
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        c.execute('''UPDATE users 
-                    SET role = 'user' 
-                    WHERE user_id = ?''', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        user_state.set_role(user_id, 'user')
         
         user_info = vk.users.get(user_ids=[user_id])[0]
         return f"✅ У пользователя @id{user_id} ({user_info['first_name']}) забрана роль"
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('zov', role='senior_moderator', cost=COST_HEAVY, cooldown=30)
 def cmd_zov(vk, event):
     try:
-        chat_members = vk.messages.getConversationMembers(
-            peer_id=2000000000 + event.chat_id
-        )
+        chat_members = members_index.members(vk, event.chat_id)
         
         mentions = []
-        for member in chat_members['profiles']:
+        for member in chat_members:
             mentions.append(f"@id{member['id']} ({member['first_name']})")
         
         return "🔔 Всеобщий призыв!\n" + ", ".join(mentions)
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('online', role='senior_moderator', cost=COST_HEAVY, cooldown=10)
 def cmd_online(vk, event):
     try:
-        chat_members = vk.messages.getConversationMembers(
-            peer_id=2000000000 + event.chat_id
-        )
+        chat_members, online = members_index.online_members(vk, event.chat_id)
         
         online_members = []
-        for member in chat_members['profiles']:
-            if member.get('online', 0) == 1:
+        for member in chat_members:
+            if member['id'] in online:
                 online_members.append(f"@id{member['id']} ({member['first_name']})")
         
         if not online_members:
@@ -152,17 +146,16 @@ def cmd_online(vk, event):
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('banlist', role='senior_moderator', cost=COST_API, background=True)
 def cmd_banlist(vk, event):
     try:
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        
-        c.execute('''SELECT user_id, ban_time 
-                    FROM bans 
-                    WHERE chat_id = ? 
-                    ORDER BY ban_time DESC''', (event.chat_id,))
-        bans = c.fetchall()
-        conn.close()
+        with read_snapshot() as snapshot:
+            bans = snapshot.fetch('''SELECT user_id, ban_time 
+                                    FROM bans 
+                                    WHERE chat_id = ? 
+                                    ORDER BY ban_time DESC''', (event.chat_id,), limit=BANLIST_LIMIT)
+            bans_count = snapshot.fetch_one('SELECT COUNT(*) FROM bans WHERE chat_id = ?',
+                                            (event.chat_id,))[0] if snapshot.truncated else len(bans)
         
         if not bans:
             return "✅ В этой беседе нет заблокированных пользователей"
@@ -170,26 +163,27 @@ def cmd_banlist(vk, event):
         message = "📋 Список заблокированных пользователей:\n"
         for user_id, ban_time in bans:
             message += f"• {user_id}: с {ban_time}\n"
+        if bans_count > len(bans):
+            message += f"\n...и еще {bans_count - len(bans)}"
         return message
     except Exception as e:
         return f"❌ Ошибка: {str(e)}"
 
+@command('onlinelist', role='senior_moderator', cost=COST_HEAVY, cooldown=10)
 def cmd_onlinelist(vk, event):
     try:
-        chat_members = vk.messages.getConversationMembers(
-            peer_id=2000000000 + event.chat_id
-        )
+        chat_members, online = members_index.online_members(vk, event.chat_id)
         
         online_count = 0
         message = "📊 Статистика онлайна:\n"
         
-        for member in chat_members['profiles']:
-            status = "🟢" if member.get('online', 0) == 1 else "⚫"
+        for member in chat_members:
+            status = "🟢" if member['id'] in online else "⚫"
             message += f"{status} @id{member['id']} ({member['first_name']})\n"
-            if member.get('online', 0) == 1:
+            if member['id'] in online:
                 online_count += 1
         
-        message += f"\nВсего онлайн: {online_count}/{len(chat_members['profiles'])}"
+        message += f"\nВсего онлайн: {online_count}/{len(chat_members)}"
         return message
     except Exception as e:
         return f"❌ Ошибка: {str(e)}" 
\ No newline at end of file
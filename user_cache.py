@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from vk_api.vk_api import VkApiMethod
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Максимум ID в одном запросе users.get
+USERS_GET_LIMIT = 1000
+
+MENTION_PATTERN = re.compile(r'\[id(\d+)\|')
+
+
+class UserCache:
+    """
+    Общий кэш профилей users.get с TTL и вытеснением давно неиспользуемых (LRU).
+
+    Кэшируются только запросы по числовым ID без дополнительных параметров
+    (fields, name_case). Недостающие профили запрашиваются одним users.get,
+    а одновременные запросы одного и того же ID из разных потоков ждут
+    один общий запрос.
+    """
+
+    def __init__(self, ttl=3600, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # user_id -> (время устаревания, профиль)
+        self.entries = OrderedDict()
+        # user_id -> threading.Event для запросов, которые уже выполняются
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    @staticmethod
+    def cacheable(values):
+        """Можно ли обслужить запрос users.get из кэша"""
+        if set(values) - {'user_ids', 'v', 'access_token'}:
+            return False
+        user_ids = str(values.get('user_ids', ''))
+        return bool(user_ids) and all(part.strip().isdigit() for part in user_ids.split(','))
+
+    def get_users(self, fetch, user_ids):
+        """
+        Профили пользователей в порядке user_ids.
+        fetch(ids) выполняет users.get для списка ID и возвращает его ответ.
+        """
+        profiles = self._load(fetch, user_ids)
+        return [profiles[user_id] for user_id in user_ids if user_id in profiles]
+
+    def prefetch(self, fetch, user_ids):
+        """Заранее загрузить профили, которые понадобятся при обработке события"""
+        self._load(fetch, user_ids)
+
+    def _load(self, fetch, user_ids):
+        profiles = {}
+        to_fetch = []
+        to_wait = []
+        now = time.monotonic()
+
+        with self.lock:
+            for user_id in dict.fromkeys(user_ids):
+                entry = self.entries.get(user_id)
+                if entry and entry[0] > now:
+                    self.entries.move_to_end(user_id)
+                    profiles[user_id] = entry[1]
+                    self.hits += 1
+                    continue
+
+                self.misses += 1
+                inflight = self.inflight.get(user_id)
+                if inflight:
+                    to_wait.append((user_id, inflight))
+                else:
+                    self.inflight[user_id] = threading.Event()
+                    to_fetch.append(user_id)
+
+        if to_fetch:
+            self._fetch(fetch, to_fetch, profiles)
+
+        # Ждем запросы, которые уже выполняются в других потоках
+        for user_id, inflight in to_wait:
+            inflight.wait(30)
+            with self.lock:
+                entry = self.entries.get(user_id)
+            if entry:
+                profiles[user_id] = entry[1]
+
+        return profiles
+
+    def _fetch(self, fetch, user_ids, profiles):
+        try:
+            for start in range(0, len(user_ids), USERS_GET_LIMIT):
+                chunk = user_ids[start:start + USERS_GET_LIMIT]
+                with self.lock:
+                    self.api_calls += 1
+                result = fetch(chunk)
+
+                expires = time.monotonic() + self.ttl
+                with self.lock:
+                    for profile in result:
+                        profiles[profile['id']] = profile
+                        self.entries[profile['id']] = (expires, profile)
+                        self.entries.move_to_end(profile['id'])
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+        finally:
+            with self.lock:
+                for user_id in user_ids:
+                    inflight = self.inflight.pop(user_id, None)
+                    if inflight:
+                        inflight.set()
+
+    def store(self, profiles):
+        """Положить в кэш профили, полученные другими методами (например, getConversationMembers)"""
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            for profile in profiles:
+                self.entries[profile['id']] = (expires, profile)
+                self.entries.move_to_end(profile['id'])
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """Удалить профиль из кэша (или очистить весь кэш)"""
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(user_id, None)
+
+    def metrics(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'api_calls': self.api_calls
+            }
+
+
+class CachedUsersSession:
+    """Сессия для VkApiMethod, отвечающая на users.get из кэша"""
+
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+
+    def fetch(self, user_ids):
+        return self.session.method('users.get', {'user_ids': ','.join(str(user_id) for user_id in user_ids)})
+
+    def method(self, method, values=None, raw=False):
+        if method == 'users.get' and not raw and values and self.cache.cacheable(values):
+            user_ids = [int(part) for part in str(values['user_ids']).split(',')]
+            return self.cache.get_users(self.fetch, user_ids)
+        return self.session.method(method, values, raw=raw)
+
+
+def with_user_cache(vk):
+    """Обернуть объект API так, чтобы users.get обслуживался из общего кэша"""
+    return VkApiMethod(CachedUsersSession(getattr(vk, '_vk', vk), user_cache))
+
+
+def event_user_ids(event, args):
+    """ID пользователей, имена которых скорее всего понадобятся при обработке команды"""
+    message = event.obj.message
+    user_ids = [message['from_id']]
+
+    reply = message.get('reply_message')
+    if reply:
+        user_ids.append(reply.get('from_id'))
+    for forwarded in message.get('fwd_messages') or []:
+        user_ids.append(forwarded.get('from_id'))
+    for arg in args:
+        match = MENTION_PATTERN.search(arg)
+        if match:
+            user_ids.append(int(match.group(1)))
+
+    return [user_id for user_id in user_ids if isinstance(user_id, int) and user_id > 0]
+
+
+def prefetch_users(vk, event, args):
+    """Загрузить одним запросом профили участников команды, которых нет в кэше"""
+    session = getattr(vk, '_vk', None)
+    if not isinstance(session, CachedUsersSession):
+        return
+    try:
+        user_cache.prefetch(session.fetch, event_user_ids(event, args))
+    except Exception as e:
+        logger.warning(f"Не удалось заранее загрузить профили: {str(e)}")
+
+
+# Создаем глобальный кэш профилей
+user_cache = UserCache(
+    ttl=int(os.getenv('USER_CACHE_TTL', '3600')),
+    max_size=int(os.getenv('USER_CACHE_SIZE', '10000'))
+)
@@ -0,0 +1,164 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from database import get_connection, transaction, pool
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Поля пользователя, которые хранит кэш, в порядке столбцов запросов
+STATE_COLUMNS = 'role, level, xp, balance'
+
+
+class UserState:
+    """Роль, уровень, опыт и баланс пользователя"""
+
+    __slots__ = ('role', 'level', 'xp', 'balance')
+
+    def __init__(self, role, level, xp, balance):
+        self.role = role or 'user'
+        self.level = level
+        self.xp = xp
+        self.balance = balance
+
+
+class UserStateCache:
+    """
+    Кэш состояния пользователей (роль, уровень, опыт, баланс) в памяти процесса.
+
+    При запуске загружается одним запросом, дальше читается без обращения к базе.
+    Изменения записываются в SQLite сразу (write-through): запросы возвращают
+    новое состояние строки через RETURNING, и оно же кладется в кэш. Записи,
+    сделанные в обход кэша, должны вызывать invalidate(). Размер ограничен,
+    давно неиспользуемые пользователи вытесняются (LRU) и при следующем
+    обращении читаются из базы. Отсутствие пользователя в базе тоже кэшируется.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        # user_id -> UserState или None, если пользователя нет в базе
+        self.entries = OrderedDict()
+        # Чтение из базы при промахе выполняется под блокировкой, чтобы
+        # устаревшая строка не перезаписала уже сохраненное изменение
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.invalidations = 0
+        # Вызываются с каждой строкой, записанной через кэш
+        self.listeners = []
+        # Откат транзакции мог отменить изменения, уже попавшие в кэш
+        pool.add_rollback_listener(self.invalidate)
+
+    def load_all(self):
+        """Загрузить состояние недавно активных пользователей одним запросом"""
+        try:
+            conn = get_connection()
+            try:
+                c = conn.cursor()
+                c.execute(f'''SELECT user_id, {STATE_COLUMNS} FROM users
+                            ORDER BY last_activity DESC LIMIT ?''', (self.max_size,))
+                rows = c.fetchall()
+            finally:
+                conn.close()
+        except Exception as e:
+            log_error(f"Ошибка при загрузке состояния пользователей: {str(e)}", exc_info=True)
+            return 0
+
+        with self.lock:
+            self.entries.clear()
+            # Самые активные оказываются в конце, то есть вытесняются последними
+            for user_id, *state in reversed(rows):
+                self.entries[user_id] = UserState(*state)
+        logger.info(f"Загружено состояние {len(rows)} пользователей")
+        return len(rows)
+
+    def get(self, user_id):
+        """Состояние пользователя или None, если его нет в базе. Объект только для чтения"""
+        with self.lock:
+            if user_id in self.entries:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return self.entries[user_id]
+
+            self.misses += 1
+            conn = get_connection()
+            try:
+                c = conn.cursor()
+                c.execute(f'SELECT {STATE_COLUMNS} FROM users WHERE user_id = ?', (user_id,))
+                row = c.fetchone()
+            finally:
+                conn.close()
+            return self._put(user_id, row)
+
+    def role(self, user_id):
+        """Роль пользователя ('user', если его нет в базе)"""
+        try:
+            state = self.get(user_id)
+        except Exception as e:
+            log_error(f"Ошибка при получении роли пользователя: {str(e)}")
+            return 'user'
+        return state.role if state else 'user'
+
+    def balance(self, user_id):
+        """Баланс пользователя или None, если его нет в базе"""
+        state = self.get(user_id)
+        return state.balance if state else None
+
+    def add_listener(self, callback):
+        """Вызывать callback(user_id, state) для каждой строки, переданной в store()"""
+        self.listeners.append(callback)
+
+    def store(self, user_id, row):
+        """Положить в кэш строку (role, level, xp, balance), возвращенную запросом записи"""
+        with self.lock:
+            self.writes += 1
+            state = self._put(user_id, row)
+        for callback in self.listeners:
+            callback(user_id, state)
+        return state
+
+    def set_role(self, user_id, role):
+        """Назначить роль (пользователь создается, если его нет в базе)"""
+        with transaction() as c:
+            c.execute(f'''INSERT INTO users (user_id, role) VALUES (?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET role = excluded.role
+                        RETURNING {STATE_COLUMNS}''', (user_id, role))
+            # В кэш до commit: следующая запись этой строки ждет завершения транзакции
+            self.store(user_id, c.fetchone())
+
+    def invalidate(self, user_id=None):
+        """Удалить пользователя из кэша (или очистить весь кэш)"""
+        with self.lock:
+            self.invalidations += 1
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(user_id, None)
+
+    def _put(self, user_id, row):
+        state = UserState(*row) if row else None
+        self.entries[user_id] = state
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return state
+
+    def metrics(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'writes': self.writes,
+                'invalidations': self.invalidations
+            }
+
+
+# Создаем глобальный кэш состояния пользователей
+user_state = UserStateCache(max_size=int(os.getenv('USER_STATE_SIZE', '50000')))
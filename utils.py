@@ -4,6 +4,7 @@ import json
 import os
 from dotenv import load_dotenv
 import re
+from chat_members import members_index
 
 # Load environment variables
 load_dotenv()
@@ -101,11 +102,11 @@ def check_achievement(conn, user_id, achievement_type, condition_value, required
         
         # Проверяем, нет ли уже такого достижения
         c.execute('''SELECT 1 FROM achievements 
-                    WHERE user_id = ? AND achievement_type = ?''', 
+                    WHERE user_id = ? AND type = ?''', 
                     (user_id, achievement_type))
         
         if not c.fetchone():
-            c.execute('''INSERT INTO achievements (user_id, achievement_type, achievement_date)
+            c.execute('''INSERT INTO achievements (user_id, type, earned_date)
                         VALUES (?, ?, ?)''', (user_id, achievement_type, datetime.now()))
             conn.commit()
             return True
@@ -114,12 +115,12 @@ def check_achievement(conn, user_id, achievement_type, condition_value, required
 def get_chat_stats(vk, chat_id):
     """Получить статистику беседы"""
     try:
-        members = vk.messages.getConversationMembers(peer_id=2000000000 + chat_id)
+        members, online = members_index.online_members(vk, chat_id)
         
         stats = {
-            'total_members': len(members['profiles']),
-            'online_count': sum(1 for m in members['profiles'] if m.get('online', 0) == 1),
-            'admins_count': sum(1 for m in members.get('items', []) if m.get('is_admin', False))
+            'total_members': len(members),
+            'online_count': len(online),
+            'admins_count': sum(1 for m in members if m['is_admin'])
         }
         return stats
     except:
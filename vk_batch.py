@@ -0,0 +1,158 @@
+import json
+import logging
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+# Ограничения метода execute
+MAX_CALLS_PER_EXECUTE = 25
+MAX_CODE_LENGTH = 60000
+
+
+class VkBatchError(Exception):
+    """Ошибка отдельного вызова внутри execute"""
+
+    def __init__(self, method, code, message):
+        super().__init__(f"[{code}] {message}")
+        self.method = method
+        self.code = code
+        self.message = message
+
+
+class BatchCall:
+    """Вызов метода в пакете. Результат доступен после выполнения пакета"""
+
+    __slots__ = ('method', 'values', 'result', 'error', 'done')
+
+    def __init__(self, method, values):
+        self.method = method
+        self.values = values
+        self.result = None
+        self.error = None
+        self.done = False
+
+    @property
+    def ok(self):
+        return self.done and self.error is None
+
+    def get(self):
+        """Результат вызова или исключение, если вызов завершился ошибкой"""
+        if not self.done:
+            raise RuntimeError("Пакет еще не выполнен")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def set_result(self, result):
+        self.result = result
+        self.done = True
+
+    def set_error(self, error):
+        self.error = error
+        self.done = True
+
+
+class BatchMethod:
+    """Позволяет добавлять вызовы в пакет в стиле vk.messages.send(...)"""
+
+    __slots__ = ('_batch', '_method')
+
+    def __init__(self, batch, method):
+        self._batch = batch
+        self._method = method
+
+    def __getattr__(self, name):
+        return BatchMethod(self._batch, f'{self._method}.{name}')
+
+    def __call__(self, **values):
+        return self._batch.add(self._method, values)
+
+
+class VkBatch:
+    """
+    Пакетное выполнение вызовов VK API через метод execute.
+
+    Вызовы накапливаются и отправляются запросами execute по 25 штук.
+    Каждый вызов получает свой результат или ошибку:
+
+        batch = VkBatch(vk)
+        calls = {chat_id: batch.messages.removeChatUser(chat_id=chat_id, user_id=user_id)
+                 for chat_id in chat_ids}
+        batch.execute()
+        kicked = [chat_id for chat_id, call in calls.items() if call.ok]
+    """
+
+    def __init__(self, vk):
+        # vk - объект get_api(), запросы execute выполняются через его сессию
+        self.session = getattr(vk, '_vk', vk)
+        self.calls = []
+
+    def __getattr__(self, name):
+        return BatchMethod(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, method, values=None):
+        """Добавить вызов в пакет"""
+        call = BatchCall(method, values or {})
+        self.calls.append(call)
+        return call
+
+    def execute(self):
+        """Выполнить все накопленные вызовы"""
+        calls, self.calls = self.calls, []
+        for chunk, code in self._chunks(calls):
+            self._execute_chunk(chunk, code)
+        return calls
+
+    def _chunks(self, calls):
+        """Разбить вызовы на запросы execute с учетом ограничений VK"""
+        chunk = []
+        parts = []
+        length = 0
+        for call in calls:
+            part = f"API.{call.method}({json.dumps(call.values, ensure_ascii=False, separators=(',', ':'))})"
+            if chunk and (len(chunk) >= MAX_CALLS_PER_EXECUTE or length + len(part) > MAX_CODE_LENGTH):
+                yield chunk, self._code(parts)
+                chunk, parts, length = [], [], 0
+            chunk.append(call)
+            parts.append(part)
+            length += len(part) + 1
+        if chunk:
+            yield chunk, self._code(parts)
+
+    @staticmethod
+    def _code(parts):
+        return f"return [{','.join(parts)}];"
+
+    def _execute_chunk(self, chunk, code):
+        try:
+            response = self.session.method('execute', {'code': code}, raw=True)
+        except Exception as e:
+            # Запрос execute не выполнен целиком - ошибка у каждого вызова
+            log_error(f"Ошибка при выполнении пакета из {len(chunk)} вызовов: {str(e)}")
+            for call in chunk:
+                call.set_error(e)
+            return
+
+        results = response.get('response') or []
+        errors = iter(response.get('execute_errors') or [])
+        for index, call in enumerate(chunk):
+            result = results[index] if index < len(results) else False
+            if result is not False:
+                call.set_result(result)
+                continue
+
+            # Ошибки в execute_errors идут в порядке неудачных вызовов
+            error = next(errors, None) or {}
+            call.set_error(VkBatchError(
+                error.get('method', call.method),
+                error.get('error_code', 0),
+                error.get('error_msg', "Неизвестная ошибка")
+            ))
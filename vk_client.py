@@ -0,0 +1,36 @@
+import os
+import logging
+import requests
+import vk_api
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+VK_API_DEFAULT_URL = 'https://api.vk.com/'
+
+
+class ApiUrlSession(requests.Session):
+    """HTTP сессия, перенаправляющая запросы к api.vk.com на другой адрес"""
+
+    def __init__(self, api_url):
+        super().__init__()
+        self.api_url = api_url.rstrip('/') + '/'
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(VK_API_DEFAULT_URL):
+            url = self.api_url + url[len(VK_API_DEFAULT_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def create_vk_session(token):
+    """
+    Создать сессию VK API.
+
+    Если задана переменная VK_API_URL, все вызовы методов отправляются
+    на указанный адрес (например, на локальный fake_vk_server.py).
+    """
+    api_url = os.getenv('VK_API_URL')
+    if api_url:
+        logger.info(f"Вызовы VK API перенаправлены на {api_url}")
+        return vk_api.VkApi(token=token, session=ApiUrlSession(api_url))
+    return vk_api.VkApi(token=token)
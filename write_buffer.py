@@ -0,0 +1,184 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from db_writer import db_writer
+from leaderboards import leaderboards
+import activity_rollups
+from logger import log_error
+
+# Получаем существующий логгер
+logger = logging.getLogger('bot')
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная запись истории сообщений, счетчиков сообщений и времени активности.
+
+    Вместо INSERT и UPDATE с отдельным commit на каждое сообщение записи
+    накапливаются в памяти и сбрасываются одной транзакцией (executemany)
+    раз в interval секунд или при накоплении max_rows строк. В той же
+    транзакции увеличиваются счетчики users.messages_count и
+    chat_message_counts и сводки activity_rollups, поэтому они всегда
+    согласованы с историей.
+    Код, которому нужны еще не записанные данные, вызывает flush() перед чтением.
+    """
+
+    def __init__(self, interval=0.2, max_rows=500, duplicate_window=5):
+        self.interval = interval
+        self.max_rows = max_rows
+        # Повторное сообщение пользователя в беседе за это время не записывается
+        self.duplicate_window = timedelta(seconds=duplicate_window)
+        # (user_id, chat_id, message_type, timestamp)
+        self.history = []
+        # user_id -> время последней активности
+        self.activity = {}
+        # (user_id, chat_id) -> время последнего записанного сообщения
+        self.last_message = {}
+        self.lock = threading.Lock()
+        # Сбросы выполняются по одному: flush() при чтении ждет текущий сброс
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.flushes = 0
+        self.rows = 0
+        self.max_batch = 0
+        self.flush_time = 0.0
+        self.duplicates = 0
+        self.errors = 0
+
+    def record_message(self, user_id, chat_id, message_type='text'):
+        """Добавить сообщение в историю и обновить время активности пользователя"""
+        now = datetime.now()
+        key = (user_id, chat_id)
+        with self.lock:
+            last = self.last_message.get(key)
+            if last and now - last < self.duplicate_window:
+                self.duplicates += 1
+                return False
+            self.last_message[key] = now
+            self.history.append((user_id, chat_id, message_type, now))
+            self.activity[user_id] = now
+            full = len(self.history) >= self.max_rows
+
+        if full:
+            self.wakeup.set()
+        return True
+
+    def pending(self):
+        """Количество строк, ожидающих записи"""
+        with self.lock:
+            return len(self.history) + len(self.activity)
+
+    def flush(self):
+        """Записать накопленные данные одной транзакцией. Возвращает число строк"""
+        with self.flush_lock:
+            with self.lock:
+                history, self.history = self.history, []
+                activity, self.activity = self.activity, {}
+                # Забываем сообщения, вышедшие за окно проверки повторов
+                threshold = datetime.now() - self.duplicate_window
+                self.last_message = {key: ts for key, ts in self.last_message.items() if ts > threshold}
+
+            if not history and not activity:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                # Запись идет через поток записи, вместе с другими ожидающими записями
+                user_counts = db_writer.call(self._write, history, activity)
+            except Exception as e:
+                # Возвращаем данные в буфер, чтобы записать их при следующем сбросе
+                with self.lock:
+                    self.history[:0] = history
+                    for user_id, timestamp in activity.items():
+                        self.activity.setdefault(user_id, timestamp)
+                    self.errors += 1
+                log_error(f"Ошибка при записи буфера сообщений ({len(history)} строк): {str(e)}")
+                return 0
+
+            # Счетчики записаны - обновляем топ по сообщениям
+            leaderboards.add_messages(user_counts)
+            elapsed = time.perf_counter() - started
+            count = len(history) + len(activity)
+            with self.lock:
+                self.flushes += 1
+                self.rows += count
+                self.max_batch = max(self.max_batch, count)
+                self.flush_time += elapsed
+            return count
+
+    def _write(self, c, history, activity):
+        # Прирост счетчиков по пользователям и по парам (беседа, пользователь)
+        user_counts = Counter(user_id for user_id, _, _, _ in history)
+        chat_counts = Counter((chat_id, user_id) for user_id, chat_id, _, _ in history)
+
+        c.executemany('''INSERT INTO message_history
+                        (user_id, chat_id, message_type, timestamp)
+                        VALUES (?, ?, ?, ?)''', history)
+        c.executemany('''INSERT INTO chat_message_counts (chat_id, user_id, messages_count)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(chat_id, user_id) DO UPDATE
+                        SET messages_count = messages_count + excluded.messages_count''',
+                      [(chat_id, user_id, count) for (chat_id, user_id), count in chat_counts.items()])
+        c.executemany('''UPDATE users
+                        SET last_activity = ?,
+                            messages_count = messages_count + ?
+                        WHERE user_id = ?''',
+                      [(timestamp, user_counts[user_id], user_id)
+                       for user_id, timestamp in activity.items()])
+        # Почасовые и суточные сводки активности
+        activity_rollups.record(c, history)
+        return user_counts
+
+    def start(self):
+        """Запустить фоновый сброс буфера"""
+        if self.thread:
+            return
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+        # Остаток буфера записывается при завершении процесса
+        atexit.register(self.stop)
+        logger.info(f"Отложенная запись запущена (каждые {self.interval * 1000:.0f} мс или {self.max_rows} строк)")
+
+    def stop(self):
+        """Остановить фоновый сброс и записать все, что осталось в буфере"""
+        if self.thread:
+            self.stopped = True
+            self.wakeup.set()
+            self.thread.join(timeout=10)
+            self.thread = None
+        count = self.flush()
+        if count:
+            logger.info(f"При остановке записано {count} строк из буфера")
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'pending': len(self.history) + len(self.activity),
+                'flushes': self.flushes,
+                'rows': self.rows,
+                'avg_batch': self.rows / self.flushes if self.flushes else 0.0,
+                'max_batch': self.max_batch,
+                'avg_flush_ms': self.flush_time / self.flushes * 1000 if self.flushes else 0.0,
+                'duplicates': self.duplicates,
+                'errors': self.errors
+            }
+
+
+# Создаем глобальный буфер отложенной записи
+write_buffer = WriteBehindBuffer(
+    interval=int(os.getenv('WRITE_BUFFER_INTERVAL_MS', '200')) / 1000,
+    max_rows=int(os.getenv('WRITE_BUFFER_MAX_ROWS', '500'))
+)